@@ -0,0 +1,220 @@
+'''
+Benchmark each pipeline stage on synthetic data, offline
+
+Generates (or reuses) synthetic context, exome, mutation rate and coverage tables for each panel size, times
+the main pipeline functions on them and reports throughput (input rows per second) and peak memory of the
+driver and JVM. Results can be saved as a named baseline and compared against one to catch regressions:
+
+    python benchmarks/benchmark_pipeline.py --genes 1 100 1000 --save-baseline v0.3
+    python benchmarks/benchmark_pipeline.py --genes 1 100 1000 --compare v0.3
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import hail as hl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gnomadIC import data, model, summarise
+from gnomadIC.utils import intervals, synthetic, utils
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+GROUPING = ['annotation', 'modifier', 'transcript', 'gene', 'canonical']
+
+
+def _rss_mb(pid):
+    '''Resident memory of a process and all its descendants (Linux /proc), in MB'''
+    total, pending = 0, [pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                total += next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+            with open(f'/proc/{pid}/task/{pid}/children') as f:
+                pending += [int(x) for x in f.read().split()]
+        except (OSError, StopIteration):
+            continue
+    return total / 1024
+
+
+class PeakMemory:
+    '''Samples the resident memory of this process and its children (the JVM) while a step runs'''
+
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, _rss_mb(os.getpid()))
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def time_step(results, name, n_genes, rows, func):
+    '''Run func, recording wall time, throughput and peak memory, and return its result'''
+    with PeakMemory() as memory:
+        start = time.time()
+        output = func()
+        seconds = time.time() - start
+    results.append({
+        'stage': name,
+        'genes': n_genes,
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_s': round(rows / seconds, 1) if seconds > 0 else None,
+        'peak_rss_mb': round(memory.peak_mb, 1)
+    })
+    print(f'{name:>28} {n_genes:>6} genes {rows:>12,} rows {seconds:>9.2f}s '
+          f'{results[-1]["rows_per_s"] or 0:>14,.0f} rows/s {memory.peak_mb:>9,.0f} MB')
+    return output
+
+
+def benchmark_scale(n_genes, bases_per_gene, data_dir, results):
+    '''Time every stage on a synthetic panel of n_genes genes'''
+    root = f'{data_dir}/genes_{n_genes}_bases_{bases_per_gene}'
+    paths = synthetic.write_synthetic_dataset(root, n_genes, bases_per_gene)
+    work = f'{root}/work'
+    os.makedirs(work, exist_ok=True)
+    panel = synthetic.synthetic_gene_panel(n_genes, bases_per_gene)
+    read_plan = intervals.ReadPlan(zip(panel['contig'], panel['start'], panel['end']))
+
+    n_context = hl.read_table(paths['context_path']).count()
+    n_exomes = hl.read_table(paths['exomes_path']).count()
+
+    def extract_context():
+        context_ht, _ = data.get_table(paths['context_path'], read_plan, 'standard', trimer=True)
+        context_ht.write(f'{work}/context.ht', overwrite=True)
+        return hl.read_table(f'{work}/context.ht')
+
+    def extract_exomes():
+        exome_ht, _ = data.get_table(paths['exomes_path'], read_plan, 'standard', additional_fields=['freq', 'filters'], trimer=True)
+        exome_ht = data.filter_exomes(exome_ht.annotate(pass_filters=hl.len(exome_ht.filters) == 0))
+        exome_ht.write(f'{work}/exomes.ht', overwrite=True)
+        return hl.read_table(f'{work}/exomes.ht')
+
+    context_ht = time_step(results, 'get_table[context]', n_genes, n_context, extract_context)
+    exome_ht = time_step(results, 'get_table[exomes]', n_genes, n_exomes, extract_exomes)
+
+    coverage_ht = hl.read_table(paths['po_coverage_path'])
+    coverage_model, plateau_models = time_step(
+        results, 'build_models', n_genes, coverage_ht.count(),
+        lambda: utils.build_models(coverage_ht, trimers=True))
+    # Several cutoffs in the same single scan (sensitivity analyses on the high coverage cutoff)
+    time_step(results, 'build_models_sweep[4 cutoffs]', n_genes, coverage_ht.count(),
+              lambda: utils.build_models_sweep(coverage_ht, [10, 20, 30, 40], trimers=True))
+    mutation_rate_ht = hl.read_table(paths['mutation_rate_path']).select('mu_snp')
+    models = {
+        'mutation_rate_ht': mutation_rate_ht,
+        'mutation_rate_index': utils.build_mutation_rate_index(mutation_rate_ht, 3),
+        'coverage_model': coverage_model,
+        'plateau_models': plateau_models
+    }
+
+    grouping = GROUPING + ['region']
+    n_context = context_ht.count()
+    expected_ht = time_step(
+        results, 'get_expected_variants', n_genes, n_context,
+        lambda: model.get_expected_variants(model.tag_regions(context_ht), models, grouping, f'{work}/possible.ht'))
+    n_exomes = exome_ht.count()
+    po_ht = time_step(
+        results, 'get_proportion_observed', n_genes, n_exomes + expected_ht.count(),
+        lambda: model.get_proportion_observed(model.tag_regions(exome_ht), expected_ht, grouping, f'{work}/po.ht'))
+    time_step(
+        results, 'summarise_prop_observed', n_genes, po_ht.count(),
+        lambda: summarise.summarise_prop_observed(po_ht, f'{work}/summary.ht'))
+
+    # Gene-level observed and expected counts for the confidence interval and pLI steps
+    po_ht = po_ht.filter(po_ht.modifier == 'HC')
+    gene_ht = po_ht.group_by('gene').aggregate(obs=hl.agg.sum(po_ht.observed_variants), exp=hl.agg.sum(po_ht.expected_variants))
+    gene_ht = gene_ht.checkpoint(f'{work}/lof_by_gene.ht', overwrite=True)
+    n_gene_rows = gene_ht.count()
+    time_step(
+        results, 'oe_confidence_interval', n_genes, n_gene_rows,
+        lambda: utils.oe_confidence_interval(gene_ht, gene_ht.obs, gene_ht.exp).write(f'{work}/oe_ci.ht', overwrite=True))
+    time_step(
+        results, 'oe_confidence_interval_np', n_genes, n_gene_rows,
+        lambda: utils.annotate_oe_confidence_intervals(gene_ht, {'oe': (gene_ht.obs, gene_ht.exp)}).write(f'{work}/oe_ci_np.ht', overwrite=True))
+    time_step(
+        results, 'pLI', n_genes, n_gene_rows,
+        lambda: utils.pLI(gene_ht, gene_ht.obs, gene_ht.exp).write(f'{work}/pli.ht', overwrite=True))
+
+
+def git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BENCHMARK_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    '''Stages at least `tolerance` (a fraction) slower than the baseline at the same panel size'''
+    reference = {(x['stage'], x['genes']): x for x in baseline['results']}
+    regressions = []
+    for result in results:
+        base = reference.get((result['stage'], result['genes']))
+        if base is None or not base['seconds']:
+            continue
+        change = result['seconds'] / base['seconds'] - 1
+        flag = 'REGRESSION' if change > tolerance else ''
+        print(f'{result["stage"]:>28} {result["genes"]:>6} genes {base["seconds"]:>9.2f}s -> {result["seconds"]:>9.2f}s '
+              f'({change:+.0%}) {flag}')
+        if flag:
+            regressions.append(result)
+    return regressions
+
+
+def main(args):
+    hl.init(log='hail_logs/benchmark.log', quiet=True, global_seed=args.seed)
+    results = []
+    for n_genes in args.genes:
+        benchmark_scale(n_genes, args.bases_per_gene, args.data_dir, results)
+
+    report = {
+        'version': git_version(),
+        'hail_version': hl.version(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'bases_per_gene': args.bases_per_gene,
+        'results': results
+    }
+    if args.save_baseline:
+        os.makedirs(args.baseline_dir, exist_ok=True)
+        path = os.path.join(args.baseline_dir, f'{args.save_baseline}.json')
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Saved baseline to {path}')
+    if args.compare:
+        with open(os.path.join(args.baseline_dir, f'{args.compare}.json')) as f:
+            baseline = json.load(f)
+        if baseline['bases_per_gene'] != args.bases_per_gene:
+            print(f'Warning: baseline used {baseline["bases_per_gene"]} bases per gene')
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pipeline stages on synthetic data')
+    parser.add_argument('--genes', nargs='+', type=int, default=[1, 10, 100], help=f'Panel sizes to benchmark (up to {synthetic.MAX_GENES})')
+    parser.add_argument('--bases-per-gene', type=int, default=300, help='Coding bases per synthetic gene')
+    parser.add_argument('--data-dir', default='data/synthetic', help='Where synthetic tables are written and reused')
+    parser.add_argument('--baseline-dir', default=os.path.join(BENCHMARK_DIR, 'baselines'), help='Directory of saved baselines')
+    parser.add_argument('--save-baseline', help='Save results as a baseline with this name')
+    parser.add_argument('--compare', help='Compare results to the baseline with this name (exits 1 on regressions)')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Slowdown counted as a regression (0.2 = 20%%)')
+    parser.add_argument('--seed', type=int, default=0, help='Hail global seed for the synthetic tables')
+    args = parser.parse_args()
+    main(args)
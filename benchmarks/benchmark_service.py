@@ -0,0 +1,141 @@
+'''
+Load-test the constraint query service
+
+Serves a synthetic summary (or --summary, a real one) from a background server, then sends single-gene GETs and
+batched POST queries from --clients concurrent clients, first with a cold cache and then a hot one. Reports p50
+and p99 latency and throughput of each; exits 1 if a hot p99 exceeds --max-p99-ms:
+
+    python benchmarks/benchmark_service.py --genes 20000 --batch-size 500 --requests 200 --clients 8
+'''
+import argparse
+import http.client
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gnomadIC import service
+
+VARIANT_CLASSES = ('lof_hc', 'lof_lc', 'mis_pphen', 'mis_non_pphen', 'syn', 'non-coding variants')
+
+
+def synthetic_summary(n_genes: int, transcripts_per_gene: int = 2, seed: int = 0) -> pd.DataFrame:
+    '''Summary with the columns of summarise.summarise_prop_observed, one row per gene, transcript and variant class'''
+    rng = np.random.default_rng(seed)
+    genes = np.repeat([f'SYN{i:05d}' for i in range(n_genes)], transcripts_per_gene * len(VARIANT_CLASSES))
+    transcripts = np.repeat([f'ENST{i:08d}' for i in range(n_genes * transcripts_per_gene)], len(VARIANT_CLASSES))
+    n_rows = len(genes)
+    exp = rng.gamma(2, 20, n_rows)
+    obs = rng.poisson(exp * rng.uniform(0.2, 1.2, n_rows))
+    return pd.DataFrame({
+        'gene': genes,
+        'transcript': transcripts,
+        'canonical': np.tile(np.repeat([True] + [False] * (transcripts_per_gene - 1), len(VARIANT_CLASSES)), n_genes),
+        'variant_class': np.tile(VARIANT_CLASSES, n_genes * transcripts_per_gene),
+        'obs': obs,
+        'exp': exp,
+        'oe': obs / exp,
+        'adj_mu': exp * 1e-6,
+        'raw_mu': exp * 1e-6,
+        'poss': rng.poisson(exp * 10),
+        'oe_lower': obs / exp * 0.8,
+        'oe_upper': obs / exp * 1.2
+    })
+
+
+def timed_requests(port, requests, clients):
+    '''Send (method, path, body) requests from `clients` threads, each on its own connection; returns latencies in s'''
+    def worker(chunk):
+        connection = http.client.HTTPConnection('127.0.0.1', port)
+        latencies = []
+        for method, path, body in chunk:
+            start = time.perf_counter()
+            connection.request(method, path, body=body, headers={'Content-Type': 'application/json'} if body else {})
+            response = connection.getresponse()
+            response.read()
+            latencies.append(time.perf_counter() - start)
+            if response.status != 200:
+                raise RuntimeError(f'{method} {path} returned {response.status}')
+        connection.close()
+        return latencies
+    chunks = [requests[i::clients] for i in range(clients)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as pool:
+        latencies = [x for chunk in pool.map(worker, chunks) for x in chunk]
+    return np.array(latencies), time.perf_counter() - start
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    if args.summary:
+        summary = service.load_summary(args.summary)
+    else:
+        summary = synthetic_summary(args.genes)
+    start = time.perf_counter()
+    index = service.ConstraintIndex(summary, cache_size=args.cache_size)
+    load_time = time.perf_counter() - start
+    server = service.serve_in_background(index)
+    port = server.server_port
+    genes = list(index.rows)
+    print(f'Indexed {len(summary)} rows of {len(genes)} genes in {load_time:.2f}s, serving on port {port}')
+
+    def gets():
+        return [('GET', f'/genes/{gene}?canonical=true', None) for gene in rng.choice(genes, args.requests)]
+
+    def posts():
+        return [('POST', '/query', json.dumps({'genes': list(rng.choice(genes, args.batch_size, replace=False))}))
+                for _ in range(args.requests)]
+
+    results = []
+    for name, make_requests in ((f'GET 1 gene', gets), (f'POST {args.batch_size} genes', posts)):
+        for cache in ('cold', 'hot'):
+            if cache == 'cold':
+                index.lookup.cache_clear()
+            else:
+                # Warm the cache with every gene
+                timed_requests(port, [('POST', '/query', json.dumps({'genes': genes[i:i + service.MAX_BATCH_GENES]}))
+                                      for i in range(0, len(genes), service.MAX_BATCH_GENES)], 1)
+                timed_requests(port, [('GET', f'/genes/{gene}?canonical=true', None) for gene in genes], args.clients)
+            latencies, duration = timed_requests(port, make_requests(), args.clients)
+            result = {
+                'query': name,
+                'cache': cache,
+                'requests': len(latencies),
+                'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 3),
+                'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 3),
+                'requests_per_s': round(len(latencies) / duration, 1)
+            }
+            results.append(result)
+            print(f'{name:>18} {cache:>4} p50 {result["p50_ms"]:>9.3f}ms p99 {result["p99_ms"]:>9.3f}ms '
+                  f'{result["requests_per_s"]:>9.1f} req/s')
+    print(f'Cache: {index.stats()["cache"]}')
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'rows': len(summary), 'genes': len(genes),
+                       'clients': args.clients, 'results': results}, f, indent=2)
+    slow = [f'{x["query"]}' for x in results if x['cache'] == 'hot' and args.max_p99_ms and x['p99_ms'] > args.max_p99_ms]
+    if slow:
+        print(f'Hot p99 above {args.max_p99_ms}ms for: {", ".join(slow)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load-test the constraint query service')
+    parser.add_argument('--summary', help='Serve this summary instead of a synthetic one')
+    parser.add_argument('--genes', type=int, default=20000, help='Genes in the synthetic summary')
+    parser.add_argument('--batch-size', type=int, default=500, help='Genes per POST query')
+    parser.add_argument('--requests', type=int, default=200, help='Requests of each kind')
+    parser.add_argument('--clients', type=int, default=8, help='Concurrent clients')
+    parser.add_argument('--cache-size', type=int, default=service.CACHE_SIZE * 16, help='Lookups kept in the cache')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-p99-ms', type=float, help='Fail if a hot-cache p99 latency exceeds this')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,77 @@
+'''
+Benchmark start-up time of the package and command line interface
+
+Times fresh interpreter invocations that should return without importing hail or starting the JVM (package
+import, --help, validation, an argument error) and, for reference, a full import of the pipeline modules.
+Each command runs --repeat times; exits 1 if any fast command's median exceeds --max-seconds:
+
+    python benchmarks/benchmark_startup.py --repeat 20 --max-seconds 0.5
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CLI = [sys.executable, os.path.join(REPO_DIR, 'constraint_analysis.py')]
+
+# name -> (command, whether it should start without hail)
+COMMANDS = {
+    'import gnomadIC': ([sys.executable, '-c', 'import gnomadIC'], True),
+    'cli --help': (CLI + ['--help'], True),
+    'cli validate': (CLI + ['validate', '--tasks', 'model', 'summarise', '--backend', 'local'], True),
+    'cli argument error': (CLI + ['run', '--tasks', 'bogus'], True),
+    'import gnomadIC.run': ([sys.executable, '-c', 'import gnomadIC.run'], False),
+}
+
+
+def time_command(command, repeat):
+    '''Wall times of `repeat` runs of command, plus its exit code and whether hail was imported'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=REPO_DIR, capture_output=True, text=True)
+        times.append(time.perf_counter() - start)
+    # One more run with -X importtime to see whether hail was imported
+    profile = subprocess.run([command[0], '-X', 'importtime'] + command[1:], cwd=REPO_DIR, capture_output=True, text=True)
+    imports_hail = any(line.rstrip().endswith('| hail') for line in profile.stderr.splitlines())
+    return times, result.returncode, imports_hail
+
+
+def main(args):
+    results = []
+    failed = []
+    for name, (command, fast) in COMMANDS.items():
+        times, returncode, imports_hail = time_command(command, args.repeat)
+        result = {
+            'command': name,
+            'median_s': round(statistics.median(times), 4),
+            'min_s': round(min(times), 4),
+            'max_s': round(max(times), 4),
+            'exit_code': returncode,
+            'imports_hail': imports_hail
+        }
+        results.append(result)
+        print(f'{name:>22} median {result["median_s"]:>7.3f}s min {result["min_s"]:>7.3f}s max {result["max_s"]:>7.3f}s '
+              f'exit {returncode:>3} {"imports hail" if imports_hail else ""}')
+        if fast and (imports_hail or (args.max_seconds and result['median_s'] > args.max_seconds)):
+            failed.append(name)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': args.repeat, 'results': results}, f, indent=2)
+    if failed:
+        print(f'Slow start-up (or hail imported) for: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark package and CLI start-up time')
+    parser.add_argument('--repeat', type=int, default=10, help='Runs of each command')
+    parser.add_argument('--max-seconds', type=float, help='Fail if a fast command takes longer than this (median)')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,81 @@
+'''
+Check the expected index against expected variants computed from the context extract, on synthetic data, offline
+
+Builds the index for a synthetic exome (twice, to check an existing build is reused), then models a panel taken
+from it both from the context extract and from the index, and compares expected and observed counts of every
+panel gene row by row. Prints build, reuse and model times; exits 1 if any count differs:
+
+    python benchmarks/check_expected_index.py --genes 48 --panel-genes 6
+'''
+import argparse
+import os
+import sys
+import time
+
+import hail as hl
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gnomadIC import data, model, expected_index
+from gnomadIC.utils import intervals, synthetic
+from check_local_backend import work_paths
+
+COUNTS = ('observed_variants', 'expected_variants', 'possible_variants', 'adjusted_mutation_rate', 'raw_mutation_rate')
+
+
+def main(args):
+    hl.init(log='hail_logs/check_expected_index.log', quiet=True, global_seed=args.seed)
+    root = f'{args.data_dir}/genes_{args.genes}_bases_{args.bases_per_gene}'
+    paths = work_paths(root, synthetic.write_synthetic_dataset(root, args.genes, args.bases_per_gene))
+    index_dir = f'{root}/work/expected_index'
+    contigs = list(synthetic.GENE_CONTIGS)
+
+    start = time.time()
+    expected_index.build_expected_index(paths, index_dir, contigs=contigs, overwrite=True)
+    build_time = time.time() - start
+    start = time.time()
+    expected_index.build_expected_index(paths, index_dir, contigs=contigs)
+    reuse_time = time.time() - start
+
+    # Every other gene, so the panel's intervals leave gaps
+    panel = synthetic.synthetic_gene_panel(args.genes, args.bases_per_gene).iloc[::2].head(args.panel_genes)
+    genes = list(panel['symbol'])
+    read_plan = intervals.ReadPlan(zip(panel['contig'], panel['start'], panel['end']))
+
+    start = time.time()
+    context_data = data.get_data(paths, read_plan, 'standard')
+    context_po = model.model(paths, context_data, 'standard')['prop_observed_ht']
+    context_df = context_po.filter(hl.literal(set(genes)).contains(context_po.gene)).to_pandas()
+    context_time = time.time() - start
+
+    index_paths = {**paths, 'po_output_path': f'{root}/work/prop_observed_index.ht'}
+    start = time.time()
+    index_data = data.get_data(index_paths, read_plan, 'standard', context=False)
+    index_df = expected_index.model(index_paths, index_data, 'standard', index_dir, genes)['prop_observed_ht'].to_pandas()
+    index_time = time.time() - start
+
+    print(f'{"build index":>22} {build_time:>8.2f}s')
+    print(f'{"reuse built index":>22} {reuse_time:>8.2f}s')
+    print(f'{"model from context":>22} {context_time:>8.2f}s')
+    print(f'{"model from index":>22} {index_time:>8.2f}s')
+
+    keys = model.GROUPING + ['region']
+    merged = context_df.merge(index_df, on=keys, how='outer', suffixes=('_context', '_index'), indicator=True)
+    differs = np.array(merged['_merge'] != 'both')
+    for count in COUNTS:
+        differs |= ~np.isclose(merged[f'{count}_context'].fillna(0), merged[f'{count}_index'].fillna(0), rtol=1e-9, atol=0)
+    print(f'{len(context_df)} rows from the context extract and {len(index_df)} from the index, {differs.sum()} differ')
+    if differs.any():
+        print(merged[differs].to_string())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the expected index against the context extract on synthetic data')
+    parser.add_argument('--genes', type=int, default=48, help=f'Genes in the synthetic exome (up to {synthetic.MAX_GENES})')
+    parser.add_argument('--panel-genes', type=int, default=6, help='Genes of the panel looked up in the index')
+    parser.add_argument('--bases-per-gene', type=int, default=300, help='Coding bases per synthetic gene')
+    parser.add_argument('--data-dir', default='data/synthetic', help='Where synthetic tables are written and reused')
+    parser.add_argument('--seed', type=int, default=0, help='Hail global seed for the synthetic tables')
+    args = parser.parse_args()
+    main(args)
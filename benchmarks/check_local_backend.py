@@ -0,0 +1,87 @@
+'''
+Check that the local (pandas) backend reproduces the Hail backend, on synthetic data, offline
+
+Runs the download, model and summarise stages of both backends on the same synthetic panel and compares the
+summaries row by row. The Hail backend computes confidence intervals with its default grid search and the local
+backend with NumPy, so CI bounds and log_P_H0 are compared to the grid's tolerance (see local.compare_summaries).
+Prints the wall time of each backend's stages and exits 1 if any row differs:
+
+    python benchmarks/check_local_backend.py --genes 24
+'''
+import argparse
+import os
+import sys
+import time
+
+import hail as hl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gnomadIC import data, model, summarise, local
+from gnomadIC.utils import intervals, synthetic
+
+
+def work_paths(root, paths):
+    '''Run paths (as from run.setup_paths) for a synthetic dataset under root/work'''
+    work = f'{root}/work'
+    os.makedirs(work, exist_ok=True)
+    return {
+        **paths,
+        'mutation_rate_local_path': f'{work}/mutation_rate.ht',
+        'coverage_models_local_dir': f'{work}/coverage_models',
+        'exomes_local_path': f'{work}/exomes.ht',
+        'context_local_path': f'{work}/context.ht',
+        'possible_variants_ht_path': f'{work}/possible.ht',
+        'po_output_path': f'{work}/prop_observed.ht',
+        'exomes_local_frame_path': f'{work}/exomes.pkl',
+        'context_local_frame_path': f'{work}/context.pkl',
+        'po_output_frame_path': f'{work}/prop_observed.pkl',
+    }
+
+
+def run_backend(stage_functions, paths, read_plan, summary_path, **summarise_args):
+    '''Run download, model and summarise, returning the summary and the wall time of each stage'''
+    times, stage_data = {}, {}
+    start = time.time()
+    stage_data.update(stage_functions['download'](paths, read_plan, 'standard'))
+    times['download'] = time.time() - start
+    start = time.time()
+    stage_data.update(stage_functions['model'](paths, stage_data, 'standard'))
+    times['model'] = time.time() - start
+    start = time.time()
+    stage_functions['summarise']({**paths, 'summary_output_path': summary_path}, stage_data, 'standard', **summarise_args)
+    times['summarise'] = time.time() - start
+    return stage_data['summary'], times
+
+
+def main(args):
+    hl.init(log='hail_logs/check_local_backend.log', quiet=True, global_seed=args.seed)
+    root = f'{args.data_dir}/genes_{args.genes}_bases_{args.bases_per_gene}'
+    paths = work_paths(root, synthetic.write_synthetic_dataset(root, args.genes, args.bases_per_gene))
+    panel = synthetic.synthetic_gene_panel(args.genes, args.bases_per_gene)
+    read_plan = intervals.ReadPlan(zip(panel['contig'], panel['start'], panel['end']))
+
+    # The Hail run fits and stores the models, so the local run reads them from the store
+    hail_summary, hail_times = run_backend(
+        {'download': data.get_data, 'model': model.model, 'summarise': summarise.summarise},
+        paths, read_plan, f'{root}/work/summary_hail.ht')
+    local_summary, local_times = run_backend(
+        {'download': local.get_data, 'model': local.model, 'summarise': local.summarise},
+        paths, read_plan, f'{root}/work/summary_local.ht')
+
+    for stage in hail_times:
+        print(f'{stage:>10} hail {hail_times[stage]:>8.2f}s local {local_times[stage]:>8.2f}s')
+    differences = local.compare_summaries(hail_summary, local_summary)
+    print(f'{len(hail_summary)} Hail and {len(local_summary)} local summary rows, {len(differences)} differ')
+    if len(differences):
+        print(differences.to_string())
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the local backend against the Hail backend on synthetic data')
+    parser.add_argument('--genes', type=int, default=24, help=f'Panel size (up to {synthetic.MAX_GENES})')
+    parser.add_argument('--bases-per-gene', type=int, default=300, help='Coding bases per synthetic gene')
+    parser.add_argument('--data-dir', default='data/synthetic', help='Where synthetic tables are written and reused')
+    parser.add_argument('--seed', type=int, default=0, help='Hail global seed for the synthetic tables')
+    args = parser.parse_args()
+    main(args)
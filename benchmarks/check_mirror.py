@@ -0,0 +1,132 @@
+'''
+Check the resource cache's LRU eviction, pinning and staleness checks on small local tables, offline
+
+Local directories laid out like Hail tables stand in for the remote bucket. Each check mirrors some of them
+through a size-bounded ResourceCache and asserts which mirrors survive. Prints one line per check; exits 1
+if any check fails:
+
+    python benchmarks/check_mirror.py --table-bytes 4096
+'''
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from gnomadIC.utils import mirror
+
+PARTS = ('part-0', 'part-1', 'part-2', 'part-3')
+
+
+def write_table(path, table_bytes, fill=b'a'):
+    '''A directory shaped like a Hail table, with `table_bytes` of row data split over PARTS'''
+    for rel, size in [('metadata.json.gz', 64), ('_SUCCESS', 0)] + [(f'rows/parts/{part}', table_bytes // len(PARTS)) for part in PARTS]:
+        os.makedirs(os.path.dirname(os.path.join(path, rel)), exist_ok=True)
+        with open(os.path.join(path, rel), 'wb') as f:
+            f.write(fill * size)
+    return path
+
+
+def mirrored(cache):
+    return set(cache._read_manifest())
+
+
+def check_lru(root, table_bytes):
+    '''The least recently used mirror is evicted first'''
+    tables = [write_table(f'{root}/remote/lru_{i}.ht', table_bytes) for i in range(3)]
+    cache = mirror.ResourceCache(f'{root}/lru_cache', max_bytes=int(2.5 * (table_bytes + 64)))
+    cache.fetch(tables[0])
+    time.sleep(0.01)
+    cache.fetch(tables[1])
+    time.sleep(0.01)
+    cache.fetch(tables[0])  # a cache hit makes tables[0] the most recently used
+    time.sleep(0.01)
+    cache.fetch(tables[2])
+    return mirrored(cache) == {tables[0], tables[2]} and not os.path.exists(cache.local_path(tables[1]))
+
+
+def check_pinned(root, table_bytes):
+    '''Pinned mirrors are kept over the size limit, and evicted once released'''
+    tables = [write_table(f'{root}/remote/pinned_{i}.ht', table_bytes) for i in range(3)]
+    cache = mirror.ResourceCache(f'{root}/pinned_cache', max_bytes=table_bytes + 64)
+    with cache.pin(tables[:2]):
+        for table in tables:
+            cache.fetch(table)
+            time.sleep(0.01)
+        kept = mirrored(cache) == set(tables)
+    cache.evict()
+    return kept and mirrored(cache) == {tables[2]}
+
+
+def check_prefetch(root, table_bytes):
+    '''Resources mirrored by one prefetch are all kept until it returns, even over the size limit'''
+    tables = [write_table(f'{root}/remote/prefetch_{i}.ht', table_bytes) for i in range(4)]
+    cache = mirror.ResourceCache(f'{root}/prefetch_cache', max_bytes=table_bytes + 64)
+    local_paths = mirror.prefetch({table: mirror.MirroredTableResource(table, cache) for table in tables}, max_workers=2)
+    return mirrored(cache) == set(tables) and all(os.path.isdir(path) for path in local_paths.values())
+
+
+def check_partitions(root, table_bytes):
+    '''A partial mirror only holds the requested partitions and is extended in place'''
+    table = write_table(f'{root}/remote/parts.ht', table_bytes)
+    cache = mirror.ResourceCache(f'{root}/parts_cache')
+    local_path = cache.fetch(table, parts=['part-1'])
+    first = sorted(os.listdir(f'{local_path}/rows/parts')) == ['part-1']
+    cache.fetch(table, parts=['part-3'])
+    return (first and sorted(os.listdir(f'{local_path}/rows/parts')) == ['part-1', 'part-3']
+            and cache.is_cached(table, ['part-1', 'part-3']) and not cache.is_cached(table))
+
+
+def check_remote_change(root, table_bytes):
+    '''A remote file rewritten with the same size is mirrored again'''
+    table = write_table(f'{root}/remote/changed.ht', table_bytes)
+    cache = mirror.ResourceCache(f'{root}/changed_cache')
+    local_path = cache.fetch(table)
+    write_table(table, table_bytes, fill=b'b')
+    part = f'rows/parts/{PARTS[0]}'
+    mtime = os.path.getmtime(f'{table}/{part}') + 10
+    os.utime(f'{table}/{part}', (mtime, mtime))
+    stale = not cache.is_cached(table)
+    cache.fetch(table)
+    with open(f'{local_path}/{part}', 'rb') as f:
+        return stale and f.read(1) == b'b' and cache.is_cached(table)
+
+
+def check_local_damage(root, table_bytes):
+    '''A mirror with a truncated local file is mirrored again'''
+    table = write_table(f'{root}/remote/damaged.ht', table_bytes)
+    cache = mirror.ResourceCache(f'{root}/damaged_cache')
+    local_path = cache.fetch(table)
+    part = f'{local_path}/rows/parts/{PARTS[0]}'
+    with open(part, 'wb'):
+        pass
+    damaged = not cache.is_cached(table)
+    cache.fetch(table)
+    return damaged and os.path.getsize(part) == table_bytes // len(PARTS)
+
+
+CHECKS = (check_lru, check_pinned, check_prefetch, check_partitions, check_remote_change, check_local_damage)
+
+
+def main(args):
+    root = tempfile.mkdtemp(prefix='check_mirror_')
+    failed = []
+    try:
+        for check in CHECKS:
+            ok = check(root, args.table_bytes)
+            print(f'{check.__name__[len("check_"):]:>16} {"ok" if ok else "FAILED"}  {check.__doc__}')
+            if not ok:
+                failed.append(check.__name__)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check the resource cache on small local tables')
+    parser.add_argument('--table-bytes', type=int, default=4096, help='Row data bytes of each table')
+    args = parser.parse_args()
+    main(args)
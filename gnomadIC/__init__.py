@@ -1,4 +1,24 @@
-from .run import *
-from .data import *
-from .model import *
-from .summarise import *
\ No newline at end of file
+'''
+gnomadIC: gnomAD Inference of Constraint
+
+The pipeline modules (and with them hail and pandas) are imported on first use of a package-level name such
+as gnomadIC.run_tasks, so importing the package, or light modules such as gnomadIC.cli, is fast.
+Submodule names (gnomadIC.model, gnomadIC.summarise, ...) always refer to the modules.
+'''
+import importlib
+
+# Modules whose public names are available from the package, in order of precedence
+_EXPORTING_MODULES = ('run', 'data', 'model', 'summarise')
+_SUBMODULES = ('cli', 'data', 'expected_index', 'local', 'model', 'options', 'run', 'service', 'summarise', 'summarise_constraint_results', 'utils')
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'.{name}', __name__)
+    if not name.startswith('_'):
+        for module_name in _EXPORTING_MODULES:
+            module = importlib.import_module(f'.{module_name}', __name__)
+            if hasattr(module, name):
+                globals()[name] = getattr(module, name)
+                return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,174 @@
+'''
+Command line interface of the constraint pipeline
+
+Only the standard library is imported up front. Hail, pandas and the pipeline modules are imported, and Hail
+started, only by a `run` whose tasks need them, so --help, argument errors and `validate` return at once:
+
+    python constraint_analysis.py run --tasks download model summarise --test
+    python constraint_analysis.py validate --tasks model summarise --backend local
+    python constraint_analysis.py compare-reports data/a/run_report.json data/b/run_report.json
+    python constraint_analysis.py build-expected-index --contigs 21 22 --model standard
+    python constraint_analysis.py serve data/gnomad_standard/constraint_final.csv.gz --port 8000
+
+Invocations without a command run tasks, as before commands were added.
+'''
+import argparse
+import sys
+from typing import List, Optional
+
+from . import options
+
+COMMANDS = ('run', 'validate', 'compare-reports', 'build-expected-index', 'serve')
+# Run ID of the paths used to build the expected index (see run.setup_paths)
+EXPECTED_INDEX_RUN_ID = 'expected_index'
+
+
+def add_run_arguments(parser):
+    parser.add_argument('--targets', help='Path to target gene list',action='store')
+    parser.add_argument('--test', help='Run tests',action='store_true',default=False)
+    parser.add_argument('--controls',help='Include control genes',action='store_true',default=False)
+    parser.add_argument('--dataset', help='Which dataset to use', choices=options.DATASETS, default='gnomad')
+    parser.add_argument('--model', nargs= '+', help='Which model to apply (one of "standard", "syn_canonical", or "worst_csq" for now) - warning not implemented', default='standard')
+    parser.add_argument('--annotations',help='Which annotations to apply (path to file)',action='store')
+    parser.add_argument('--tasks', nargs='+', help='Which tasks to perform', choices=options.TASKS, required=True)
+    parser.add_argument('--overwrite', help='Overwrite everything, rerunning stages that are up to date', action='store_true')
+    parser.add_argument('--no-cache', help='Read model resources directly from Google Cloud instead of a local mirror', action='store_true')
+    parser.add_argument('--cache-max-gb', help='Size limit of the local resource mirror in GB (no limit by default)', type=float)
+    parser.add_argument('--cache-panel-partitions', help='Also mirror the context and exome partitions the gene panel touches', action='store_true')
+    parser.add_argument('--max-concurrent-jobs', help='Number of independent Hail jobs to submit at once (1 runs them in sequence)', type=int, default=3)
+    parser.add_argument('--joint', help='Flag observed variants on the context table and count possible, expected and observed variants together', action='store_true')
+    parser.add_argument('--packed', help='Store mutation contexts as packed integer codes instead of strings', action='store_true')
+    parser.add_argument('--backend', help='Run stages with Hail, or in-process with pandas for small panels (local)', choices=options.BACKENDS, default='hail')
+    parser.add_argument('--output-format', help='Write the summary as a gzipped CSV, or as a Parquet dataset written from the executors', choices=options.OUTPUT_FORMATS, default='csv')
+    parser.add_argument('--partition-by', nargs='+', help='Columns to partition the Parquet summary by (e.g. gene)')
+    parser.add_argument('--ci-engine', help='Compute o/e confidence intervals with the grid search in Hail or in NumPy (default: hail, or numpy with the local backend)', choices=options.CI_ENGINES)
+    parser.add_argument('--incremental', help='Keep per-gene results between runs and only extract and model genes new to the panel', action='store_true')
+    parser.add_argument('--expected-index', help='Take expected variants from the genome-wide expected index (see build-expected-index) instead of extracting the context table', action='store_true')
+    parser.add_argument('-q','--quiet',help='Run in quiet mode',action='store_true',default=False)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description='Estimate constraint in a gene panel from gnomAD')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+    add_run_arguments(commands.add_parser('run', help='Run pipeline tasks'))
+    add_run_arguments(commands.add_parser('validate', help='Check run options and input files without running anything'))
+    compare = commands.add_parser('compare-reports', help='Compare the run reports of two runs step by step')
+    compare.add_argument('report_a')
+    compare.add_argument('report_b')
+    build_index = commands.add_parser('build-expected-index', help='Compute expected variants of the whole exome once, so runs can look them up')
+    build_index.add_argument('--contigs', nargs='+', help='Contigs to index (all but MT by default); finished contigs are kept between builds')
+    build_index.add_argument('--model', help='Model to compute expected variants with; runs must use the same model to read the index', default='standard')
+    build_index.add_argument('--trimer', help='Use trimer (--no-trimer: heptamer) mutation contexts; runs must match', action=argparse.BooleanOptionalAction, default=True)
+    build_index.add_argument('--overwrite', help='Rebuild every contig', action='store_true')
+    build_index.add_argument('-q','--quiet',help='Run in quiet mode',action='store_true',default=False)
+    serve = commands.add_parser('serve', help='Answer constraint queries for genes over HTTP from a summary held in memory')
+    serve.add_argument('summary', help='Summary written by the summarise task (constraint_final.csv.gz or .parquet)')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.add_argument('--cache-size', type=int, default=4096, help='Number of gene lookups kept in the cache')
+    serve.add_argument('-q','--quiet',help='Do not log requests',action='store_true',default=False)
+    return parser
+
+
+def check_args(args) -> List[str]:
+    return options.check_options(
+        args.tasks, backend=args.backend, joint=args.joint, packed=args.packed, controls=args.controls,
+        max_concurrent_jobs=args.max_concurrent_jobs, output_format=args.output_format, partition_by=args.partition_by,
+        incremental=args.incremental, expected_index=args.expected_index, ci_engine=args.ci_engine, cache_max_bytes=int(args.cache_max_gb * 1e9) if args.cache_max_gb is not None else None)
+
+
+def run(args):
+    '''Controls whether to setup in test mode or not, and generates a run ID if not in test mode'''
+    import hail as hl
+    from .run import setup_paths, run_tasks
+
+    # Initialise Hail, setting output
+    if options.needs_hail(args.tasks, args.backend):
+        hl.init(
+            log='hail_logs/log.txt',
+            quiet=args.quiet
+            )
+
+    # Setup paths
+    if args.test:
+        run_ID = 'test'
+        print('Running in test mode: Relax, sit back and enjoy the ride')
+    else:
+        run_ID = f'{args.dataset}_{args.model}'
+        print(f'Running without test mode active: THIS IS NOT A DRILL. \n Run ID: {run_ID}')
+
+    paths = setup_paths(run_ID)
+
+    # Run chosen tasks
+    run_tasks(
+        args.tasks,
+        paths = paths,
+        dataset = args.dataset,
+        model = args.model,
+        annotations = args.annotations,
+        test = args.test,
+        controls = args.controls,
+        force = args.overwrite,
+        cache_resources = not args.no_cache,
+        cache_max_bytes = int(args.cache_max_gb * 1e9) if args.cache_max_gb else None,
+        cache_panel_partitions = args.cache_panel_partitions,
+        max_concurrent_jobs = args.max_concurrent_jobs,
+        joint = args.joint,
+        packed = args.packed,
+        backend = args.backend,
+        output_format = args.output_format,
+        partition_by = args.partition_by,
+        incremental = args.incremental,
+        expected_index_dir = paths['expected_index_dir'] if args.expected_index else None,
+        ci_engine = args.ci_engine
+        )
+
+
+def build_expected_index(args):
+    '''Build (or resume building) the expected index at the path runs read it from'''
+    import hail as hl
+    from .run import setup_paths
+    from .expected_index import build_expected_index, INDEX_CONTIGS
+    from .utils import telemetry
+
+    hl.init(log='hail_logs/log.txt', quiet=args.quiet)
+    paths = setup_paths(EXPECTED_INDEX_RUN_ID)
+    telemetry.start_run(f'{paths["expected_index_dir"]}/build_report.json', params=dict(contigs=args.contigs, model=args.model, trimer=args.trimer))
+    manifest = build_expected_index(paths, paths['expected_index_dir'], model=args.model, trimer=args.trimer,
+                                    contigs=args.contigs or INDEX_CONTIGS, overwrite=args.overwrite)
+    telemetry.end_run()
+    print(f'Expected index of {manifest["genes"]} genes written to {paths["expected_index_dir"]}')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    argv = sys.argv[1:] if argv is None else list(argv)
+    if argv and argv[0] not in COMMANDS and argv[0] not in ('-h', '--help'):
+        argv = ['run'] + argv
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    if args.command == 'compare-reports':
+        from .utils import telemetry
+        print(telemetry.compare_reports(args.report_a, args.report_b).to_string())
+        return 0
+    if args.command == 'build-expected-index':
+        build_expected_index(args)
+        return 0
+    if args.command == 'serve':
+        from .service import serve
+        serve(args.summary, host=args.host, port=args.port, cache_size=args.cache_size, quiet=args.quiet)
+        return 0
+
+    problems = check_args(args)
+    if args.command == 'validate':
+        for problem in problems:
+            print(problem, file=sys.stderr)
+        print('Invalid options' if problems else 'Options are valid')
+        return 1 if problems else 0
+    if problems:
+        parser.error('\n'.join(problems))
+    run(args)
+    return 0
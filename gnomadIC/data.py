@@ -6,7 +6,7 @@ from numpy.lib import utils
 import hail as hl
 import pandas as pd
 from typing import Dict, List, Optional, Set, Tuple, Any
-from .utils import utils
+from .utils import utils, intervals, execution, telemetry
 
 def get_mutation_annotations(model):    
     # Get custom annotations for mutations from file
@@ -18,16 +18,18 @@ def get_mutation_annotations(model):
         raise NotImplementedError('Model not implemented!')
 
 
-def get_table(path, intervals, model, additional_fields = [], trimer=True):
-   # Path to full exome table
-    full_ht = hl.read_table(path)
+def get_table(path, read_plan, model, additional_fields = [], trimer=True, packed=False):
+    # Read only the partitions overlapping the panel's gene intervals
+    ht = read_plan.read(path)
+    return process_table(ht, model, additional_fields=additional_fields, trimer=trimer, packed=packed)
+
+
+def process_table(ht, model, additional_fields = [], trimer=True, packed=False):
     # Select relevant fields to avoid getting too much data
     fields = ['vep','context', 'methylation','coverage'] + additional_fields
-    full_ht = full_ht.select(*fields)
-    # Filter by gene
-    ht = hl.filter_intervals(full_ht, intervals)
+    ht = ht.select(*fields)
     # Prepare exomes
-    ht = utils.prepare_ht(ht, trimer=trimer)
+    ht = utils.prepare_ht(ht, trimer=trimer, packed=packed)
     # Extract relevant parts of VEP struct and set as groupings for annotation join
     ht = utils.add_most_severe_csq_to_tc_within_ht(ht)
     ht = ht.transmute(transcript_consequences=ht.vep.transcript_consequences) 
@@ -37,8 +39,9 @@ def get_table(path, intervals, model, additional_fields = [], trimer=True):
     ht = ht.transmute(coverage=ht.exome_coverage)
 
     # Select fields for modelling
-    final_fields = ['ref', 'alt', 'context', 'methylation_level', 'coverage'] + \
-        groupings + additional_fields
+    # (packed tables carry context, ref, alt and methylation level as a single mutation_code)
+    mutation_fields = ['mutation_code'] if packed else ['ref', 'alt', 'context', 'methylation_level']
+    final_fields = mutation_fields + ['coverage'] + groupings + additional_fields
     ht = ht.select(*final_fields)
     return ht, groupings
 
@@ -57,32 +60,66 @@ def filter_exomes(exome_ht, af_cutoff=0.001, dataset: str = 'gnomad',
     return exome_ht
 
 
-def get_data(paths, gene_intervals, model, overwrite=True, trimer=True):
+def get_joint_table(paths, read_plan, model, trimer=True, dataset='gnomad', packed=False):
+    '''
+    Context table with an `observed` flag for possible variants found in the filtered exomes
+    The filtered exome rows are key-joined onto the context by (locus, alleles) before VEP processing and
+    the transcript explode, so groupings are computed once (from the context VEP annotations)
+    '''
+    exome_ht = read_plan.read(paths['exomes_path'])
+    exome_ht = exome_ht.select('freq', pass_filters=hl.len(exome_ht.filters) == 0, coverage=exome_ht.coverage.exomes.median)
+    exome_ht = filter_exomes(exome_ht, dataset=dataset).select()
+
+    context_ht = read_plan.read(paths['context_path'])
+    context_ht = context_ht.annotate(observed=hl.is_defined(exome_ht[context_ht.key]))
+    return process_table(context_ht, model, additional_fields=['observed'], trimer=trimer, packed=packed)
+
+
+def get_data(paths, read_plan, model, overwrite=True, trimer=True, dataset='gnomad',
+             max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS, joint=False, packed=False, context=True):
     '''
     This is the new master function for loading all necessary data for constraint analysis on the given genes
     Paths are passed in from the main program. 
     The exomes and context data should always be downloaded as new gene intervals are passed in. 
     The mutation rate by methylation and proportion observed by coverage tables are stored locally.
     They should be downloaded if not present but the control flow to do this isn't yet implemented 
+    read_plan is an intervals.ReadPlan (or a list of gene intervals) shared by the context and exome reads
+    The context and exome extracts are independent and are written concurrently (up to max_concurrent_jobs)
+    joint writes a single context extract flagged with observed variants instead (see get_joint_table)
+    packed stores each variant's context, ref, alt and methylation level as one integer (see utils.prepare_ht)
+    context=False only extracts the exomes, for models that take expected variants from an expected index
     '''
-    # Prepare context table by filtering on gene intervals and selecting correct VEP annotations
-    context_ht, groupings = get_table(paths['context_path'], gene_intervals, model, trimer=trimer)
+    if not isinstance(read_plan, intervals.ReadPlan):
+        read_plan = intervals.ReadPlan(read_plan)
+    if joint:
+        joint_ht, groupings = get_joint_table(paths, read_plan, model, trimer=trimer, dataset=dataset, packed=packed)
+        with telemetry.step('extract_joint'):
+            joint_ht.write(paths['joint_local_path'], overwrite=overwrite)
+            telemetry.record_output(paths['joint_local_path'])
+        return {'joint_ht': hl.read_table(paths['joint_local_path']), 'groupings': groupings}
 
     # Get exomes data by filtering on gene intervals & selecting correct VEP annotations
-    exome_ht, _ = get_table(paths['exomes_path'], gene_intervals, model, additional_fields= ['freq', 'filters'], trimer=trimer)
+    exome_ht, groupings = get_table(paths['exomes_path'], read_plan, model, additional_fields= ['freq', 'filters'], trimer=trimer, packed=packed)
 
     # Do extra filtering of exomes
     exome_ht = exome_ht.annotate(pass_filters = hl.len(exome_ht.filters)==0)
-    exome_ht = filter_exomes(exome_ht)  
+    exome_ht = filter_exomes(exome_ht, dataset=dataset)
 
     # Write to file
-    exome_ht.write(paths['exomes_local_path'], overwrite=overwrite)
-    context_ht.write(paths['context_local_path'], overwrite=overwrite)
-
+    def write(name, ht, path):
+        with telemetry.step(f'extract_{name}'):
+            ht.write(path, overwrite=overwrite)
+            telemetry.record_output(path)
+    jobs = {'exomes': lambda: write('exomes', exome_ht, paths['exomes_local_path'])}
     data = {
         'exome_ht': exome_ht,
-        'context_ht':context_ht,
         'groupings':groupings
     }
+    if context:
+        # Prepare context table by filtering on gene intervals and selecting correct VEP annotations
+        context_ht, _ = get_table(paths['context_path'], read_plan, model, trimer=trimer, packed=packed)
+        jobs['context'] = lambda: write('context', context_ht, paths['context_local_path'])
+        data['context_ht'] = context_ht
+    execution.run_concurrently(jobs, max_workers=max_concurrent_jobs)
 
     return data
\ No newline at end of file
@@ -0,0 +1,197 @@
+'''
+Genome-wide index of expected variants
+
+Expected variant counts depend only on the context table, the mutation rate table and the coverage models, so
+they can be computed once for the whole exome and looked up by gene instead of being recomputed from the
+context rows of each panel. build_expected_index runs get_expected_variants one contig at a time, recording
+finished chunks in a manifest so an interrupted build resumes, then writes the chunks as one table keyed by
+gene (INDEX_KEY) with the row range of each gene:
+
+    index_dir/manifest.json
+    index_dir/chunks/<contig>.ht
+    index_dir/expected.ht
+    index_dir/genes.json
+'''
+import json
+import os
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import hail as hl
+
+from .data import process_table
+from .model import GROUPING, load_models, tag_regions, get_expected_variants, get_proportion_observed
+from .utils import intervals, model_store, stages, telemetry, execution
+
+# Index rows are ordered by gene first, so the rows of a gene are contiguous and a lookup reads only its partitions
+INDEX_KEY = ['gene', 'transcript', 'annotation', 'modifier', 'canonical', 'region']
+# Mitochondrial variants fall in no region, so MT is left out
+INDEX_CONTIGS = intervals.CONTIGS_GRCH37[:24]
+
+
+def index_paths(index_dir: str) -> Dict[str, str]:
+    return dict(
+        manifest=f'{index_dir}/manifest.json',
+        chunks_dir=f'{index_dir}/chunks',
+        expected=f'{index_dir}/expected.ht',
+        genes=f'{index_dir}/genes.json'
+    )
+
+
+def index_key(paths, model, trimer=True) -> Dict[str, str]:
+    '''What the index depends on: the model, the source tables and the code computing expected variants'''
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    code = [os.path.join(package_dir, x) for x in ('data.py', 'model.py', 'utils/utils.py', 'utils/vep.py')]
+    return {
+        'model': model,
+        'trimer': trimer,
+        'tables': {name: model_store.table_fingerprint(paths[name])
+                   for name in ('context_path', 'mutation_rate_path', 'po_coverage_path')},
+        'code': stages.code_version(code)
+    }
+
+
+def read_manifest(index_dir: str) -> Dict:
+    path = index_paths(index_dir)['manifest']
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_index(paths, index_dir, model, trimer=True):
+    '''Raise ValueError unless index_dir holds a complete index built with the sources, model, trimer and code of this run'''
+    manifest = read_manifest(index_dir)
+    if not manifest.get('complete'):
+        raise ValueError(f'No complete expected index in {index_dir}: run build_expected_index first')
+    key = index_key(paths, model, trimer=trimer)
+    differ = [x for x in key if manifest['key'].get(x) != key[x]]
+    if differ:
+        raise ValueError(f'Expected index in {index_dir} was built with a different {", ".join(differ)} than this run '
+                         f'(model {model}, trimer {trimer}): rebuild it with build_expected_index')
+
+
+def write_manifest(index_dir: str, manifest: Dict):
+    # Write then rename so an interrupted build never leaves a truncated manifest
+    path = index_paths(index_dir)['manifest']
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+@telemetry.traced()
+def build_expected_index(paths, index_dir, model='standard', trimer=True, contigs: Sequence[str] = INDEX_CONTIGS,
+                         overwrite=False) -> Dict:
+    '''
+    Compute expected variants of every transcript on `contigs` and index them by gene
+    Each contig is a chunk written to index_dir/chunks and recorded in the manifest once complete; chunks built
+    with the same sources, model and code are reused, so rerunning an interrupted build carries on where it
+    stopped. overwrite rebuilds every chunk. Returns the manifest
+    '''
+    files = index_paths(index_dir)
+    os.makedirs(files['chunks_dir'], exist_ok=True)
+    key = index_key(paths, model, trimer=trimer)
+    manifest = read_manifest(index_dir)
+    if overwrite or manifest.get('key') != key:
+        if manifest:
+            print('Expected index was built from other sources, model or code: rebuilding every chunk')
+        manifest = {'key': key, 'chunks': {}}
+    manifest['complete'] = False
+    write_manifest(index_dir, manifest)
+
+    models = None
+    grouping = GROUPING + ['region']
+    for contig in contigs:
+        if contig in manifest['chunks']:
+            print(f'Skipping chunk {contig}: already built')
+            continue
+        if models is None:
+            models = load_models(paths, trimer=trimer)
+        chunk_path = f'{files["chunks_dir"]}/{contig}.ht'
+        with telemetry.step(f'chunk_{contig}'):
+            start = time.time()
+            context_ht = hl.filter_intervals(hl.read_table(paths['context_path']),
+                                             [hl.parse_locus_interval(contig, reference_genome='GRCh37')])
+            context_ht, _ = process_table(context_ht, model, trimer=trimer)
+            chunk_ht = get_expected_variants(tag_regions(context_ht), models, grouping, chunk_path)
+            manifest['chunks'][contig] = {
+                'path': chunk_path,
+                'rows': chunk_ht.count(),
+                'duration_s': round(time.time() - start, 1),
+                'completed': time.strftime('%Y-%m-%d %H:%M:%S')
+            }
+        write_manifest(index_dir, manifest)
+        print(f'Built chunk {contig}: {manifest["chunks"][contig]["rows"]} rows')
+
+    # Merge the chunks ordered by gene, and record the rows of each gene
+    with telemetry.step('merge_chunks'):
+        chunks = [hl.read_table(manifest['chunks'][x]['path']) for x in contigs]
+        expected_ht = chunks[0].union(*chunks[1:]).key_by(*INDEX_KEY)
+        expected_ht.write(files['expected'], overwrite=True)
+        telemetry.record_output(files['expected'])
+        expected_ht = hl.read_table(files['expected']).add_index('_row')
+        ranges = expected_ht.aggregate(hl.agg.group_by(
+            expected_ht.gene, hl.struct(start=hl.agg.min(expected_ht._row), end=hl.agg.max(expected_ht._row) + 1)))
+    with open(files['genes'], 'w') as f:
+        json.dump({gene: [x.start, x.end] for gene, x in ranges.items() if gene is not None}, f)
+    manifest.update(complete=True, contigs=list(contigs), genes=len(ranges), completed=time.strftime('%Y-%m-%d %H:%M:%S'))
+    write_manifest(index_dir, manifest)
+    return manifest
+
+
+def load_gene_index(index_dir: str) -> Dict[str, Tuple[int, int]]:
+    '''Row range [start, end) of each gene in the index'''
+    manifest = read_manifest(index_dir)
+    if not manifest.get('complete'):
+        raise ValueError(f'No complete expected index in {index_dir}: run build_expected_index first')
+    with open(index_paths(index_dir)['genes']) as f:
+        return {gene: tuple(rows) for gene, rows in json.load(f).items()}
+
+
+def lookup_expected(index_dir: str, genes: Sequence[str], grouping: Optional[List[str]] = None) -> hl.Table:
+    '''
+    Expected variant rows of `genes` from the index, keyed by grouping (GROUPING + region by default) as
+    get_expected_variants returns them
+    Only the index partitions holding the genes are read: the index is keyed by gene first, so filter_intervals
+    prunes partitions from the key bounds stored with the table. Selecting the genes' row ranges instead would
+    need add_index, which counts the rows of every preceding partition; the ranges serve to report missing genes
+    and rows looked up.
+    '''
+    gene_index = load_gene_index(index_dir)
+    genes = list(dict.fromkeys(genes))
+    missing = [x for x in genes if x not in gene_index]
+    if missing:
+        print(f'No expected variants indexed for {", ".join(missing)}')
+    found = [x for x in genes if x in gene_index]
+    telemetry.record(genes=len(found), rows=sum(gene_index[x][1] - gene_index[x][0] for x in found))
+    expected_ht = hl.read_table(index_paths(index_dir)['expected'])
+    expected_ht = hl.filter_intervals(expected_ht, [
+        hl.Interval(hl.Struct(gene=x), hl.Struct(gene=x), includes_start=True, includes_end=True) for x in found])
+    return expected_ht.key_by(*(grouping or GROUPING + ['region']))
+
+
+def model(paths, data, model, index_dir, genes, trimer=True, max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS,
+          joint=False, merge='copartitioned'):
+    '''
+    Model stage taking expected variants of `genes` from the index in index_dir rather than the context extract,
+    so only the exomes need extracting (data.get_data(context=False))
+    Observed variants are restricted to `genes` too, so overlapping genes do not get partial counts
+    Raises ValueError if the index was built from other sources, model, trimer or code than this run
+    '''
+    if joint:
+        raise ValueError('Joint mode counts expected variants from the context extract and cannot use an expected index')
+    check_index(paths, index_dir, model, trimer=trimer)
+    if 'exome_ht' not in data:
+        print('Loading data...')
+        data = {'exome_ht': hl.read_table(paths['exomes_local_path'])}
+        telemetry.record_input(paths['exomes_local_path'])
+    grouping = GROUPING + ['region']
+    exome_ht = tag_regions(data['exome_ht'])
+    exome_ht = exome_ht.filter(hl.literal(set(genes)).contains(exome_ht.gene))
+    with telemetry.step('lookup_expected'):
+        expected_ht = lookup_expected(index_dir, genes, grouping)
+    data['prop_observed_ht'] = get_proportion_observed(exome_ht, expected_ht, grouping, paths['po_output_path'],
+                                                       overwrite=True, merge=merge)
+    data['grouping'] = grouping
+    return data
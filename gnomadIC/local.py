@@ -0,0 +1,354 @@
+'''
+In-process pandas/NumPy backend for small gene panels
+
+Once the panel's rows are extracted, a few dozen genes are only a few thousand rows, and Spark job overhead
+dominates the model and summarise stages. This backend runs them on pandas frames with the same formulas
+as the Hail path:
+- strand collapsing, variant types and methylation levels (utils.prepare_ht);
+- mutation rates from the mutation rate index (utils.annotate_with_mu_index);
+- the expected variant model (utils.annotate_expected_mutations);
+- observed and expected counts (model.get_expected_variants, model.get_proportion_observed);
+- the summary and its confidence intervals (summarise.summarise_prop_observed with the NumPy engine).
+
+Hail is still used for the pruned read and VEP parsing in the download stage, and for fitting models
+that are not in the model store yet. Frames are written next to the Hail extracts as pickles.
+'''
+import functools
+import os
+
+import hail as hl
+import numpy as np
+import pandas as pd
+from typing import Dict, List
+
+from .utils import utils, intervals, execution, model_store, telemetry, export
+from .model import GROUPING, load_models as load_hail_models, mutation_rate_index_path
+
+# GRCh37 pseudoautosomal regions (1-based, inclusive), as used by hl.Locus.in_x_par and in_y_par
+PAR_GRCH37 = (('X', 60001, 2699520), ('X', 154931044, 155260560), ('Y', 10001, 2649520), ('Y', 59034050, 59373566))
+SUMMARY_GROUPS = ['gene', 'transcript', 'canonical', 'variant_class']
+SUMMARY_VALUES = ['obs', 'exp', 'oe', 'adj_mu', 'raw_mu', 'poss', 'oe_lower', 'oe_upper', 'log_P_H0']
+# Below this log_P_H0 the grid search CI saturates at float64 resolution (see utils.oe_confidence_interval_np)
+LOG_P_H0_SATURATION = -30
+
+
+def plain_frame(df: pd.DataFrame) -> pd.DataFrame:
+    '''Convert pandas extension columns (as returned by newer Hail's to_pandas) to float64 or object with None'''
+    df = df.copy()
+    for column in df.columns:
+        if not pd.api.types.is_extension_array_dtype(df[column]):
+            continue
+        if pd.api.types.is_numeric_dtype(df[column]) and not pd.api.types.is_bool_dtype(df[column]):
+            df[column] = df[column].to_numpy(dtype=np.float64, na_value=np.nan)
+        else:
+            df[column] = df[column].astype(object).where(df[column].notna(), None)
+    return df
+
+
+# Extraction (Hail)
+
+def extract_table(path, read_plan, model, exomes=False, dataset='gnomad') -> pd.DataFrame:
+    '''
+    Rows of a context or exome table in the panel, one per variant and transcript, collected to pandas
+    VEP consequences are exploded into the constraint groupings in Hail, as in data.process_table; exomes
+    also carry the allele count and frequency of `dataset` and whether they pass filters
+    '''
+    ht = read_plan.read(path)
+    ht = ht.select('vep', 'context', 'methylation', 'coverage', *(['freq', 'filters'] if exomes else []))
+    ht = utils.add_most_severe_csq_to_tc_within_ht(ht)
+    ht = ht.transmute(transcript_consequences=ht.vep.transcript_consequences)
+    ht = ht.explode(ht.transcript_consequences)
+    ht, _ = utils.annotate_constraint_groupings(ht, model)
+    ht = ht.key_by()
+    fields = dict(
+        contig=ht.locus.contig,
+        position=ht.locus.position,
+        ref_allele=ht.alleles[0],
+        alt_allele=ht.alleles[1],
+        context=ht.context,
+        methylation=ht.methylation.MEAN,
+        coverage=ht.coverage.exomes.median,
+        **{k: ht[k] for k in GROUPING}
+    )
+    if exomes:
+        freq_index = hl.eval(ht.freq_index_dict[dataset])
+        fields.update(ac=ht.freq[freq_index].AC, af=ht.freq[freq_index].AF, pass_filters=hl.len(ht.filters) == 0)
+    return plain_frame(ht.select(**fields).to_pandas())
+
+
+# Variant preparation
+
+@functools.lru_cache()
+def strand_collapse_frame(trimer: bool = False) -> pd.DataFrame:
+    '''utils.strand_collapse_table as a frame indexed by context + ref + alt'''
+    table = utils.strand_collapse_table(trimer)
+    return pd.DataFrame.from_dict({k: (v.context, v.ref, v.alt) for k, v in table.items()},
+                                  orient='index', columns=['context', 'ref', 'alt'])
+
+
+def variant_types(df: pd.DataFrame) -> Dict[str, np.ndarray]:
+    '''cpg and transition of each row (see utils.annotate_variant_types)'''
+    mid_index = len(df['context'].iloc[0]) // 2 if len(df) else 1
+    ref, alt, context = df['ref'], df['alt'], df['context']
+    transition = (((ref == 'A') & (alt == 'G')) | ((ref == 'G') & (alt == 'A')) |
+                  ((ref == 'T') & (alt == 'C')) | ((ref == 'C') & (alt == 'T')))
+    cpg = (((ref == 'G') & (alt == 'A') & (context.str[mid_index - 1] == 'C')) |
+           ((ref == 'C') & (alt == 'T') & (context.str[mid_index + 1] == 'G')))
+    return {'cpg': cpg.to_numpy(dtype=bool), 'transition': transition.to_numpy(dtype=bool)}
+
+
+def prepare_frame(df: pd.DataFrame, trimer: bool = False) -> pd.DataFrame:
+    '''
+    Local version of utils.prepare_ht: strand-collapses contexts (trimmed to trimers if trimer) with
+    strand_collapse_table, dropping rows without an entry, and adds methylation_level
+    '''
+    context = df['context']
+    if trimer:
+        # As utils.strand_collapse_key: heptamers are trimmed, so only the trimer must be ACGT
+        context = context.where(context.str.len() != 7, context.str[2:5])
+    collapsed = strand_collapse_frame(trimer).reindex(context + df['ref_allele'] + df['alt_allele'])
+    keep = collapsed['context'].notna().to_numpy()
+    df = df[keep].drop(columns=['ref_allele', 'alt_allele']).assign(
+        context=collapsed['context'].to_numpy()[keep],
+        ref=collapsed['ref'].to_numpy()[keep],
+        alt=collapsed['alt'].to_numpy()[keep]
+    )
+    cpg = variant_types(df)['cpg']
+    methylation = df['methylation'].to_numpy(dtype=np.float64)
+    df['methylation_level'] = np.select([cpg & (methylation > 0.6), cpg & (methylation > 0.2)], [2, 1], 0)
+    return df.drop(columns='methylation').reset_index(drop=True)
+
+
+def filter_exomes(df: pd.DataFrame, af_cutoff: float = 0.001, impose_high_af_cutoff_upfront: bool = True) -> pd.DataFrame:
+    '''Local version of data.filter_exomes'''
+    keep = (df['ac'] > 0) & df['pass_filters'].astype(bool) & (df['coverage'] > 0)
+    if impose_high_af_cutoff_upfront:
+        keep &= df['af'] <= af_cutoff
+    return df[keep].drop(columns=['ac', 'af', 'pass_filters']).reset_index(drop=True)
+
+
+def tag_regions(df: pd.DataFrame) -> pd.DataFrame:
+    '''Local version of model.tag_regions'''
+    contig = df['contig'].astype(str)
+    position = df['position'].to_numpy()
+    in_par = np.zeros(len(df), dtype=bool)
+    for par_contig, start, end in PAR_GRCH37:
+        in_par |= (contig == par_contig).to_numpy() & (position >= start) & (position <= end)
+    region = np.select(
+        [~contig.isin(['X', 'Y', 'MT']).to_numpy() | in_par, (contig == 'X').to_numpy(), (contig == 'Y').to_numpy()],
+        ['auto', 'x', 'y'],
+        None
+    )
+    df = df.assign(region=region)
+    return df[df['region'].notna()]
+
+
+# Modelling
+
+def mutation_codes(df: pd.DataFrame) -> np.ndarray:
+    '''utils.mutation_code of every row'''
+    context_length = len(df['context'].iloc[0]) if len(df) else 0
+    code = np.zeros(len(df), dtype=np.int64)
+    for bases in [df['context'].str[i] for i in range(context_length)] + [df['alt']]:
+        code = code * 4 + bases.map(utils.BASE_CODES).to_numpy(dtype=np.int64)
+    return code * 4 + df['methylation_level'].to_numpy(dtype=np.int64)
+
+
+def load_models(paths, trimer=True):
+    '''
+    Mutation rate index and coverage models from the local caches written by model.load_models
+    If either is missing, model.load_models (Hail) builds and caches them for later runs.
+    '''
+    index_path = mutation_rate_index_path(paths, trimer)
+    model_params = dict(trimers=trimer, weighted=False, half_cutoff=False)
+    fingerprint = model_store.table_fingerprint(paths['po_coverage_path'])
+    stored_models = model_store.load_coverage_models(paths['coverage_models_local_dir'], model_params, fingerprint)
+    if stored_models is None or not os.path.isfile(index_path):
+        print('Models not cached yet, building them with Hail')
+        models = load_hail_models(paths, trimer=trimer)
+        return {k: models[k] for k in ('mutation_rate_index', 'coverage_model', 'plateau_models')}
+    coverage_model, plateau_models = stored_models
+    return {'mutation_rate_index': np.load(index_path), 'coverage_model': coverage_model, 'plateau_models': plateau_models}
+
+
+def annotate_expected_mutations(df: pd.DataFrame, models, half_cutoff=False) -> pd.DataFrame:
+    '''Local version of utils.annotate_expected_mutations for one possible variant per row'''
+    mu_snp = models['mutation_rate_index'][mutation_codes(df)]
+    if np.isnan(mu_snp).any():
+        missing = df[np.isnan(mu_snp)].iloc[0]
+        raise ValueError(f'Missing mu for {missing["context"]} {missing["ref"]}>{missing["alt"]} '
+                         f'(methylation level {missing["methylation_level"]})')
+    cpg = variant_types(df)['cpg']
+    plateau = models['plateau_models'].total
+    intercept = np.where(cpg, plateau[True][0], plateau[False][0])
+    slope = np.where(cpg, plateau[True][1], plateau[False][1])
+
+    coverage_model = models['coverage_model']
+    cov_cutoff = (utils.HIGH_COVERAGE_CUTOFF / half_cutoff) if half_cutoff else utils.HIGH_COVERAGE_CUTOFF
+    coverage = df['coverage'].to_numpy(dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        coverage_correction = np.where(
+            coverage == 0, 0.0,
+            np.where(coverage >= cov_cutoff, 1.0, coverage_model[1] * np.log10(coverage) + coverage_model[0]))
+    coverage_correction[np.isnan(coverage)] = np.nan
+
+    adjusted_mutation_rate = mu_snp * slope + intercept
+    return df.assign(
+        possible_variants=1,
+        adjusted_mutation_rate=adjusted_mutation_rate,
+        expected_variants=adjusted_mutation_rate * coverage_correction,
+        mu=mu_snp * coverage_correction
+    )
+
+
+def get_expected_variants(df: pd.DataFrame, models, grouping: List[str]) -> pd.DataFrame:
+    '''Local version of model.get_expected_variants: expected, possible and mutation rate sums by grouping'''
+    df = annotate_expected_mutations(df, models)
+    df = df.rename(columns={'mu': 'raw_mutation_rate'})
+    fields = ['expected_variants', 'possible_variants', 'adjusted_mutation_rate', 'raw_mutation_rate']
+    return df.groupby(grouping, dropna=False)[fields].sum().reset_index()
+
+
+def get_proportion_observed(exome_df: pd.DataFrame, expected_df: pd.DataFrame, grouping: List[str]) -> pd.DataFrame:
+    '''
+    Local version of model.get_proportion_observed: observed counts by grouping merged with the expected counts
+    Groups missing from one side get 0 for that side's counts, as with merge='copartitioned'.
+    '''
+    observed_df = exome_df.groupby(grouping, dropna=False).size().rename('observed_variants').reset_index()
+    po_df = pd.concat([observed_df, expected_df], ignore_index=True)
+    po_df = po_df.groupby(grouping, dropna=False).sum(min_count=0).reset_index()
+    po_df['observed_variants'] = po_df['observed_variants'].astype(np.int64)
+    po_df['possible_variants'] = po_df['possible_variants'].astype(np.int64)
+    return po_df
+
+
+# Summary
+
+def summarise_prop_observed(po_df: pd.DataFrame, summary_path, output_format='csv', partition_by=None) -> pd.DataFrame:
+    '''Local version of summarise.summarise_prop_observed (with ci_engine='numpy'), writing the same CSV or Parquet dataset'''
+    annotation, modifier = po_df['annotation'], po_df['modifier']
+    classic_lof = annotation.isin(['stop_gained', 'splice_donor_variant', 'splice_acceptor_variant']).to_numpy()
+    missense = (annotation == 'missense_variant').to_numpy(dtype=bool)
+    variant_class = np.select(
+        [
+            classic_lof & (modifier == 'HC').to_numpy(dtype=bool),
+            classic_lof & (modifier == 'LC').to_numpy(dtype=bool),
+            missense & (modifier == 'probably_damaging').to_numpy(dtype=bool),
+            missense & (modifier != 'probably_damaging').to_numpy(dtype=bool),
+            (annotation == 'synonymous_variant').to_numpy(dtype=bool)
+        ],
+        ['lof_hc', 'lof_lc', 'mis_pphen', 'mis_non_pphen', 'syn'],
+        'non-coding variants'
+    ).astype(object)
+    # As in Hail, rows without an annotation have no class
+    variant_class[annotation.isna().to_numpy()] = None
+    po_df = po_df.assign(variant_class=variant_class)
+
+    constraint_df = po_df.groupby(SUMMARY_GROUPS, dropna=False).agg(
+        obs=('observed_variants', 'sum'),
+        exp=('expected_variants', 'sum'),
+        adj_mu=('adjusted_mutation_rate', 'sum'),
+        raw_mu=('raw_mutation_rate', 'sum'),
+        poss=('possible_variants', 'sum')
+    ).reset_index()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        constraint_df.insert(constraint_df.columns.get_loc('exp') + 1, 'oe', constraint_df['obs'] / constraint_df['exp'])
+    ci = utils.oe_confidence_interval_np(constraint_df['obs'].to_numpy(), constraint_df['exp'].to_numpy())
+    constraint_df = constraint_df.assign(oe_lower=ci['lower'], oe_upper=ci['upper'], log_P_H0=ci['log_P_H0'])
+    telemetry.record(rows_out=len(constraint_df))
+    if output_format == 'parquet':
+        export.export_frame_parquet(constraint_df, summary_path.replace('.ht', '.parquet'), partition_by=partition_by)
+        return constraint_df
+    if output_format != 'csv':
+        raise ValueError(f'Unknown output format {output_format}, expected one of {", ".join(export.OUTPUT_FORMATS)}')
+    constraint_df.to_csv(summary_path.replace('.ht', '.csv.gz'), compression='gzip')
+    telemetry.record_output(summary_path.replace('.ht', '.csv.gz'), count_rows=False)
+    return constraint_df
+
+
+def compare_summaries(expected: pd.DataFrame, actual: pd.DataFrame, rtol: float = 1e-9, ci_atol: float = 1e-3,
+                      log_p_rtol: float = 2e-3) -> pd.DataFrame:
+    '''
+    Rows where two summaries (e.g. from the Hail and local backends) differ, empty if they agree
+    Values must agree to rtol; CI bounds, which are snapped to a grid, to within ci_atol (one grid step).
+    log_P_H0, which the grid search only approximates, must agree to log_p_rtol plus ci_atol, or both be below
+    LOG_P_H0_SATURATION, so summaries with grid search and NumPy CIs (ci_engine 'hail' and 'numpy') compare equal.
+    Rows present in only one summary are returned with _merge set to left_only or right_only.
+    '''
+    expected, actual = plain_frame(expected), plain_frame(actual)
+    merged = expected[SUMMARY_GROUPS + SUMMARY_VALUES].merge(
+        actual[SUMMARY_GROUPS + SUMMARY_VALUES], on=SUMMARY_GROUPS, how='outer',
+        suffixes=('_expected', '_actual'), indicator=True)
+    mismatched = np.array(merged['_merge'] != 'both')
+    for column in SUMMARY_VALUES:
+        a = merged[f'{column}_expected'].to_numpy(dtype=np.float64, na_value=np.nan)
+        b = merged[f'{column}_actual'].to_numpy(dtype=np.float64, na_value=np.nan)
+        if column in ('oe_lower', 'oe_upper'):
+            mismatched |= ~np.isclose(a, b, rtol=0, atol=ci_atol + 1e-12, equal_nan=True)
+        elif column == 'log_P_H0':
+            saturated = (a < LOG_P_H0_SATURATION) & (b < LOG_P_H0_SATURATION)
+            mismatched |= ~(saturated | np.isclose(a, b, rtol=log_p_rtol, atol=ci_atol + 1e-12, equal_nan=True))
+        else:
+            mismatched |= ~np.isclose(a, b, rtol=rtol, atol=0, equal_nan=True)
+    return merged[mismatched]
+
+
+# Stages (same signatures as data.get_data, model.model and summarise.summarise)
+
+def get_data(paths, read_plan, model, dataset='gnomad', trimer=True, max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS,
+             joint=False, packed=False):
+    '''
+    Extract the panel's context and exome rows (see extract_table), prepare them locally and write them as frames
+    The exome frame is filtered as in data.filter_exomes
+    '''
+    if joint or packed:
+        raise ValueError('The local backend supports neither joint nor packed mode')
+    if not isinstance(read_plan, intervals.ReadPlan):
+        read_plan = intervals.ReadPlan(read_plan)
+
+    def extract(name, path, frame_path, exomes):
+        with telemetry.step(f'extract_{name}'):
+            df = prepare_frame(extract_table(path, read_plan, model, exomes=exomes, dataset=dataset), trimer=trimer)
+            if exomes:
+                df = filter_exomes(df)
+            df.to_pickle(frame_path)
+            telemetry.record(rows_out=len(df))
+            telemetry.record_output(frame_path, count_rows=False)
+        return df
+    frames = execution.run_concurrently({
+        'exomes': lambda: extract('exomes', paths['exomes_path'], paths['exomes_local_frame_path'], True),
+        'context': lambda: extract('context', paths['context_path'], paths['context_local_frame_path'], False)
+    }, max_workers=max_concurrent_jobs)
+    return {'exome_df': frames['exomes'], 'context_df': frames['context']}
+
+
+def model(paths, data, model, trimer=True, max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS, joint=False):
+    '''Count possible, expected and observed variants by grouping and region in pandas (see model.model)'''
+    if joint:
+        raise ValueError('The local backend does not support joint mode')
+    if 'context_df' not in data:
+        print('Loading data...')
+        data = {
+            'exome_df': pd.read_pickle(paths['exomes_local_frame_path']),
+            'context_df': pd.read_pickle(paths['context_local_frame_path'])
+        }
+    grouping = GROUPING + ['region']
+    with telemetry.step('load_models'):
+        models = load_models(paths, trimer=trimer)
+    with telemetry.step('get_expected_variants'):
+        expected_df = get_expected_variants(tag_regions(data['context_df']), models, grouping)
+        telemetry.record(rows_in=len(data['context_df']), rows_out=len(expected_df))
+    with telemetry.step('get_proportion_observed'):
+        data['prop_observed_df'] = get_proportion_observed(tag_regions(data['exome_df']), expected_df, grouping)
+        data['prop_observed_df'].to_pickle(paths['po_output_frame_path'])
+        telemetry.record(rows_in=len(data['exome_df']), rows_out=len(data['prop_observed_df']))
+        telemetry.record_output(paths['po_output_frame_path'], count_rows=False)
+    return data
+
+
+def summarise(paths, data, model, output_format='csv', partition_by=None):
+    if 'prop_observed_df' not in data:
+        data['prop_observed_df'] = pd.read_pickle(paths['po_output_frame_path'])
+    with telemetry.step('summarise_prop_observed'):
+        data['summary'] = summarise_prop_observed(data['prop_observed_df'], paths['summary_output_path'],
+                                                  output_format=output_format, partition_by=partition_by)
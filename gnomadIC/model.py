@@ -3,128 +3,235 @@ from itertools import product
 import argparse
 import hail as hl
 from typing import List
-from .utils import utils
+from .utils import utils, model_store, execution, telemetry
 from .data import *
 import os
 
 HIGH_COVERAGE_CUTOFF = 40
 POPS = ('global', 'afr', 'amr', 'eas', 'nfe', 'sas')
-  
+REGIONS = ('auto', 'x', 'y')
+# Variables observed and expected variants are counted by (region is added when tagging regions)
+GROUPING = ['annotation', 'modifier', 'transcript', 'gene', 'canonical']
 
-def split_table(path, full_ht):
+
+def region_expr(locus):
+    '''Region of a locus: autosome or PAR ('auto'), X non-PAR ('x') or Y non-PAR ('y'), missing otherwise'''
+    return (hl.case()
+        .when(locus.in_autosome_or_par(), 'auto')
+        .when(locus.in_x_nonpar(), 'x')
+        .when(locus.in_y_nonpar(), 'y')
+        .or_missing())
+
+
+def tag_regions(full_ht):
+    '''Tag each row with its region in a single scan, dropping rows in none of them (as split_table does)'''
+    full_ht = full_ht.annotate(region=region_expr(full_ht.locus))
+    return full_ht.filter(hl.is_defined(full_ht.region))
+
+
+@telemetry.traced()
+def split_table(path, full_ht, overwrite=False):
     # filter into X, Y and autosomal regions for separate aggregation
+    # Existing splits are reused unless overwrite is set; the model stage always overwrites, as it only
+    # reruns when its inputs have changed
     auto_path = path.replace('.ht','_auto.ht')
-    if not os.path.isdir(auto_path):
+    if overwrite or not os.path.isdir(auto_path):
         auto_ht = full_ht.filter(full_ht.locus.in_autosome_or_par())
-        auto_ht.write(auto_path)
+        auto_ht.write(auto_path, overwrite=True)
     auto_ht = hl.read_table(auto_path)
 
     x_path = path.replace('.ht','_x.ht')
-    if not os.path.isdir(x_path):
+    if overwrite or not os.path.isdir(x_path):
         x_ht = hl.filter_intervals(full_ht, [hl.parse_locus_interval('X')])
         x_ht = x_ht.filter(x_ht.locus.in_x_nonpar())
-        x_ht.write(x_path)
+        x_ht.write(x_path, overwrite=True)
     x_ht = hl.read_table(x_path)
 
     y_path = path.replace('.ht','_y.ht')
-    if not os.path.isdir(y_path):
+    if overwrite or not os.path.isdir(y_path):
         y_ht = hl.filter_intervals(full_ht, [hl.parse_locus_interval('Y')])
         y_ht = y_ht.filter(y_ht.locus.in_y_nonpar())
-        y_ht.write(y_path)
+        y_ht.write(y_path, overwrite=True)
     y_ht = hl.read_table(y_path)
 
+    for region_path in (auto_path, x_path, y_path):
+        telemetry.record_output(region_path)
     return {'auto':auto_ht, 'x':x_ht, 'y': y_ht}
 
 
-def load_models(paths):
-    # Get table for mutation rate if it doesn't exist  
-    if os.path.isdir(paths['mutation_rate_local_path']):
-        mutation_rate_ht = hl.read_table(paths['mutation_rate_local_path'])
-    else:
-        mutation_rate_ht = hl.read_table(paths['mutation_rate_path']).select('mu_snp')
-        mutation_rate_ht.write(paths['mutation_rate_local_path'])
-    
-    # Get coverage models if they don't exist
-    if os.path.isfile(paths['coverage_models_local_path']):
-        # Load local coverage models
-        with open(paths['coverage_models_local_path'],'rb') as fid:
-            coverage_model, plateau_models = pickle.load(fid)
+def mutation_rate_index_path(paths, trimer=True):
+    '''
+    Cache path of the mutation rate index, keyed by the fingerprint of the mutation rate table it is built from,
+    so a regenerated or replaced table gets a new index rather than reusing a stale one
+    '''
+    fingerprint = model_store.table_fingerprint(paths['mutation_rate_path'])[:16]
+    return paths['mutation_rate_local_path'].replace('.ht', f'_{"trimer" if trimer else "heptamer"}_{fingerprint}_index.npy')
+
+
+@telemetry.traced()
+def load_models(paths, trimer=True, weighted=False, half_cutoff=False, pops=False):
+    # Mutation rate and coverage tables are read from paths, which run_tasks points at local mirrors
+    mutation_rate_ht = hl.read_table(paths['mutation_rate_path']).select('mu_snp')
+    # Integer-indexed mutation rates, cached next to the local mutation rate table (by source fingerprint) and
+    # shared by every region
+    mutation_rate_index = utils.load_mutation_rate_index(mutation_rate_index_path(paths, trimer), mutation_rate_ht, trimer=trimer)
+
+    # Get coverage models fitted with these parameters on this coverage table, fitting them if not stored yet
+    # (a mirror has the same fingerprint as its source table, as its files are copied byte for byte)
+    # (pops is only part of the key when set, so models stored before population models keep their key)
+    model_params = dict(trimers=trimer, weighted=weighted, half_cutoff=half_cutoff, **({'pops': True} if pops else {}))
+    fingerprint = model_store.table_fingerprint(paths['po_coverage_path'])
+    stored_models = model_store.load_coverage_models(paths['coverage_models_local_dir'], model_params, fingerprint)
+    telemetry.record(stored_models=stored_models is not None)
+    if stored_models is not None:
+        coverage_model, plateau_models = stored_models
     else:
-        if os.path.isdir(paths['po_coverage_local_path']):
-            # Load local coverage table
-           coverage_ht = hl.read_table(paths['po_coverage_local_path'])
-        else:
-            # Download coverage table
-            coverage_ht = hl.read_table(paths['po_coverage_path'])
-            coverage_ht.write(paths['po_coverage_local_path'])
         # Build models from coverage table
-        coverage_model, plateau_models = utils.build_models(coverage_ht, trimers=True) 
-        with open(paths['coverage_models_local_path'],'wb') as fid:
-            pickle.dump((coverage_model,plateau_models),fid)  
+        coverage_ht = hl.read_table(paths['po_coverage_path'])
+        coverage_model, plateau_models = utils.build_models(coverage_ht, trimers=trimer, weighted=weighted, half_cutoff=half_cutoff, pops=pops)
+        model_store.save_coverage_models(paths['coverage_models_local_dir'], model_params, fingerprint,
+                                         coverage_model, plateau_models)
 
+    # The coverage model only applies below the cutoff it was fitted at, so the models carry their half_cutoff
     models = {
         'mutation_rate_ht': mutation_rate_ht,
+        'mutation_rate_index': mutation_rate_index,
         'coverage_model': coverage_model,
-        'plateau_models': plateau_models
+        'plateau_models': plateau_models,
+        'half_cutoff': half_cutoff
     }
     return models
 
-def preprocess(paths, data, grouping, model):
+@telemetry.traced()
+def fit_coverage_cutoffs(paths, half_cutoffs=(False, 2), trimer=True, weighted=False, pops=False):
+    '''
+    Fit coverage models for several high coverage cutoffs (HIGH_COVERAGE_CUTOFF / half_cutoff) in one scan of
+    the coverage table and save any not stored yet, so load_models(half_cutoff=...) finds each of them (e.g. for
+    sensitivity analyses on the cutoff). Returns {half_cutoff: (coverage_model, plateau_models)}
+    '''
+    fingerprint = model_store.table_fingerprint(paths['po_coverage_path'])
+    def params(half_cutoff):
+        return dict(trimers=trimer, weighted=weighted, half_cutoff=half_cutoff, **({'pops': True} if pops else {}))
+    fits = {x: model_store.load_coverage_models(paths['coverage_models_local_dir'], params(x), fingerprint) for x in half_cutoffs}
+    missing = [x for x, models in fits.items() if models is None]
+    telemetry.record(stored_models=len(fits) - len(missing))
+    if missing:
+        cutoffs = {x: HIGH_COVERAGE_CUTOFF / x if x else HIGH_COVERAGE_CUTOFF for x in missing}
+        coverage_ht = hl.read_table(paths['po_coverage_path'])
+        swept = utils.build_models_sweep(coverage_ht, list(cutoffs.values()), trimers=trimer, weighted=weighted, pops=pops)
+        for half_cutoff, cutoff in cutoffs.items():
+            fits[half_cutoff] = swept[cutoff]
+            model_store.save_coverage_models(paths['coverage_models_local_dir'], params(half_cutoff), fingerprint, *swept[cutoff])
+    return fits
+
+
+def preprocess(paths, data, grouping, model, trimer=True, split_regions=False,
+               max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS, joint=False, pops=False, half_cutoff=False):
     # Add extra annotations based on VEP 
     # annotations_ht = hl.get_annotations(model)
     # data['context_ht'] = data['context_ht'].annotate(**annotations_ht[data['context_ht'].hgvsp])
     # data['exome_ht'] = data['exome_ht'].annotate(**annotations_ht[data['exome_ht'].hgvsp])
-    # Split data; load models; modify grouping
-    data.update({
-        'exomes': split_table(paths['exomes_local_path'],data['exome_ht']),
-        'context': split_table(paths['context_local_path'],data['context_ht']),
-        'models': load_models(paths),
-        'grouping': grouping
-    })
+    # Tag (or with split_regions, split) data by region; load models; modify grouping
+    # Splitting and model loading are independent jobs, so they run concurrently
+    jobs = {'models': lambda: load_models(paths, trimer=trimer, pops=pops, half_cutoff=half_cutoff)}
+    if split_regions:
+        jobs.update({
+            'exomes': lambda: split_table(paths['exomes_local_path'],data['exome_ht'], overwrite=True),
+            'context': lambda: split_table(paths['context_local_path'],data['context_ht'], overwrite=True)
+        })
+    elif joint:
+        data['joint'] = tag_regions(data['joint_ht'])
+        grouping = grouping + ['region']
+    else:
+        data.update({
+            'exomes': tag_regions(data['exome_ht']),
+            'context': tag_regions(data['context_ht'])
+        })
+        grouping = grouping + ['region']
+    data.update(execution.run_concurrently(jobs, max_workers=max_concurrent_jobs))
+    data['grouping'] = grouping
     return data
 
 
 def load_data_to_estimate(paths):
-    data = dict(zip(
-        ('po_ht','po_x_ht','po_y_ht'),
-        (hl.read_table(x) for x in (
-                paths['po_output_path'], 
-                paths['po_output_path'].replace('.ht','_x.ht'),
-                paths['po_output_path'].replace('.ht','_y.ht')
-            )
-        )
-    ))
-    return data
+    # The proportion observed table holds every region, either tagged in one pass or as the union of splits
+    return {'po_ht': hl.read_table(paths['po_output_path'])}
 
 
-def get_expected_variants(ht, models, grouping, possible_path, pops=False):
-    '''Compute table of possible variants with needed properties'''
+@telemetry.traced()
+def get_expected_variants(ht, models, grouping, possible_path, pops=False, observed=False):
+    '''Compute table of possible variants with needed properties
+    observed also counts variants flagged as observed, for a joint table from data.get_joint_table
+    pops also sums expected variants of each population by downsampling (expected_variants_{pop} arrays)
+    Coverage is corrected below the cutoff the models were fitted at (their half_cutoff)'''
     # Apply model to calculated expected variants
     print('Calculating expected variants')
     ht = ht.annotate(variant_count=hl.literal(1))
-    ht = utils.annotate_expected_mutations(ht, models['mutation_rate_ht'], models['plateau_models'], models['coverage_model'], pops = pops)
+    ht = utils.annotate_expected_mutations(ht, models['mutation_rate_ht'], models['plateau_models'], models['coverage_model'], pops = pops,
+                                           mu_index=models.get('mutation_rate_index'), half_cutoff=models.get('half_cutoff', False))
 
     # Count possible variants by context, ref, alt & grouping - need to expand list of groupings to keep this from destroying information
-    agg_expr = {
+    agg_expr = {'observed_variants': hl.agg.count_where(ht.observed)} if observed else {}
+    agg_expr.update({
         'expected_variants': hl.agg.sum(ht.expected_variants),
         'possible_variants': hl.agg.sum(ht.possible_variants),
         'adjusted_mutation_rate': hl.agg.sum(ht.adjusted_mutation_rate),      
         'raw_mutation_rate': hl.agg.sum(ht.mu)
-    }
+    })
+    if pops:
+        agg_expr.update({f'expected_variants_{pop}': hl.agg.array_sum(ht[f'expected_variants_{pop}']) for pop in POPS})
     ht = ht.group_by(*grouping).aggregate(**agg_expr)
     ht.write(possible_path, overwrite=True)
-    return ht
+    telemetry.record_output(possible_path)
+    # Read back so later steps use the written table rather than recomputing the pipeline
+    return hl.read_table(possible_path)
 
 
+@telemetry.traced()
 def get_proportion_observed(
         exome_ht: hl.Table, 
         expected_variants_ht: hl.Table,
         grouping: List,
         proportion_variants_observed_ht_path,
         impose_high_af_cutoff_upfront: bool = True,
-        pops = False, overwrite=True) -> hl.Table:
-    '''Aggregate by grouping variables'''
+        pops = False, overwrite=True, merge='copartitioned') -> hl.Table:
+    '''Aggregate by grouping variables
+    merge='copartitioned' aggregates observed variants with the same grouping key and partitioning as the
+    expected table, then merges the two as a union of identically keyed tables followed by an aggregation on
+    that key. Hail does both as ordered per-partition passes, so there is no intermediate write, shuffle or
+    join. Groups missing from one side get missing counts from that side, which sum to 0, and groups with
+    missing key fields merge with each other rather than being duplicated as in the outer join.
+    merge='join' keeps the previous write, read and outer join.'''
+    if merge == 'join':
+        return _join_proportion_observed(exome_ht, expected_variants_ht, grouping, proportion_variants_observed_ht_path, overwrite=overwrite)
+    if merge != 'copartitioned':
+        raise ValueError(f'Unknown merge mode {merge}, expected copartitioned or join')
+
+    # Count observed variants by grouping, partitioned like the expected variants table
+    observed_variants_ht = (
+        exome_ht.group_by(*grouping)
+        .partition_hint(expected_variants_ht.n_partitions())
+        .aggregate(observed_variants=hl.agg.count())
+    )
+
+    # Give both sides the same row fields, missing where a side has no count
+    count_fields = {'observed_variants': observed_variants_ht.observed_variants.dtype}
+    count_fields.update(expected_variants_ht.row_value.dtype.items())
+    def with_count_fields(ht):
+        return ht.select(**{k: ht[k] if k in ht.row_value.dtype else hl.missing(dtype) for k, dtype in count_fields.items()})
+    merged_ht = with_count_fields(observed_variants_ht).union(with_count_fields(expected_variants_ht))
 
+    # Rows of the union with equal keys are adjacent, so aggregating on the key merges them in one pass
+    # (population expected counts are arrays, summed elementwise)
+    merged_ht = merged_ht.group_by(*merged_ht.key).aggregate(**{
+        k: hl.agg.array_sum(merged_ht[k]) if isinstance(dtype, hl.tarray) else hl.agg.sum(merged_ht[k])
+        for k, dtype in count_fields.items()})
+    merged_ht.write(proportion_variants_observed_ht_path, overwrite=overwrite)
+    telemetry.record_output(proportion_variants_observed_ht_path)
+    return hl.read_table(proportion_variants_observed_ht_path)
+
+
+def _join_proportion_observed(exome_ht, expected_variants_ht, grouping, proportion_variants_observed_ht_path, overwrite=True):
     # Count observed variants by grouping - expand grouping to include hgvsp to prevent information loss
     agg_expr = {
         'observed_variants': hl.agg.count()
@@ -132,58 +239,103 @@ def get_proportion_observed(
     observed_variants_ht = exome_ht.group_by(*grouping).aggregate(**agg_expr)
     obs_path = proportion_variants_observed_ht_path.replace('.ht','_raw.ht')
     observed_variants_ht.write(obs_path,overwrite=overwrite)
+    telemetry.record_output(obs_path)
 
     # Merge observed variants with expected variants
     observed_variants_ht = hl.read_table(obs_path)
     # Why does this join lead to variable duplication? Think it's because of missing values
     observed_variants_ht = observed_variants_ht.join(expected_variants_ht, 'outer')
     observed_variants_ht.write(proportion_variants_observed_ht_path,overwrite=overwrite)
+    telemetry.record_output(proportion_variants_observed_ht_path)
     return observed_variants_ht
 
 
-def model(paths, data, model):
+def model(paths, data, model, trimer=True, split_regions=False, max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS,
+          merge='copartitioned', joint=False, pops=False, half_cutoff=False):
     '''
     This is the new master function for performing constraint analysis
-    Possible variants for populations currently switched off
+    pops also fits plateau models for each population and downsampling and counts their expected variants
+    half_cutoff uses models fitted at a high coverage cutoff of HIGH_COVERAGE_CUTOFF / half_cutoff (see
+    fit_coverage_cutoffs)
+    Rows are tagged with their region (auto, x, y) in one scan and region is aggregated as an extra grouping,
+    so one pass covers all regions; split_regions instead writes and models each region separately, running
+    up to max_concurrent_jobs regions at once. merge selects how observed and expected counts are combined
+    (see get_proportion_observed)
+    joint models the single context table flagged with observed variants written by get_data(joint=True),
+    producing possible, expected and observed counts in one aggregation
     '''
+    if joint and split_regions:
+        raise ValueError('Joint mode tags regions in one pass and cannot be combined with split_regions')
     # Get data if not given 
-    if not data:
+    if joint and 'joint_ht' not in data:
+        print('Loading data...')
+        data = {'joint_ht': hl.read_table(paths['joint_local_path'])}
+        telemetry.record_input(paths['joint_local_path'])
+    elif not joint and 'exome_ht' not in data:
         print('Loading data...')
         data = {
             'exome_ht': hl.read_table(paths['exomes_local_path']),
             'context_ht': hl.read_table(paths['context_local_path'])
         }
+        telemetry.record_input(paths['exomes_local_path'])
+        telemetry.record_input(paths['context_local_path'])
     # Pre-process data
-    grouping = [
-        'annotation',
-        'modifier',
-        'transcript', 
-        'gene',
-        'canonical'
-        ]
-    data = preprocess(paths, data, grouping, model)
+    grouping = list(GROUPING)
+    data = preprocess(paths, data, grouping, model, trimer=trimer, split_regions=split_regions,
+                      max_concurrent_jobs=max_concurrent_jobs, joint=joint, pops=pops, half_cutoff=half_cutoff)
 
+    if joint:
+        # Possible, expected and observed counts for all regions in a single aggregation
+        data['prop_observed_ht'] = get_expected_variants(
+            data['joint'],
+            data['models'],
+            data['grouping'],
+            paths['po_output_path'],
+            pops=pops,
+            observed=True
+        )
+        return data
 
-    # Loop over autosomes, x y: aggregate by chosen groupings & get proportion observed
-    tables = ('auto','x','y')
-    data['prop_observed'] = {}
+    if not split_regions:
+        # Aggregate all regions at once by chosen groupings (including region) & get proportion observed
+        expected_variants_ht = get_expected_variants(
+            data['context'],
+            data['models'],
+            data['grouping'],
+            paths['possible_variants_ht_path'],
+            pops=pops
+        )
+        data['prop_observed_ht'] = get_proportion_observed(
+            data['exomes'],
+            expected_variants_ht,
+            data['grouping'],
+            paths['po_output_path'],
+            overwrite=True,
+            merge=merge)
+        return data
 
-    for table in tables:
+    # For autosomes, x y concurrently: aggregate by chosen groupings & get proportion observed
+    def model_region(table):
         expected_variants_ht = get_expected_variants(
             data['context'][table], 
             data['models'],
             data['grouping'],
             paths['possible_variants_ht_path'].replace('.ht',f'_{table}.ht'),
-            pops=False
+            pops=pops
         )
 
-        prop_observed_ht = get_proportion_observed(
+        return get_proportion_observed(
             data['exomes'][table],
             expected_variants_ht,
             data['grouping'],
             paths['po_output_path'].replace('.ht',f'_{table}.ht'), 
-            overwrite=True)
-        data['prop_observed'][table] = prop_observed_ht
+            overwrite=True,
+            merge=merge)
+
+    data['prop_observed'] = execution.run_concurrently(
+        {table: (lambda table=table: model_region(table)) for table in REGIONS},
+        max_workers=max_concurrent_jobs
+    )
 
     # Take union of answers and write to file
     data['prop_observed_ht'] = (
@@ -191,7 +343,9 @@ def model(paths, data, model):
                 .union(data['prop_observed']['x'])
                 .union(data['prop_observed']['y'])
                 )
-    data['prop_observed_ht'].write(paths['po_output_path'], overwrite=True)
+    with telemetry.step('union_regions'):
+        data['prop_observed_ht'].write(paths['po_output_path'], overwrite=True)
+        telemetry.record_output(paths['po_output_path'])
 
     
-    return data
\ No newline at end of file
+    return data
@@ -0,0 +1,62 @@
+'''Run options and their validation, importable without hail or pandas (see cli.py)'''
+import os
+from typing import List, Optional, Sequence
+
+TASKS = ('download', 'model', 'summarise')
+DATASETS = ('gnomad', 'non_neuro', 'non_cancer', 'controls')
+BACKENDS = ('hail', 'local')
+# Summary output formats: a gzipped CSV collected on the driver, or a Parquet dataset written from the executors
+OUTPUT_FORMATS = ('csv', 'parquet')
+# Confidence intervals of o/e: the grid search in Hail, or the same intervals from the gamma distribution in NumPy
+CI_ENGINES = ('hail', 'numpy')
+# CI engine of each backend when none is given
+DEFAULT_CI_ENGINES = {'hail': 'hail', 'local': 'numpy'}
+GENE_PANEL_PATH = 'data/Ensembl_Grch37_gpcr_genome_locations.csv'
+CONTROL_GENES_PATH = 'data/ensembl_gene_annotations.txt'
+
+
+def check_options(tasks: Sequence[str], backend: str = 'hail', joint: bool = False, packed: bool = False,
+                  controls: bool = False, max_concurrent_jobs: int = 1, cache_max_bytes=None,
+                  output_format: str = 'csv', partition_by=None, incremental: bool = False,
+                  expected_index: bool = False, ci_engine: Optional[str] = None) -> List[str]:
+    '''Problems with a combination of run options (empty if it is valid); checks input files but reads nothing'''
+    problems = []
+    if not tasks:
+        problems.append('No tasks given')
+    problems += [f'Unknown task {task}, expected one of {", ".join(TASKS)}' for task in tasks or () if task not in TASKS]
+    if backend not in BACKENDS:
+        problems.append(f'Unknown backend {backend}, expected one of {", ".join(BACKENDS)}')
+    if backend == 'local' and (joint or packed):
+        problems.append('The local backend supports neither joint nor packed mode')
+    if output_format not in OUTPUT_FORMATS:
+        problems.append(f'Unknown output format {output_format}, expected one of {", ".join(OUTPUT_FORMATS)}')
+    elif partition_by and output_format != 'parquet':
+        problems.append('Only parquet output can be partitioned')
+    if ci_engine is not None and ci_engine not in CI_ENGINES:
+        problems.append(f'Unknown CI engine {ci_engine}, expected one of {", ".join(CI_ENGINES)}')
+    elif ci_engine == 'hail' and backend == 'local':
+        problems.append('The local backend computes confidence intervals with NumPy, not the Hail grid search')
+    if incremental and backend != 'hail':
+        problems.append('Incremental updates need the hail backend')
+    if incremental and ('download' in (tasks or ())) != ('model' in (tasks or ())):
+        problems.append('Incremental updates extract and model new genes in one run: request download and model together')
+    if expected_index and (backend != 'hail' or joint):
+        problems.append('Expected variants can only be taken from an index with the hail backend, without joint mode')
+    if max_concurrent_jobs is not None and max_concurrent_jobs < 1:
+        problems.append('max_concurrent_jobs must be at least 1')
+    if cache_max_bytes is not None and cache_max_bytes <= 0:
+        problems.append('The cache size limit must be positive')
+    if 'download' in (tasks or ()):
+        for path in [GENE_PANEL_PATH] + ([CONTROL_GENES_PATH] if controls else []):
+            if not os.path.isfile(path):
+                problems.append(f'Gene panel file {path} not found')
+    return problems
+
+
+def needs_hail(tasks: Sequence[str], backend: str = 'hail') -> bool:
+    '''
+    Whether the tasks need Hail started up front
+    The local backend only needs Hail to extract the panel; otherwise Hail starts itself on first use (e.g. to
+    fit models that are not stored yet)
+    '''
+    return bool(tasks) and (backend == 'hail' or 'download' in tasks)
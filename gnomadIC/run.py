@@ -1,7 +1,23 @@
+import contextlib
+import functools
 import pandas as pd
 from .data import *
 from .model import *
 from .summarise import *
+from .utils import stages, mirror, intervals, execution, telemetry, gene_store
+from . import local, options, expected_index
+
+# Stage functions of each backend, bound here as run_tasks' `model` argument shadows the function of the same name
+STAGE_FUNCTIONS = {
+    'download': get_data,
+    'model': model,
+    'summarise': summarise
+}
+LOCAL_STAGE_FUNCTIONS = {
+    'download': local.get_data,
+    'model': local.model,
+    'summarise': local.summarise
+}
 
 def setup_paths(run_ID):
     root = './data'
@@ -19,13 +35,23 @@ def setup_paths(run_ID):
     local_paths = dict(
         # models - shared between runs
         mutation_rate_local_path = f'{root}/models/mutation_rate_methylation_bins.ht',
-        po_coverage_local_path = f'{root}/models/prop_observed_by_coverage_no_common_pass_filtered_bins.ht',
-        coverage_models_local_path = f'{root}/models/coverage_models.pkl',
+        resource_cache_dir = f'{root}/cache',
+        coverage_models_local_dir = f'{root}/models/coverage_models',
+        expected_index_dir = f'{root}/expected_index',
         # outputs - specific to run
+        stage_manifest_path = f'{output_subdir}/stages.json',
+        run_report_path = f'{output_subdir}/run_report.json',
         exomes_local_path = f'{output_subdir}/exomes.ht',
         context_local_path = f'{output_subdir}/context.ht',        
+        joint_local_path = f'{output_subdir}/joint.ht',
         possible_variants_ht_path = f'{output_subdir}/possible_transcript_pop.ht',
         po_output_path = f'{output_subdir}/prop_observed.ht',
+        # outputs of the local backend
+        exomes_local_frame_path = f'{output_subdir}/exomes.pkl',
+        context_local_frame_path = f'{output_subdir}/context.pkl',
+        po_output_frame_path = f'{output_subdir}/prop_observed.pkl',
+        # per-gene results of incremental runs
+        gene_store_dir = f'{output_subdir}/gene_store',
         finalized_output_path = f'{output_subdir}/constraint.ht',
         summary_output_path = f'{output_subdir}/constraint_final.ht'
     )
@@ -34,55 +60,213 @@ def setup_paths(run_ID):
     return paths
 
 
-def get_gene_intervals(test=False,controls=False):
-    # Get Ensembl gene intervals from file
-
-    gpcr_gene_intervals = pd.read_csv('data/Ensembl_Grch37_gpcr_genome_locations.csv')
+def get_gene_panel(test=False,controls=False):
+    '''Get Ensembl gene locations for the panel from file (symbol, contig, start, end)'''
+    columns = {'Grch37 symbol': 'symbol', 'Grch37 chromosome': 'contig', 'Grch37 start bp': 'start', 'Grch37 end bp': 'end'}
+    gpcr_gene_intervals = pd.read_csv(options.GENE_PANEL_PATH)
 
-    gpcr_gene_intervals = gpcr_gene_intervals[['HGNC symbol','Grch37 symbol','Grch37 chromosome','Grch37 start bp','Grch37 end bp']]
-    gpcr_gene_intervals['locus_interval_txt'] = gpcr_gene_intervals['Grch37 chromosome'] + ':'  + \
-        + gpcr_gene_intervals['Grch37 start bp'].map(str) + '-' + gpcr_gene_intervals['Grch37 end bp'].map(str)
-    gpcr_gene_intervals['interval'] = gpcr_gene_intervals['locus_interval_txt'].map(hl.parse_locus_interval)
+    if test:
+        gpcr_gene_intervals = gpcr_gene_intervals.sample(n=1,random_state=0)
+        print(f"{str(gpcr_gene_intervals['HGNC symbol'].values[0])} chosen as test gene")
+        return gpcr_gene_intervals.rename(columns=columns)[list(columns.values())]
+    panel = [gpcr_gene_intervals.rename(columns=columns)[list(columns.values())]]
 
     if controls:     
-        gene_intervals = pd.read_csv('data/ensembl_gene_annotations.txt',sep='\t')
+        gene_intervals = pd.read_csv(options.CONTROL_GENES_PATH,sep='\t')
         gene_intervals.columns = ['ensembl_gene_id','Grch37 chromosome','Grch37 start bp','Grch37 end bp','Grch37 symbol']
-        gene_intervals[['ensembl_gene_id','Grch37 symbol','Grch37 chromosome','Grch37 start bp','Grch37 end bp']]
         control_gene_intervals = gene_intervals[~gene_intervals['Grch37 symbol'].isin(gpcr_gene_intervals['Grch37 symbol'])].sample(n=500,random_state=0)
         control_gene_intervals.to_csv('data/control_gene_intervals.csv')
-        control_gene_intervals['locus_interval_txt'] = control_gene_intervals['Grch37 chromosome'] + ':'  + \
-        + control_gene_intervals['Grch37 start bp'].map(str) + '-' + control_gene_intervals['Grch37 end bp'].map(str)
-        control_gene_intervals['interval'] = control_gene_intervals['locus_interval_txt'].map(hl.parse_locus_interval)
+        panel.append(control_gene_intervals.rename(columns=columns)[list(columns.values())])
 
+    return pd.concat(panel, ignore_index=True)
 
-    if test:
-        gpcr_gene_intervals = gpcr_gene_intervals.sample(n=1,random_state=0)
-        print(f"{str(gpcr_gene_intervals['HGNC symbol'].values[0])} chosen as test gene")
-        return gpcr_gene_intervals['interval'].tolist()
-    elif not controls:
-        return gpcr_gene_intervals['interval'].tolist() 
-    else:
-        return gpcr_gene_intervals['interval'].tolist() + control_gene_intervals['interval'].tolist()
+
+def get_gene_intervals(test=False,controls=False,panel=None):
+    '''Gene intervals for the panel (or the given rows of it) as (contig, start, end), sorted and with overlaps merged'''
+    if panel is None:
+        panel = get_gene_panel(test, controls)
+    return intervals.normalize_intervals(zip(panel['contig'], panel['start'], panel['end']))
+
+
+def mirror_resources(paths, names, cache, max_workers=4):
+    '''Prefetch the named gs:// resources into a local cache concurrently and point paths at the mirrors'''
+    resources = {name: mirror.MirroredTableResource(paths[name], cache) for name in names}
+    print(f'Prefetching {", ".join(names)} into {cache.cache_dir}...')
+    return {**paths, **mirror.prefetch(resources, max_workers=max_workers)}
 
 
-def run_tasks(tasks, paths, model, test = False, controls=False):
-    '''Runs all requested tasks in specified path'''
+def run_tasks(tasks, paths, model, dataset='gnomad', annotations=None, test=False, controls=False, trimer=True, force=False,
+              cache_resources=True, cache_max_bytes=None, cache_panel_partitions=False,
+              max_concurrent_jobs=execution.MAX_CONCURRENT_JOBS, joint=False, packed=False, backend='hail',
+              output_format='csv', partition_by=None, incremental=False, expected_index_dir=None, ci_engine=None):
+    '''Runs all requested tasks in specified path
+    Each stage is keyed by a hash of its inputs, code and upstream stages. Stages that already completed with
+    the same hash are skipped, so an interrupted run resumes after the last completed stage; force reruns all.
+    Model resources (and, with cache_panel_partitions, the context/exome partitions the panel touches)
+    are mirrored into paths['resource_cache_dir'] before any stage starts
+    Independent Hail jobs within a stage are submitted concurrently, up to max_concurrent_jobs at once
+    joint extracts one context table flagged with observed exome variants and models it in one aggregation
+    packed stores mutation contexts in the extracts as integer codes rather than strings
+    backend='local' runs the stages on pandas frames in-process after extracting the panel with Hail (see local.py),
+    which suits panels of a few dozen genes; it supports neither joint nor packed
+    output_format='parquet' writes the summary as a Parquet dataset (partitioned by the partition_by columns) instead of a CSV
+    ci_engine computes confidence intervals with the grid search in Hail ('hail') or in NumPy ('numpy'); by default
+    the hail backend uses the grid search and the local backend NumPy
+    incremental keeps the proportion observed rows of each gene in paths['gene_store_dir'] (see gene_store.GeneStore):
+    only genes of the panel missing from the store are extracted and modelled, genes no longer in the panel are
+    dropped, and the panel's proportion observed table is assembled from the store before summarising
+    expected_index_dir takes expected variants of the panel genes from an index built by
+    expected_index.build_expected_index, so only the exomes are extracted
+    Timings, row counts, outputs and Spark metrics of every stage and sub-step go to paths['run_report_path']
+    (compare two runs with telemetry.compare_reports)'''
+    problems = options.check_options(tasks, backend=backend, joint=joint, packed=packed, controls=controls,
+                                     max_concurrent_jobs=max_concurrent_jobs, cache_max_bytes=cache_max_bytes,
+                                     output_format=output_format, partition_by=partition_by, incremental=incremental,
+                                     expected_index=expected_index_dir is not None, ci_engine=ci_engine)
+    if problems:
+        raise ValueError('\n'.join(problems))
+    ci_engine = ci_engine or options.DEFAULT_CI_ENGINES[backend]
+    summarise_args = {'ci_engine': ci_engine} if backend == 'hail' else {}
+    stage_functions = LOCAL_STAGE_FUNCTIONS if backend == 'local' else STAGE_FUNCTIONS
     data = {}
-    
-    if 'download' in tasks:
-        # Load gene intervals
-        gene_intervals = get_gene_intervals(test,controls)
-        # If in test mode only load 1 gene
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    shared_code = [os.path.join(package_dir, 'utils', x) for x in ('utils.py', 'vep.py')]
+    if backend == 'local':
+        stage_code = {name: [os.path.join(package_dir, 'local.py')] + shared_code for name in ('download', 'model', 'summarise')}
+    else:
+        stage_code = {name: [os.path.join(package_dir, f'{module}.py')] + shared_code
+                      for name, module in (('download', 'data'), ('model', 'model'), ('summarise', 'summarise'))}
+
+    @telemetry.traced('download')
+    def download():
         print('Getting data from Google Cloud...')
-        data = get_data(paths, gene_intervals, model)
+        data.update(stage_functions['download'](paths, read_plan, model, dataset=dataset, trimer=trimer,
+                                                     max_concurrent_jobs=max_concurrent_jobs, joint=joint,
+                                                     packed=packed))
         print('Data loaded successfully!')
-  
-    if 'model' in tasks:
+
+    @telemetry.traced('model')
+    def run_model():
         print('Modelling expected number of variants')
-        data = model(paths, data, model)
+        data.update(stage_functions['model'](paths, data, model, trimer=trimer, max_concurrent_jobs=max_concurrent_jobs,
+                                                  joint=joint))
+        if store is not None:
+            with telemetry.step('store_genes'):
+                store.add(added, data['prop_observed_ht'])
         print()
-    
-    if 'summarise' in tasks:
+
+    @telemetry.traced('summarise')
+    def run_summarise():
+        if store is not None:
+            with telemetry.step('assemble_panel'):
+                data['prop_observed_ht'] = store.write_panel(panel_genes, paths['po_output_path'])
         print('Running aggregation by variant classes')
-        data = summarise(paths, data, model)
+        stage_functions['summarise'](paths, data, model, output_format=output_format, partition_by=partition_by,
+                                     **summarise_args)
         print('Aggregated variants successfully!')
+
+    # A failed run leaves its report without a finish time
+    telemetry.start_run(paths['run_report_path'], params=dict(
+        tasks=tasks, model=model, dataset=dataset, test=test, controls=controls, trimer=trimer, joint=joint,
+        packed=packed, max_concurrent_jobs=max_concurrent_jobs, backend=backend, output_format=output_format, ci_engine=ci_engine,
+        incremental=incremental, expected_index_dir=expected_index_dir), spark_metrics=backend == 'hail')
+
+    store, panel, panel_genes, added = None, None, None, []
+    if incremental:
+        with telemetry.step('diff_panel'):
+            panel = get_gene_panel(test, controls)
+            panel_genes = list(dict.fromkeys(panel['symbol']))
+            store = gene_store.GeneStore(paths['gene_store_dir'], gene_store.store_key(
+                dict(dataset=dataset, model=model, trimer=trimer, joint=joint, packed=packed,
+                     sources=[paths[x] for x in ('context_path', 'exomes_path', 'mutation_rate_path', 'po_coverage_path')]),
+                code=stage_code['download'] + stage_code['model']))
+            added, removed = store.diff(panel_genes)
+            store.remove(removed)
+            telemetry.record(genes=len(panel_genes), added=len(added), removed=len(removed))
+        print(f'Gene store: {len(panel_genes)} genes in the panel, {len(added)} to add, {len(removed)} removed')
+        # Only the added genes are extracted and modelled
+        panel = panel[panel['symbol'].isin(added)]
+        if added:
+            # The store, not the stage manifest, records which genes are modelled, so new genes are always
+            # modelled and the panel summarised again
+            manifest = stages.StageManifest(paths['stage_manifest_path'])
+            manifest.invalidate('model')
+            manifest.invalidate('summarise')
+        else:
+            tasks = [x for x in tasks if x not in ('download', 'model')]
+
+    if expected_index_dir is not None:
+        # Expected variants of the genes come from the index, so the context table is not extracted
+        index_genes = added if incremental else list(dict.fromkeys(get_gene_panel(test, controls)['symbol']))
+        stage_functions = {
+            **stage_functions,
+            'download': functools.partial(stage_functions['download'], context=False),
+            'model': functools.partial(expected_index.model, index_dir=expected_index_dir, genes=index_genes)
+        }
+        stage_code['model'] = stage_code['model'] + [os.path.join(package_dir, 'expected_index.py')]
+
+    read_plan = intervals.ReadPlan([])
+    if 'download' in tasks:
+        # Plan pruned reads of the context and exome tables for the panel (1 gene in test mode)
+        with telemetry.step('plan_reads'):
+            read_plan = intervals.ReadPlan(get_gene_intervals(test, controls, panel=panel), [paths['context_path'], paths['exomes_path']])
+            telemetry.record(intervals=len(read_plan.intervals), tables={
+                path: {k: v for k, v in table.items() if k != 'parts'} for path, table in read_plan.tables.items()})
+        print(read_plan.report())
+
+    if backend == 'local':
+        download_outputs = [paths['exomes_local_frame_path'], paths['context_local_frame_path']]
+        model_outputs = [paths['po_output_frame_path']]
+    else:
+        download_outputs = [paths['joint_local_path']] if joint else [paths['exomes_local_path'], paths['context_local_path']]
+        if expected_index_dir is not None:
+            download_outputs = [paths['exomes_local_path']]
+        model_outputs = [paths['po_output_path']]
+    graph = [
+        stages.Stage(
+            'download', download,
+            params=dict(intervals=read_plan.interval_strings(), dataset=dataset, model=model, trimer=trimer, joint=joint,
+                        packed=packed, backend=backend, sources=[paths['context_path'], paths['exomes_path']],
+                        **({'context': False} if expected_index_dir is not None else {})),
+            outputs=download_outputs,
+            code=stage_code['download']
+        ),
+        stages.Stage(
+            'model', run_model,
+            params=dict(model=model, trimer=trimer, joint=joint, backend=backend,
+                        sources=[paths['mutation_rate_path'], paths['po_coverage_path']],
+                        # the genes looked up and the build of the index they are looked up in
+                        **({'index': expected_index.read_manifest(expected_index_dir).get('completed'), 'genes': sorted(index_genes)}
+                           if expected_index_dir is not None else {})),
+            upstream=['download'],
+            outputs=model_outputs,
+            code=stage_code['model']
+        ),
+        stages.Stage(
+            'summarise', run_summarise,
+            params=dict(model=model, backend=backend, output_format=output_format, partition_by=partition_by, ci_engine=ci_engine,
+                        # the genes of an incremental panel
+                        **({'genes': store.fingerprint(panel_genes)} if store is not None else {})),
+            upstream=['model'],
+            outputs=[paths['summary_output_path'].replace('.ht', '.parquet' if output_format == 'parquet' else '.csv.gz')],
+            code=stage_code['summarise']
+        )
+    ]
+    mirrored = ((['mutation_rate_path', 'po_coverage_path'] if cache_resources and 'model' in tasks else []) +
+                (['context_path', 'exomes_path'] if cache_panel_partitions and 'download' in tasks else []))
+    cache = mirror.ResourceCache(paths['resource_cache_dir'], max_bytes=cache_max_bytes) if mirrored else None
+    # Every mirror stays pinned until the stages reading it have run, so mirroring one never evicts another
+    with cache.pin([paths[name] for name in mirrored]) if mirrored else contextlib.nullcontext():
+        if cache_resources and 'model' in tasks:
+            # Stage hashes above keep the source paths; stages read through the mirrors
+            with telemetry.step('mirror_resources'):
+                paths.update(mirror_resources(paths, ['mutation_rate_path', 'po_coverage_path'], cache))
+        if cache_panel_partitions and 'download' in tasks:
+            with telemetry.step('mirror_panel_partitions'):
+                paths.update(mirror.prefetch({
+                    name: mirror.MirroredTableResource(paths[name], cache, parts=read_plan.tables[paths[name]]['parts'])
+                    for name in ('context_path', 'exomes_path')
+                }))
+        stages.run_stages(graph, paths['stage_manifest_path'], tasks, force=force)
+    telemetry.end_run()
+    return data
@@ -0,0 +1,189 @@
+'''
+Local query service for summarised constraint metrics
+
+Loads a summary written by the summarise stage (constraint_final.csv.gz, or a Parquet dataset) once, indexes
+its rows by gene, and answers lookups over HTTP from memory. The JSON of recent lookups is cached, so batched
+answers are assembled from cached fragments rather than encoded again:
+
+    GET  /health
+    GET  /genes/<gene>?variant_class=syn&canonical=true
+    POST /query  {"genes": ["ACTB", ...], "variant_class": "lof_hc", "canonical": true}
+
+Start it with `python constraint_analysis.py serve data/gnomad_standard/constraint_final.csv.gz`.
+'''
+import functools
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Sequence
+from urllib.parse import parse_qs, unquote, urlparse
+
+import numpy as np
+import pandas as pd
+
+CACHE_SIZE = 4096
+# Largest number of genes in one /query request
+MAX_BATCH_GENES = 1000
+
+
+def load_summary(path: str) -> pd.DataFrame:
+    '''Summary from the gzipped CSV or Parquet dataset written by summarise.summarise_prop_observed'''
+    if path.rstrip('/').endswith('.parquet'):
+        return pd.read_parquet(path)
+    summary = pd.read_csv(path, index_col=0)
+    if 'gene' not in summary.columns:
+        raise ValueError(f'{path} is not a constraint summary: it has no gene column')
+    return summary
+
+
+def _json_value(value):
+    # JSON has no NaN or infinity: missing metrics (e.g. o/e without expected variants) and log_P_H0 of -inf
+    # (P(L > 1) below float64 resolution) are null
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, np.generic):
+        return _json_value(value.item())
+    return value
+
+
+class ConstraintIndex:
+    '''
+    Summary rows indexed by gene, with an LRU cache of per-gene (and variant class) lookups
+
+    :param summary: Summary DataFrame (see load_summary)
+    :param cache_size: Number of (gene, variant class, canonical) lookups whose answers are kept
+    '''
+
+    def __init__(self, summary: pd.DataFrame, cache_size: int = CACHE_SIZE):
+        self.summary = summary.reset_index(drop=True)
+        self.columns = list(self.summary.columns)
+        # gene -> positions of its rows
+        self.rows = {gene: positions for gene, positions in self.summary.groupby('gene', sort=False).indices.items()}
+        self.lookup = functools.lru_cache(maxsize=cache_size)(self._lookup)
+
+    def __repr__(self):
+        return f'ConstraintIndex(rows={len(self.summary)}, genes={len(self.rows)})'
+
+    def _lookup(self, gene: str, variant_class: Optional[str] = None, canonical: Optional[bool] = None) -> Optional[str]:
+        '''Rows of a gene (optionally of one variant class, or canonical transcripts only) as a JSON array of objects'''
+        positions = self.rows.get(gene)
+        if positions is None:
+            return None
+        rows = self.summary.iloc[positions]
+        if variant_class is not None:
+            rows = rows[rows['variant_class'] == variant_class]
+        if canonical is not None:
+            rows = rows[rows['canonical'] == canonical]
+        return json.dumps([{k: _json_value(x) for k, x in zip(self.columns, row)}
+                           for row in rows.itertuples(index=False, name=None)], allow_nan=False)
+
+    def query_json(self, genes: Sequence[str], variant_class: Optional[str] = None, canonical: Optional[bool] = None) -> str:
+        '''JSON of query(), joined from the cached JSON of each gene'''
+        results, missing = [], []
+        for gene in dict.fromkeys(genes):
+            rows = self.lookup(gene, variant_class, canonical)
+            if rows is None:
+                missing.append(gene)
+            else:
+                results.append(f'{json.dumps(gene)}: {rows}')
+        return f'{{"results": {{{", ".join(results)}}}, "missing": {json.dumps(missing)}}}'
+
+    def query(self, genes: Sequence[str], variant_class: Optional[str] = None, canonical: Optional[bool] = None) -> Dict[str, Any]:
+        '''Rows of each of genes as {gene: [{column: value}]}, plus the genes not in the summary'''
+        return json.loads(self.query_json(genes, variant_class, canonical))
+
+    def stats(self) -> Dict[str, Any]:
+        info = self.lookup.cache_info()
+        return {'rows': len(self.summary), 'genes': len(self.rows),
+                'cache': {'hits': info.hits, 'misses': info.misses, 'size': info.currsize, 'max_size': info.maxsize}}
+
+
+def _parse_canonical(value) -> Optional[bool]:
+    if value is None or isinstance(value, bool):
+        return value
+    if str(value).lower() in ('true', '1', 'yes'):
+        return True
+    if str(value).lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError(f'canonical must be true or false, not {value}')
+
+
+class ConstraintRequestHandler(BaseHTTPRequestHandler):
+    '''Answers /health, /genes/<gene> and /query from the server's ConstraintIndex'''
+    quiet = True
+
+    def log_message(self, format, *args):
+        if not self.quiet:
+            super().log_message(format, *args)
+
+    def send_json(self, body, status: int = 200):
+        '''Send a JSON response from an object or an already encoded JSON string'''
+        data = (body if isinstance(body, str) else json.dumps(body)).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        index = self.server.index
+        if url.path == '/health':
+            return self.send_json(index.stats())
+        if url.path.startswith('/genes/'):
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            gene = unquote(url.path[len('/genes/'):])
+            try:
+                rows = index.lookup(gene, params.get('variant_class'), _parse_canonical(params.get('canonical')))
+            except ValueError as e:
+                return self.send_json({'error': str(e)}, 400)
+            if rows is None:
+                return self.send_json({'error': f'Gene {gene} not in the summary'}, 404)
+            return self.send_json(f'{{"gene": {json.dumps(gene)}, "rows": {rows}}}')
+        self.send_json({'error': f'Unknown path {url.path}'}, 404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/query':
+            return self.send_json({'error': f'Unknown path {self.path}'}, 404)
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            genes = request.get('genes')
+            if not isinstance(genes, list) or not genes:
+                raise ValueError('genes must be a non-empty list')
+            if len(genes) > MAX_BATCH_GENES:
+                raise ValueError(f'At most {MAX_BATCH_GENES} genes per query, not {len(genes)}')
+            if not all(isinstance(x, str) for x in genes):
+                raise ValueError('genes must be strings')
+            answer = self.server.index.query_json(genes, request.get('variant_class'), _parse_canonical(request.get('canonical')))
+        except (ValueError, AttributeError, TypeError) as e:
+            return self.send_json({'error': str(e)}, 400)
+        self.send_json(answer)
+
+
+def make_server(index: ConstraintIndex, host: str = '127.0.0.1', port: int = 8000, quiet: bool = True) -> ThreadingHTTPServer:
+    '''HTTP server answering queries from index on its own thread per connection (port 0 picks a free port)'''
+    handler = type('Handler', (ConstraintRequestHandler,), {'quiet': quiet})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.index = index
+    return server
+
+
+def serve_in_background(index: ConstraintIndex, host: str = '127.0.0.1', port: int = 0) -> ThreadingHTTPServer:
+    '''Start a server on a daemon thread, returning it (stop it with server.shutdown())'''
+    server = make_server(index, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def serve(summary_path: str, host: str = '127.0.0.1', port: int = 8000, cache_size: int = CACHE_SIZE, quiet: bool = False):
+    index = ConstraintIndex(load_summary(summary_path), cache_size=cache_size)
+    server = make_server(index, host, port, quiet=quiet)
+    print(f'Serving {index.stats()["genes"]} genes from {summary_path} on http://{host}:{server.server_port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,8 +1,15 @@
 import hail as hl
-from .utils import utils
+from . import options
+from .utils import utils, telemetry, export
 
-def summarise_prop_observed(po_ht, summary_path):
-    """ Function for drawing final inferences from observed and expected variant counts"""
+@telemetry.traced()
+def summarise_prop_observed(po_ht, summary_path, ci_engine='hail', output_format='csv', partition_by=None):
+    """ Function for drawing final inferences from observed and expected variant counts
+    ci_engine selects the grid search in Hail ('hail') or the batched NumPy engine ('numpy') for confidence intervals;
+    both add oe_lower, oe_upper and log_P_H0, so the summary has the same columns either way
+    output_format='csv' collects the summary and writes a gzipped CSV, returning it as a DataFrame; 'parquet' writes
+    it from the executors as a Parquet dataset (optionally partitioned by partition_by columns, e.g. 'gene') and
+    returns the summary table"""
 
     # Finish annotation groups    
     classic_lof_annotations = hl.literal({'stop_gained', 'splice_donor_variant', 'splice_acceptor_variant'})
@@ -29,12 +36,26 @@ def summarise_prop_observed(po_ht, summary_path):
     constraint_ht = po_ht.group_by(*groups).aggregate(**agg_expr)
     
     # calculate confidence intervals, join tables and label
-    constraint_ht = utils.oe_confidence_interval(constraint_ht, constraint_ht.obs, constraint_ht.exp, select_only_ci_metrics=False)
+    if ci_engine == 'numpy':
+        constraint_ht = utils.annotate_oe_confidence_intervals(constraint_ht, {'oe': (constraint_ht.obs, constraint_ht.exp)})
+    elif ci_engine == 'hail':
+        constraint_ht = utils.oe_confidence_interval(constraint_ht, constraint_ht.obs, constraint_ht.exp, select_only_ci_metrics=False)
+    else:
+        raise ValueError(f'Unknown CI engine {ci_engine}, expected one of {", ".join(options.CI_ENGINES)}')
+    if output_format == 'parquet':
+        export.export_parquet(constraint_ht, summary_path.replace('.ht', '.parquet'), partition_by=partition_by)
+        return constraint_ht
+    if output_format != 'csv':
+        raise ValueError(f'Unknown output format {output_format}, expected one of {", ".join(export.OUTPUT_FORMATS)}')
     constraint_df = constraint_ht.select_globals().to_pandas()
     constraint_df.to_csv(summary_path.replace('.ht','.csv.gz'),compression='gzip')
+    telemetry.record(rows_out=len(constraint_df))
+    telemetry.record_output(summary_path.replace('.ht','.csv.gz'), count_rows=False)
     return constraint_df
 
-def summarise(paths, data, model):
-    if not data:
+def summarise(paths, data, model, ci_engine='hail', output_format='csv', partition_by=None):
+    if 'prop_observed_ht' not in data:
         data['prop_observed_ht'] = hl.read_table(paths['po_output_path'])
-    data['summary'] = summarise_prop_observed(data['prop_observed_ht'], paths['summary_output_path'])
\ No newline at end of file
+        telemetry.record_input(paths['po_output_path'])
+    data['summary'] = summarise_prop_observed(data['prop_observed_ht'], paths['summary_output_path'], ci_engine=ci_engine,
+                                              output_format=output_format, partition_by=partition_by)
\ No newline at end of file
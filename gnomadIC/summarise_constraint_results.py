@@ -1,8 +1,9 @@
 import argparse
 import hail as hl
+import numpy as np
 from itertools import product
 from typing import Dict, List, Optional, Set, Tuple, Any
-from .utils import utils
+from .utils import utils, export
 
 # def estimate_custom(
 #         paths, 
@@ -15,105 +16,119 @@ from .utils import utils
 #     n_partitions = 1000
 
 
-def estimate(paths, data, pops = False, overwrite=False):
-    '''aggregate variants to calculate constraint metrics and significance'''
+def estimate(paths, data, pops = False, overwrite=False, ci_engine='hail', output_format='tsv', partition_by=None):
+    '''aggregate variants to calculate constraint metrics and significance
+    All variant categories are aggregated in one group_by, then pLI and (with ci_engine = 'numpy') all
+    confidence intervals are computed in one batched driver-side pass; with ci_engine = 'hail' all confidence
+    intervals are row annotations computed in one pass over the table
+    The summary is exported as a block-gzipped TSV, or with output_format = 'parquet' as a Parquet dataset
+    written from the executors (optionally partitioned by partition_by columns, e.g. 'gene')'''
     # Z score calculation not feasible with partial dataset
     # Need to include flagging of issues in constraint calculations
     keys = ('gene', 'transcript', 'canonical')
     n_partitions = 1000
 
 
-    # Take union of proportion observed tables
+    # The proportion observed table covers all regions; any per-region tables given separately are unioned in
     # This function aggregates over genes in all cases, as XG spans PAR and non-PAR X
-    po_ht = data['po_ht'].union(data['po_x_ht']).union(data['po_y_ht'])
-    po_ht = po_ht.repartition(n_partitions).persist()
+    po_ht = data['po_ht']
+    for name in ('po_x_ht', 'po_y_ht'):
+        if name in data:
+            po_ht = po_ht.union(data[name])
 
-    # Getting classic LoF annotations (no LOFTEE)
+    # Variant categories, all aggregated with filtered aggregators in a single group_by
     classic_lof_annotations = hl.literal({'stop_gained', 'splice_donor_variant', 'splice_acceptor_variant'})
-    lof_ht_classic = po_ht.filter(classic_lof_annotations.contains(po_ht.annotation) &
-                                  ((po_ht.modifier == 'HC') | (po_ht.modifier == 'LC')))
-    lof_ht_classic = utils.collapse_lof_ht(lof_ht_classic, keys, False)
-    lof_ht_classic = lof_ht_classic.rename({x: f'{x}_classic' for x in list(lof_ht_classic.row_value)})
-
-    # Getting all LoF annotations (LOFTEE HC + OS)
-    lof_ht_classic_hc = po_ht.filter((po_ht.modifier == 'HC') | (po_ht.modifier == 'OS'))
-    lof_ht_classic_hc = utils.collapse_lof_ht(lof_ht_classic_hc, keys, False)
-    lof_ht_classic_hc = lof_ht_classic_hc.rename({x: f'{x}_with_os' for x in list(lof_ht_classic_hc.row_value)})
-
-    # Getting all LoF annotations (LOFTEE HC)
-    lof_ht = po_ht.filter(po_ht.modifier == 'HC')
-    lof_ht = utils.collapse_lof_ht(lof_ht, keys, False)
-
-    # Aggregate missense variants
-    mis_ht = po_ht.filter(po_ht.annotation == 'missense_variant')
-    agg_expr = {
-        'obs_mis': hl.agg.sum(mis_ht.variant_count),
-        'exp_mis': hl.agg.sum(mis_ht.expected_variants),
-        'oe_mis': hl.agg.sum(mis_ht.variant_count) / hl.agg.sum(mis_ht.expected_variants),
-        'mu_mis': hl.agg.sum(mis_ht.mu),
-        'possible_mis': hl.agg.sum(mis_ht.possible_variants)
+    categories = {
+        # Classic LoF annotations (no LOFTEE)
+        'lof_classic': classic_lof_annotations.contains(po_ht.annotation) &
+                       ((po_ht.modifier == 'HC') | (po_ht.modifier == 'LC')),
+        'mis': po_ht.annotation == 'missense_variant',
+        'mis_pphen': po_ht.modifier == 'probably_damaging',
+        'mis_non_pphen': po_ht.modifier != 'probably_damaging',
+        'syn': po_ht.annotation == 'synonymous_variant',
+        # LOFTEE HC
+        'lof': po_ht.modifier == 'HC',
+        # LOFTEE HC + OS
+        'lof_with_os': (po_ht.modifier == 'HC') | (po_ht.modifier == 'OS')
     }
-
-    if pops:
-        for pop in utils.POPS:
-            agg_expr[f'exp_mis_{pop}'] = hl.agg.array_sum(mis_ht[f'expected_variants_{pop}'])
-            agg_expr[f'obs_mis_{pop}'] = hl.agg.array_sum(mis_ht[f'downsampling_counts_{pop}'])
-    mis_ht = mis_ht.group_by(*keys).aggregate(**agg_expr)
-
-    # Aggregate pphen and non-pphen missense variants
-    mis_pphen_ht = po_ht.filter(po_ht.modifier == 'probably_damaging')
-    mis_pphen_ht = mis_pphen_ht.group_by(*keys).aggregate(obs_mis_pphen=hl.agg.sum(mis_pphen_ht.variant_count),
-                                                          exp_mis_pphen=hl.agg.sum(mis_pphen_ht.expected_variants),
-                                                          oe_mis_pphen=hl.agg.sum(mis_pphen_ht.variant_count) / hl.agg.sum(mis_pphen_ht.expected_variants),
-                                                          possible_mis_pphen=hl.agg.sum(mis_pphen_ht.possible_variants))
-
-    mis_non_pphen_ht = po_ht.filter(po_ht.modifier != 'probably_damaging')
-    mis_non_pphen_ht = mis_non_pphen_ht.group_by(*keys).aggregate(obs_mis_non_pphen=hl.agg.sum(mis_non_pphen_ht.variant_count),
-                                                          exp_mis_non_pphen=hl.agg.sum(mis_non_pphen_ht.expected_variants),
-                                                          oe_mis_non_pphen=hl.agg.sum(mis_non_pphen_ht.variant_count) / hl.agg.sum(mis_non_pphen_ht.expected_variants),
-                                                          possible_mis_non_pphen=hl.agg.sum(mis_non_pphen_ht.possible_variants))
-
-            
-    # Aggregate synonymous variants                                
-    syn_ht = po_ht.filter(po_ht.annotation == 'synonymous_variant').key_by(*keys)
-    agg_expr = {
-        'obs_syn': hl.agg.sum(syn_ht.variant_count),
-        'exp_syn': hl.agg.sum(syn_ht.expected_variants),
-        'oe_syn': hl.agg.sum(syn_ht.variant_count) / hl.agg.sum(syn_ht.expected_variants),
-        'mu_syn': hl.agg.sum(syn_ht.mu),
-        'possible_syn': hl.agg.sum(syn_ht.possible_variants)
-    }
-    if pops:
-        for pop in utils.POPS:
-            agg_expr[f'exp_syn_{pop}'] = hl.agg.array_sum(syn_ht[f'expected_variants_{pop}'])
-            agg_expr[f'obs_syn_{pop}'] = hl.agg.array_sum(syn_ht[f'downsampling_counts_{pop}'])
-    syn_ht = syn_ht.group_by(*keys).aggregate(**agg_expr)
-
-    # join constraint metrics
-    ht = lof_ht_classic.annotate(
-        **mis_ht[lof_ht_classic.key], 
-        **mis_pphen_ht[lof_ht_classic.key],
-        **mis_non_pphen_ht[lof_ht_classic.key],
-        **syn_ht[lof_ht_classic.key], 
-        **lof_ht[lof_ht_classic.key],
-        **lof_ht_classic_hc[lof_ht_classic.key]
-    )
-
-    # calculate confidence intervals
-    syn_cis = utils.oe_confidence_interval(ht, ht.obs_syn, ht.exp_syn, prefix='oe_syn')
-    mis_cis = utils.oe_confidence_interval(ht, ht.obs_mis, ht.exp_mis, prefix='oe_mis')
-    lof_cis = utils.oe_confidence_interval(ht, ht.obs_lof, ht.exp_lof, prefix='oe_lof')
-    mis_pphen_cis = utils.oe_confidence_interval(ht, ht.obs_mis_pphen, ht.exp_mis_pphen, prefix='oe_mis_pphen')
-    mis_non_pphen_cis = utils.oe_confidence_interval(ht, ht.obs_mis_non_pphen, ht.exp_mis_non_pphen, prefix='oe_mis_non_pphen')
-
-    # join confidence intervals
-    ht = ht.annotate(
-        **syn_cis[ht.key], 
-        **mis_cis[ht.key], 
-        **lof_cis[ht.key],
-        **mis_pphen_cis[ht.key],
-        **mis_non_pphen_cis[ht.key]
-        )
+    lof_categories = {'lof_classic': '_classic', 'lof': '', 'lof_with_os': '_with_os'}
+    ci_categories = ('syn', 'mis', 'lof', 'mis_pphen', 'mis_non_pphen')
+
+    # Output columns per category, in the order of the former per-category tables
+    fields = {}
+    for name in categories:
+        if name in lof_categories:
+            suffix = lof_categories[name]
+            fields[name] = [f'obs_{name}', f'mu_{name}', f'possible_{name}', f'exp_{name}',
+                            f'pNull{suffix}', f'pRec{suffix}', f'pLI{suffix}', f'oe_{name}']
+        elif name in ('mis', 'syn'):
+            fields[name] = [f'obs_{name}', f'exp_{name}', f'oe_{name}', f'mu_{name}', f'possible_{name}']
+            if pops:
+                fields[name] += [f'{x}_{name}_{pop}' for pop in utils.POPS for x in ('exp', 'obs')]
+        else:
+            fields[name] = [f'obs_{name}', f'exp_{name}', f'oe_{name}', f'possible_{name}']
+
+    agg_expr = {}
+    for name, condition in categories.items():
+        condition = hl.or_else(condition, False)
+        agg_expr.update({
+            f'_n_{name}': hl.agg.count_where(condition),
+            f'obs_{name}': hl.agg.filter(condition, hl.agg.sum(
+                po_ht.observed_variants if name in lof_categories else po_ht.variant_count)),
+            f'exp_{name}': hl.agg.filter(condition, hl.agg.sum(po_ht.expected_variants)),
+            f'possible_{name}': hl.agg.filter(condition, hl.agg.sum(po_ht.possible_variants))
+        })
+        if f'mu_{name}' in fields[name]:
+            agg_expr[f'mu_{name}'] = hl.agg.filter(condition, hl.agg.sum(po_ht.mu))
+        if pops and name in ('mis', 'syn'):
+            for pop in utils.POPS:
+                agg_expr[f'exp_{name}_{pop}'] = hl.agg.filter(condition, hl.agg.array_sum(po_ht[f'expected_variants_{pop}']))
+                agg_expr[f'obs_{name}_{pop}'] = hl.agg.filter(condition, hl.agg.array_sum(po_ht[f'downsampling_counts_{pop}']))
+    ht = po_ht.group_by(*keys).partition_hint(n_partitions).aggregate(**agg_expr)
+
+    # Categories without variants are missing, as are LoF categories without expected variants
+    present = {name: ht[f'_n_{name}'] > 0 for name in categories}
+    for name in lof_categories:
+        present[name] &= ht[f'exp_{name}'] > 0
+    ht = ht.annotate(**{
+        field: hl.or_missing(present[name], ht[field])
+        for name in categories for field in fields[name] if field in ht.row
+    }, **{f'_present_{name}': present[name] for name in categories})
+    ht = ht.annotate(**{f'oe_{name}': ht[f'obs_{name}'] / ht[f'exp_{name}'] for name in categories})
+
+    # pLI for every LoF category (each fitted on its own genes) and all confidence intervals from one collect
+    columns = {f'{x}_{name}': ht[f'{x}_{name}'] for name in lof_categories for x in ('obs', 'exp')}
+    if ci_engine == 'numpy':
+        columns.update({f'{x}_{name}': ht[f'{x}_{name}'] for name in ci_categories for x in ('obs', 'exp')})
+    ht, df = utils._collect_frame(ht, **columns)
+
+    def column(name):
+        return df[name].to_numpy(dtype=np.float64, na_value=np.nan)
+
+    plis = utils.pLI_np(np.stack([column(f'obs_{name}') for name in lof_categories], axis=1),
+                        np.stack([column(f'exp_{name}') for name in lof_categories], axis=1))
+    results = {f'{k}{suffix}': plis[k][:, i]
+               for i, suffix in enumerate(lof_categories.values()) for k in ('pNull', 'pRec', 'pLI')}
+    if ci_engine == 'numpy':
+        for name in ci_categories:
+            ci = utils.oe_confidence_interval_np(column(f'obs_{name}'), column(f'exp_{name}'))
+            results.update({f'oe_{name}_lower': ci['lower'], f'oe_{name}_upper': ci['upper'], f'log_P_H0_{name}': ci['log_P_H0']})
+    ht = utils._annotate_from_arrays(ht, df, results)
+
+    # Keep genes with expected classic LoF variants, which the other categories used to be joined onto
+    ht = ht.filter(ht._present_lof_classic)
+
+    # calculate confidence intervals of every category in the same pass
+    if ci_engine != 'numpy':
+        ht = ht.annotate(**{f'_ci_{name}': utils.oe_confidence_interval_expr(ht[f'obs_{name}'], ht[f'exp_{name}'])
+                            for name in ci_categories})
+        ht = ht.transmute(**{
+            **{f'oe_{name}_lower': ht[f'_ci_{name}'].lower for name in ci_categories},
+            **{f'oe_{name}_upper': ht[f'_ci_{name}'].upper for name in ci_categories},
+            **{f'log_P_H0_{name}': ht[f'_ci_{name}'].log_P_H0 for name in ci_categories}
+        })
+    ci_fields = [field for name in ci_categories for field in (f'oe_{name}_lower', f'oe_{name}_upper', f'log_P_H0_{name}')]
+    ht = ht.select(*[field for name in categories for field in fields[name]], *ci_fields)
 
     data['finalised_ht'] = ht
     ht.write(paths['finalized_output_path'],overwrite=overwrite)
@@ -139,7 +154,11 @@ def estimate(paths, data, pops = False, overwrite=False):
         paths['summary_output_path'], 
         overwrite=overwrite
     )
-    data['summary'].export(paths['summary_output_path'].replace('.ht', '.txt.bgz'))
+    if output_format == 'parquet':
+        export.export_parquet(data['summary'], paths['summary_output_path'].replace('.ht', '.parquet'),
+                              partition_by=partition_by, overwrite=overwrite)
+    else:
+        data['summary'].export(paths['summary_output_path'].replace('.ht', '.txt.bgz'))
     return data
 
 
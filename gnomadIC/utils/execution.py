@@ -0,0 +1,69 @@
+import functools
+import logging
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger("gnomadIC.execution")
+
+# Independent Hail pipelines submitted at once; each spends much of its time in driver-side planning
+# and small stages, so a few concurrent jobs keep the executors busy
+MAX_CONCURRENT_JOBS = 3
+
+
+class ExecutionError(Exception):
+    '''
+    One or more concurrently submitted jobs failed
+
+    :param failures: Job name -> exception raised by that job
+    :param results: Job name -> result of every job that succeeded
+    '''
+
+    def __init__(self, failures: Dict[str, BaseException], results: Dict[str, Any]):
+        self.failures = failures
+        self.results = results
+        lines = [f'{len(failures)} of {len(failures) + len(results)} jobs failed:']
+        for name, error in failures.items():
+            lines.append(f'  {name}: {type(error).__name__}: {error}')
+        super().__init__('\n'.join(lines))
+
+
+def run_concurrently(jobs: Dict[str, Callable[[], Any]], max_workers: Optional[int] = MAX_CONCURRENT_JOBS) -> Dict[str, Any]:
+    '''
+    Run independent jobs (e.g. Hail pipelines ending in a write) from a thread pool and return name -> result
+
+    Hail submits each job to Spark from the calling thread, so jobs in different threads run side by side on
+    the cluster and wall-clock time approaches that of the longest job. Every job runs to completion; if any
+    fail, ExecutionError is raised listing all failures (chained to the first) with the successful results
+    attached. max_workers of 1 (or None) runs the jobs one after the other in the calling thread, with the
+    same failure handling.
+    '''
+    results, failures = {}, {}
+
+    def collect(name: str, get_result: Callable[[], Any]):
+        try:
+            results[name] = get_result()
+        except Exception as error:
+            logger.error('Job %s failed:\n%s', name, ''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+            failures[name] = error
+
+    if not max_workers or max_workers <= 1 or len(jobs) <= 1:
+        for name, job in jobs.items():
+            collect(name, functools.partial(_timed, name, job))
+    else:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(jobs))) as executor:
+            futures = {executor.submit(_timed, name, job): name for name, job in jobs.items()}
+            for future in as_completed(futures):
+                collect(futures[future], future.result)
+    if failures:
+        raise ExecutionError(failures, results) from next(iter(failures.values()))
+    # Return results in submission order
+    return {name: results[name] for name in jobs}
+
+
+def _timed(name: str, job: Callable[[], Any]) -> Any:
+    start = time.time()
+    result = job()
+    logger.info('Job %s finished in %.1fs', name, time.time() - start)
+    return result
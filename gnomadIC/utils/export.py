@@ -0,0 +1,55 @@
+import os
+import shutil
+from typing import Optional, Sequence
+
+import hail as hl
+
+from . import telemetry
+from ..options import OUTPUT_FORMATS
+
+
+def export_parquet(ht: hl.Table, path: str, partition_by: Optional[Sequence[str]] = None, overwrite: bool = True) -> str:
+    '''
+    Write a Hail table to a Parquet dataset, partition by partition on the executors
+
+    Nothing is collected to the driver, so its memory use does not grow with the table. Column types are
+    kept (structs are flattened to 'a.b' columns, sets and dicts become arrays); fields starting with '_' are
+    left out. partition_by writes one directory per value of the given columns (e.g. gene=ACTB/), so
+    readers such as pandas.read_parquet(path, columns=..., filters=...) load only what they need.
+    '''
+    partition_by = [partition_by] if isinstance(partition_by, str) else list(partition_by or [])
+    missing = [x for x in partition_by if x not in ht.row]
+    if missing:
+        raise ValueError(f'Cannot partition by {", ".join(missing)}: not a field of the table (fields: {", ".join(ht.row)})')
+    ht = ht.select_globals()
+    ht = ht.select(*[x for x in ht.row_value if not x.startswith('_')])
+    df = ht.to_spark(flatten=True)
+    writer = (df.repartition(*partition_by) if partition_by else df).write.mode('overwrite' if overwrite else 'error')
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(path)
+    telemetry.record_output(path, count_rows=False)
+    return path
+
+
+def export_frame_parquet(df, path: str, partition_by: Optional[Sequence[str]] = None, overwrite: bool = True) -> str:
+    '''Write a pandas DataFrame to a Parquet dataset laid out like export_parquet (needs pyarrow)'''
+    partition_by = [partition_by] if isinstance(partition_by, str) else list(partition_by or [])
+    missing = [x for x in partition_by if x not in df.columns]
+    if missing:
+        raise ValueError(f'Cannot partition by {", ".join(missing)}: not a column of the frame')
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f'{path} already exists')
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    df = df[[x for x in df.columns if not str(x).startswith('_')]]
+    if partition_by:
+        df.to_parquet(path, partition_cols=partition_by, index=False)
+    else:
+        os.makedirs(path)
+        df.to_parquet(os.path.join(path, 'part-00000.parquet'), index=False)
+    telemetry.record_output(path, count_rows=False)
+    return path
@@ -0,0 +1,168 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import hail as hl
+
+from . import telemetry
+from .stages import code_version
+
+# Batches are merged into one once a store holds more than this many
+MAX_BATCHES = 16
+
+
+def store_key(params: Dict[str, Any], code: Sequence[str] = ()) -> str:
+    '''Key of a gene store: the parameters and source files its per-gene results were computed with'''
+    key = {'params': params, 'code': code_version(code)}
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class GeneStore:
+    '''
+    Persistent per-gene store of proportion observed tables, for incremental gene panel updates
+
+    Rows of the proportion observed table (possible, expected and observed counts by annotation, modifier,
+    transcript, gene, canonical and region) depend only on the variants of their own gene, so the table of a
+    panel is the union of the rows of its genes. The store keeps those rows in batches, one Hail table per
+    update, and records in a JSON manifest which batch holds each gene:
+
+        store_dir/manifest.json
+        store_dir/batches/<batch>.ht
+
+    Only rows of the genes a batch was added for are kept, so rows of neighbouring genes that the gene
+    intervals happen to overlap are left out. A store built with another key (parameters or code) is emptied,
+    so every gene is recomputed.
+
+    :param store_dir: Directory holding the manifest and batches
+    :param key: Key of the parameters and code the rows are computed with (see store_key)
+    '''
+
+    def __init__(self, store_dir: str, key: str):
+        self.store_dir = store_dir
+        self.path = os.path.join(store_dir, 'manifest.json')
+        self.key = key
+        record = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                record = json.load(f)
+        if record and record.get('key') != key:
+            print(f'Gene store {store_dir} was built with other parameters or code: recomputing every gene')
+            self.clear()
+            record = {}
+        # gene -> {'batch': batch name, 'rows': rows of the gene}
+        self.genes: Dict[str, Dict[str, Any]] = record.get('genes', {})
+        # batch name -> {'genes': genes added in the batch, 'created': time}
+        self.batches: Dict[str, Dict[str, Any]] = record.get('batches', {})
+
+    def __repr__(self):
+        return f'GeneStore(store_dir={self.store_dir}, genes={len(self.genes)}, batches={len(self.batches)})'
+
+    def batch_path(self, batch: str) -> str:
+        return os.path.join(self.store_dir, 'batches', f'{batch}.ht')
+
+    def diff(self, genes: Iterable[str]) -> Tuple[List[str], List[str]]:
+        '''Genes of a panel missing from the store (in panel order), and stored genes no longer in the panel'''
+        genes = list(dict.fromkeys(genes))
+        added = [x for x in genes if x not in self.genes]
+        removed = sorted(set(self.genes) - set(genes))
+        return added, removed
+
+    def fingerprint(self, genes: Iterable[str]) -> str:
+        '''Hash of a set of genes and the store key, identifying a panel's results as long as no gene is re-added'''
+        return hashlib.sha256(json.dumps([self.key, sorted(set(genes))]).encode()).hexdigest()
+
+    def add(self, genes: Sequence[str], po_ht: hl.Table) -> str:
+        '''Store the rows of `genes` from a proportion observed table as a new batch, returning its name'''
+        genes = sorted(set(genes))
+        stored = [x for x in genes if x in self.genes]
+        if stored:
+            raise ValueError(f'Genes already in the store: {", ".join(stored)}')
+        digest = hashlib.sha256(json.dumps(genes).encode()).hexdigest()[:8]
+        batch = f'{time.strftime("%Y%m%d%H%M%S")}_{digest}'
+        path = self.batch_path(batch)
+        po_ht = po_ht.filter(hl.literal(set(genes)).contains(po_ht.gene))
+        po_ht.write(path, overwrite=True)
+        telemetry.record_output(path)
+        batch_ht = hl.read_table(path)
+        rows = batch_ht.aggregate(hl.agg.counter(batch_ht.gene))
+        missing = [x for x in genes if not rows.get(x)]
+        if missing:
+            # Usually a panel symbol that differs from the VEP gene symbol
+            print(f'No variants annotated to {", ".join(missing)}: check their symbols match VEP gene symbols')
+        self.batches[batch] = {'genes': genes, 'created': time.strftime('%Y-%m-%d %H:%M:%S')}
+        self.genes.update({x: {'batch': batch, 'rows': rows.get(x, 0)} for x in genes})
+        self.save()
+        return batch
+
+    def remove(self, genes: Iterable[str]):
+        '''Drop genes from the store, deleting batches left without any stored gene'''
+        genes = [x for x in genes if x in self.genes]
+        for gene in genes:
+            self.genes.pop(gene)
+        live = {x['batch'] for x in self.genes.values()}
+        dropped = [x for x in self.batches if x not in live]
+        for batch in dropped:
+            self.batches.pop(batch)
+        # Save before deleting so the manifest never points at a deleted batch
+        self.save()
+        for batch in dropped:
+            shutil.rmtree(self.batch_path(batch), ignore_errors=True)
+
+    def read(self, genes: Optional[Iterable[str]] = None) -> hl.Table:
+        '''Union of the stored rows of `genes` (all stored genes by default)'''
+        genes = set(self.genes) if genes is None else set(genes)
+        missing = sorted(genes - set(self.genes))
+        if missing:
+            raise ValueError(f'Genes not in the store: {", ".join(missing)}')
+        batches = sorted({self.genes[x]['batch'] for x in genes})
+        if not batches:
+            raise ValueError('No genes to read from the store')
+        tables = [hl.read_table(self.batch_path(x)) for x in batches]
+        ht = tables[0].union(*tables[1:])
+        # Batches may still hold rows of genes removed since they were written, or of genes not asked for
+        if any(set(self.batches[x]['genes']) - genes for x in batches):
+            ht = ht.filter(hl.literal(genes).contains(ht.gene))
+        return ht
+
+    def write_panel(self, genes: Iterable[str], path: str) -> hl.Table:
+        '''Write the proportion observed table of a panel from the store, merging batches first if there are many'''
+        if len(self.batches) > MAX_BATCHES:
+            self.compact()
+        self.read(genes).write(path, overwrite=True)
+        telemetry.record_output(path)
+        return hl.read_table(path)
+
+    def compact(self):
+        '''Merge every batch into one, keeping only the rows of stored genes'''
+        if len(self.batches) < 2:
+            return
+        old_batches = list(self.batches)
+        genes = sorted(self.genes)
+        digest = hashlib.sha256(json.dumps(genes).encode()).hexdigest()[:8]
+        batch = f'{time.strftime("%Y%m%d%H%M%S")}_{digest}'
+        with telemetry.step('compact_gene_store'):
+            self.read().write(self.batch_path(batch), overwrite=True)
+            telemetry.record_output(self.batch_path(batch))
+        self.batches = {batch: {'genes': genes, 'created': time.strftime('%Y-%m-%d %H:%M:%S')}}
+        for gene in genes:
+            self.genes[gene]['batch'] = batch
+        self.save()
+        for old_batch in old_batches:
+            shutil.rmtree(self.batch_path(old_batch), ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(os.path.join(self.store_dir, 'batches'), ignore_errors=True)
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+        self.genes, self.batches = {}, {}
+
+    def save(self):
+        # Write then rename so an interrupted run never leaves a truncated manifest
+        os.makedirs(self.store_dir, exist_ok=True)
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self.key, 'genes': self.genes, 'batches': self.batches}, f, indent=2)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,143 @@
+import gzip
+import json
+import os
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import hail as hl
+
+CONTIGS_GRCH37 = [str(x) for x in range(1, 23)] + ['X', 'Y', 'MT']
+CONTIG_RANK = {contig: i for i, contig in enumerate(CONTIGS_GRCH37)}
+
+GenomicInterval = Tuple[str, int, int]
+
+
+def parse_interval(text: str) -> GenomicInterval:
+    '''Parse 'contig:start-end' (1-based, inclusive) into a (contig, start, end) tuple'''
+    contig, span = text.strip().split(':')
+    start, end = span.replace(',', '').split('-')
+    return normalize_contig(contig), int(start), int(end)
+
+
+def normalize_contig(contig) -> str:
+    contig = str(contig).strip()
+    contig = contig[3:] if contig.lower().startswith('chr') else contig
+    return 'MT' if contig == 'M' else contig
+
+
+def normalize_intervals(intervals: Iterable[GenomicInterval]) -> List[GenomicInterval]:
+    '''Sort intervals in reference order and merge any that overlap or abut'''
+    intervals = sorted(
+        ((normalize_contig(contig), int(start), int(end)) for contig, start, end in intervals),
+        key=lambda x: (CONTIG_RANK.get(x[0], len(CONTIG_RANK)), x[0], x[1], x[2])
+    )
+    merged = []
+    for contig, start, end in intervals:
+        if merged and merged[-1][0] == contig and start <= merged[-1][2] + 1:
+            merged[-1] = (contig, merged[-1][1], max(end, merged[-1][2]))
+        else:
+            merged.append((contig, start, end))
+    return merged
+
+
+def format_interval(interval: GenomicInterval) -> str:
+    return f'{interval[0]}:{interval[1]}-{interval[2]}'
+
+
+def to_hail_intervals(intervals: Sequence[GenomicInterval], reference_genome: str = 'GRCh37') -> List[hl.Interval]:
+    return [
+        hl.Interval(hl.Locus(contig, start, reference_genome=reference_genome),
+                    hl.Locus(contig, end, reference_genome=reference_genome),
+                    includes_end=True)
+        for contig, start, end in intervals
+    ]
+
+
+def _read_json(path: str):
+    with hl.hadoop_open(path, 'rb') as f:
+        data = f.read()
+    return json.loads(gzip.decompress(data) if path.endswith('.gz') else data)
+
+
+def _locus_rank(point) -> Tuple[int, int]:
+    '''Sort key for a partition bound, a struct whose first field is the locus'''
+    locus = point['locus'] if 'locus' in point else next(iter(point.values()))
+    contig = normalize_contig(locus['contig'])
+    return CONTIG_RANK.get(contig, len(CONTIG_RANK)), locus['position']
+
+
+def table_partitions(path: str) -> List[Dict]:
+    '''
+    Partition files of a locus-keyed Hail table, with their key bounds and sizes
+
+    Bounds come from the table's rows/metadata.json.gz, so no data is read.
+    '''
+    path = path.rstrip('/')
+    spec = _read_json(f'{path}/rows/metadata.json.gz')
+    sizes = {os.path.basename(x['path']): x['size_bytes'] for x in hl.hadoop_ls(f'{path}/rows/parts')}
+    return [
+        {
+            'part': part,
+            'start': _locus_rank(bounds['start']),
+            'end': _locus_rank(bounds['end']),
+            'size_bytes': sizes.get(part, 0)
+        }
+        for part, bounds in zip(spec['_partFiles'], spec['_jRangeBounds'])
+    ]
+
+
+class ReadPlan:
+    '''
+    A pruned-read plan for a gene panel, shared by every table read for that panel
+
+    Intervals are normalised, sorted and merged once. For each planned table, the partitions overlapping the
+    intervals are found from the table's partition bounds, which gives the partition and byte counts each
+    read will touch before anything runs.
+
+    :param intervals: (contig, start, end) tuples, or 'contig:start-end' strings
+    :param paths: Table paths to plan reads for
+    :param reference_genome: Reference genome of the loci
+    '''
+
+    def __init__(self, intervals: Iterable, paths: Sequence[str] = (), reference_genome: str = 'GRCh37'):
+        self.intervals = normalize_intervals(parse_interval(x) if isinstance(x, str) else x for x in intervals)
+        self.reference_genome = reference_genome
+        self.tables = {}
+        for path in paths:
+            self.plan_table(path)
+
+    def __repr__(self):
+        return f'ReadPlan(n_intervals={len(self.intervals)},tables={list(self.tables)})'
+
+    def interval_strings(self) -> List[str]:
+        return [format_interval(x) for x in self.intervals]
+
+    def hail_intervals(self) -> List[hl.Interval]:
+        return to_hail_intervals(self.intervals, self.reference_genome)
+
+    def plan_table(self, path: str) -> Dict:
+        '''Find the partitions of `path` that overlap the planned intervals'''
+        partitions = table_partitions(path)
+        ranked = [((CONTIG_RANK.get(c, len(CONTIG_RANK)), start), (CONTIG_RANK.get(c, len(CONTIG_RANK)), end))
+                  for c, start, end in self.intervals]
+        touched = [p for p in partitions if any(p['start'] <= end and start <= p['end'] for start, end in ranked)]
+        self.tables[path] = {
+            'parts': [p['part'] for p in touched],
+            'n_partitions': len(touched),
+            'total_partitions': len(partitions),
+            'bytes': sum(p['size_bytes'] for p in touched),
+            'total_bytes': sum(p['size_bytes'] for p in partitions)
+        }
+        return self.tables[path]
+
+    def read(self, path: str) -> hl.Table:
+        '''Read `path` pruned to the planned intervals, so only overlapping partitions are loaded'''
+        return hl.read_table(path, _intervals=self.hail_intervals(), _filter_intervals=True)
+
+    def report(self) -> str:
+        lines = [f'{len(self.intervals)} merged intervals covering {sum(e - s + 1 for _, s, e in self.intervals):,} bp']
+        for path, table in self.tables.items():
+            lines.append(
+                f'{path}: {table["n_partitions"]}/{table["total_partitions"]} partitions, '
+                f'{table["bytes"] / 1e9:.2f}/{table["total_bytes"] / 1e9:.2f} GB'
+            )
+        return '\n'.join(lines)
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import hail as hl
+
+from .resources import DataException, TableResource
+
+logger = logging.getLogger("gnomadIC.mirror")
+
+
+def _is_local(path: str) -> bool:
+    return '://' not in path or path.startswith('file://')
+
+
+def _strip_scheme(path: str) -> str:
+    return path[len('file://'):] if path.startswith('file://') else path
+
+
+def _stat_files(path: str) -> Dict[str, List]:
+    '''Recursively map the relative path of every file under a table directory, local or remote, to [size, modification time]'''
+    path = path.rstrip('/')
+    if _is_local(path):
+        root = _strip_scheme(path)
+        files = {}
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                full_path = os.path.join(dirpath, name)
+                files[os.path.relpath(full_path, root)] = [os.path.getsize(full_path), os.path.getmtime(full_path)]
+        return files
+
+    files = {}
+    pending = [path]
+    while pending:
+        for entry in hl.hadoop_ls(pending.pop()):
+            if entry['is_dir']:
+                pending.append(entry['path'])
+            else:
+                files[entry['path'][len(path) + 1:]] = [entry['size_bytes'], entry.get('modification_time')]
+    return files
+
+
+def _list_files(path: str) -> List[Tuple[str, int]]:
+    '''Recursively list (relative path, size) of every file under a table directory, local or remote'''
+    return [(rel, size) for rel, (size, _) in _stat_files(path).items()]
+
+
+def _copy_file(src: str, dst: str):
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    if _is_local(src):
+        shutil.copyfile(_strip_scheme(src), dst)
+    else:
+        hl.hadoop_copy(src, f'file://{os.path.abspath(dst)}')
+
+
+def _in_partitions(rel_path: str, parts: Optional[Iterable[str]]) -> bool:
+    '''Whether a table file is needed when only `parts` (row partition file names) are mirrored'''
+    if parts is None:
+        return True
+    if not (rel_path.startswith('rows/parts/') or rel_path.startswith('index/')):
+        # Metadata, globals and success markers are always needed
+        return True
+    return any(part in rel_path for part in parts)
+
+
+class ResourceCache:
+    '''
+    Local mirror of remote Hail tables with size-bounded LRU eviction
+
+    Each mirrored table is recorded in a JSON manifest in `cache_dir` with the size and remote modification
+    time of every file copied. A mirror is only used if all of its recorded files are present locally with the
+    recorded sizes and the remote files still have the recorded sizes and modification times; otherwise it is
+    mirrored again. Mirrors are built in a temporary directory that is renamed into place once complete.
+    `parts` restricts a mirror to the given row partitions, which is enough for reads that are pruned to those
+    partitions.
+
+    Eviction never removes a mirror that is being fetched or is pinned (see `pin`) by this process, even if
+    the cache then stays over max_bytes until the pins are released.
+
+    :param cache_dir: Local directory holding mirrored tables
+    :param max_bytes: Evict least recently used tables once the cache is larger than this (no limit if None)
+    '''
+
+    def __init__(self, cache_dir: str, max_bytes: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.manifest_path = os.path.join(cache_dir, 'cache_manifest.json')
+        self._lock = threading.Lock()
+        self._pinned = Counter()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f'ResourceCache(cache_dir={self.cache_dir},max_bytes={self.max_bytes})'
+
+    def local_path(self, remote_path: str) -> str:
+        remote_path = remote_path.rstrip('/')
+        digest = hashlib.sha256(remote_path.encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, digest, os.path.basename(remote_path))
+
+    def _read_manifest(self) -> Dict[str, Dict]:
+        if not os.path.isfile(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest: Dict[str, Dict]):
+        tmp_path = f'{self.manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, self.manifest_path)
+
+    @contextmanager
+    def pin(self, remote_paths: Iterable[str]):
+        '''Keep the mirrors of `remote_paths` from being evicted while in this context'''
+        remote_paths = [x.rstrip('/') for x in remote_paths]
+        with self._lock:
+            self._pinned.update(remote_paths)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pinned.subtract(remote_paths)
+                self._pinned += Counter()  # drop paths no longer pinned
+
+    def _is_intact(self, entry: Dict, remote_files: Optional[Dict[str, List]] = None) -> bool:
+        '''Whether every recorded file is present locally with its size, and unchanged in `remote_files` if given'''
+        local_path = entry['local_path']
+        for rel, stat in entry['files'].items():
+            # Manifests written before modification times were recorded hold bare sizes
+            if not isinstance(stat, list):
+                return False
+            full_path = os.path.join(local_path, rel)
+            if not os.path.isfile(full_path) or os.path.getsize(full_path) != stat[0]:
+                return False
+            if remote_files is not None and remote_files.get(rel) != stat:
+                return False
+        return True
+
+    def is_cached(self, remote_path: str, parts: Optional[Iterable[str]] = None,
+                  remote_files: Optional[Dict[str, List]] = None) -> bool:
+        '''Whether an intact, up to date mirror of `remote_path` covers `parts` (the remote table is listed unless `remote_files` is given)'''
+        remote_path = remote_path.rstrip('/')
+        entry = self._read_manifest().get(remote_path)
+        if entry is None:
+            return False
+        if not self._is_intact(entry, _stat_files(remote_path) if remote_files is None else remote_files):
+            return False
+        if entry['parts'] is None:
+            return True
+        return parts is not None and set(parts) <= set(entry['parts'])
+
+    def fetch(self, remote_path: str, parts: Optional[Iterable[str]] = None, overwrite: bool = False) -> str:
+        '''Mirror `remote_path` (or only the row partitions in `parts`) and return the local path'''
+        remote_path = remote_path.rstrip('/')
+        parts = None if parts is None else sorted(set(parts))
+        # Pinned while in flight, so fetches of other tables do not evict it before it is read
+        with self.pin([remote_path]):
+            return self._fetch(remote_path, parts, overwrite)
+
+    def _fetch(self, remote_path: str, parts: Optional[List[str]], overwrite: bool) -> str:
+        local_path = self.local_path(remote_path)
+        with self._lock:
+            entry = self._read_manifest().get(remote_path)
+        remote_files = _stat_files(remote_path)
+        if '_SUCCESS' not in remote_files:
+            raise DataException(f'{remote_path} is not a complete Hail table (no _SUCCESS file)')
+        if not overwrite and self.is_cached(remote_path, parts, remote_files=remote_files):
+            self._touch(remote_path)
+            return local_path
+
+        # Extend an intact, up to date partial mirror in place; otherwise build a fresh mirror and rename it into place
+        extend = (not overwrite and entry is not None and entry['parts'] is not None
+                  and self._is_intact(entry, remote_files))
+        if extend:
+            target, files = local_path, dict(entry['files'])
+            parts = None if parts is None else sorted(set(parts) | set(entry['parts']))
+        else:
+            target, files = f'{local_path}.{os.getpid()}.{threading.get_ident()}.tmp', {}
+        start = time.time()
+        for rel, (size, mtime) in remote_files.items():
+            if rel in files or not _in_partitions(rel, parts):
+                continue
+            dst = os.path.join(target, rel)
+            _copy_file(f'{remote_path}/{rel}', dst)
+            if os.path.getsize(dst) != size:
+                raise DataException(f'Size mismatch mirroring {remote_path}/{rel}: expected {size}, got {os.path.getsize(dst)}')
+            files[rel] = [size, mtime]
+        if not extend:
+            if os.path.isdir(local_path):
+                shutil.rmtree(local_path)
+            os.replace(target, local_path)
+        logger.info('Mirrored %s to %s in %.1fs', remote_path, local_path, time.time() - start)
+
+        with self._lock:
+            manifest = self._read_manifest()
+            manifest[remote_path] = {
+                'local_path': local_path,
+                'parts': parts,
+                'files': files,
+                'size_bytes': sum(size for size, _ in files.values()),
+                'last_access': time.time()
+            }
+            self._write_manifest(manifest)
+        self.evict()
+        return local_path
+
+    def _touch(self, remote_path: str):
+        with self._lock:
+            manifest = self._read_manifest()
+            if remote_path in manifest:
+                manifest[remote_path]['last_access'] = time.time()
+                self._write_manifest(manifest)
+
+    def size_bytes(self) -> int:
+        return sum(entry['size_bytes'] for entry in self._read_manifest().values())
+
+    def evict(self, keep: Iterable[str] = ()):
+        '''Remove least recently used mirrors until the cache fits in max_bytes, skipping pinned mirrors and `keep`'''
+        if self.max_bytes is None:
+            return
+        with self._lock:
+            keep = set(x.rstrip('/') for x in keep) | set(self._pinned)
+            manifest = self._read_manifest()
+            total = sum(entry['size_bytes'] for entry in manifest.values())
+            for remote_path in sorted(manifest, key=lambda x: manifest[x]['last_access']):
+                if total <= self.max_bytes:
+                    break
+                if remote_path in keep:
+                    continue
+                entry = manifest.pop(remote_path)
+                shutil.rmtree(os.path.dirname(entry['local_path']), ignore_errors=True)
+                total -= entry['size_bytes']
+                logger.info('Evicted %s from the resource cache', remote_path)
+            if total > self.max_bytes:
+                logger.warning('Resource cache holds %d bytes, over its %d byte limit, as the rest is pinned', total, self.max_bytes)
+            self._write_manifest(manifest)
+
+
+class MirroredTableResource(TableResource):
+    '''
+    A Hail Table resource read through a local ResourceCache mirror of a remote table
+
+    :param remote_path: The remote Table path (gs://..., or a local directory standing in for the bucket)
+    :param cache: ResourceCache holding the mirror
+    :param parts: Optional row partition file names to mirror instead of the whole table
+    '''
+
+    def __init__(self, remote_path: str, cache: ResourceCache, parts: Optional[Iterable[str]] = None):
+        self.remote_path = remote_path
+        self.cache = cache
+        self.parts = parts
+        super().__init__(path=cache.local_path(remote_path))
+
+    def ht(self, force_import: bool = False) -> hl.Table:
+        """
+        Mirror the table if needed, then read and return it from the local cache.
+
+        :return: Hail Table resource
+        """
+        self.import_resource(overwrite=force_import)
+        return hl.read_table(self.path)
+
+    def import_resource(self, overwrite: bool = False, **kwargs) -> None:
+        """
+        Mirror the remote table into the local cache.
+
+        :param overwrite: If ``True``, mirror again even if an intact mirror exists.
+        :return: Nothing
+        """
+        self.cache.fetch(self.remote_path, parts=self.parts, overwrite=overwrite)
+
+
+def prefetch(resources: Dict[str, MirroredTableResource], max_workers: int = 4) -> Dict[str, str]:
+    '''
+    Mirror several resources concurrently, returning name -> local path
+
+    Every resource is pinned until all are mirrored, so mirroring one never evicts another finished earlier.
+    Pin them again (ResourceCache.pin) to keep them for as long as they are read.
+    '''
+    with ExitStack() as pins:
+        for resource in resources.values():
+            pins.enter_context(resource.cache.pin([resource.remote_path]))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {name: executor.submit(resource.import_resource) for name, resource in resources.items()}
+            for future in futures.values():
+                future.result()
+    return {name: resource.path for name, resource in resources.items()}
@@ -0,0 +1,102 @@
+import glob
+import hashlib
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+# Hail table files whose contents change whenever the table is rewritten (partition file names are unique)
+TABLE_METADATA_FILES = ('metadata.json.gz', 'rows/metadata.json.gz', 'globals/metadata.json.gz')
+
+
+def table_fingerprint(path: str) -> str:
+    '''Fingerprint of a Hail table from its metadata files, which works for local and remote (gs://) tables'''
+    digest = hashlib.sha256()
+    for name in TABLE_METADATA_FILES:
+        file_path = f'{path.rstrip("/")}/{name}'
+        if '://' in path:
+            import hail as hl
+            with hl.hadoop_open(file_path, 'rb') as f:
+                digest.update(f.read())
+        elif os.path.isfile(file_path):
+            with open(file_path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+def model_key(params: Dict[str, Any], fingerprint: str) -> str:
+    '''Key of a fitted model variant: the fitting parameters plus the fingerprint of the source coverage table'''
+    key = json.dumps({'params': params, 'fingerprint': fingerprint}, sort_keys=True)
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+def _encode(obj):
+    '''Make model structures JSON-serialisable, keeping dict keys (e.g. cpg booleans) and structs distinguishable'''
+    if hasattr(obj, '_fields') and isinstance(getattr(obj, '_fields'), dict):  # hail Struct
+        return {'struct': {k: _encode(v) for k, v in obj._fields.items()}}
+    if isinstance(obj, dict):
+        return {'dict': [[_encode(k), _encode(v)] for k, v in obj.items()]}
+    if isinstance(obj, (list, tuple)):
+        return [_encode(x) for x in obj]
+    if hasattr(obj, 'item'):  # numpy scalar
+        return obj.item()
+    return obj
+
+
+def _decode(obj, struct=dict):
+    if isinstance(obj, dict) and 'struct' in obj:
+        return struct(**{k: _decode(v, struct) for k, v in obj['struct'].items()})
+    if isinstance(obj, dict) and 'dict' in obj:
+        return {_decode(k, struct): _decode(v, struct) for k, v in obj['dict']}
+    if isinstance(obj, list):
+        return [_decode(x, struct) for x in obj]
+    return obj
+
+
+def save_coverage_models(store_dir: str, params: Dict[str, Any], fingerprint: str,
+                         coverage_model: Tuple[float, float], plateau_models) -> str:
+    '''
+    Save a fitted (coverage_model, plateau_models) variant to the store as JSON
+
+    The file is written under a temporary name and renamed, so concurrent readers never see a partial file
+    and concurrent writers of the same variant simply replace each other's identical output.
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    path = os.path.join(store_dir, f'{model_key(params, fingerprint)}.json')
+    record = {
+        'params': params,
+        'fingerprint': fingerprint,
+        'coverage_model': _encode(coverage_model),
+        'plateau_models': _encode(plateau_models)
+    }
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_coverage_models(store_dir: str, params: Dict[str, Any], fingerprint: str, struct=None) -> Optional[Tuple]:
+    '''
+    Load the (coverage_model, plateau_models) variant fitted with `params` on the table with `fingerprint`
+
+    Returns None if no such variant has been stored. Structs are rebuilt with `struct` (hail's Struct by
+    default) so plateau_models supports both attribute and item access, as returned by build_models.
+    '''
+    path = os.path.join(store_dir, f'{model_key(params, fingerprint)}.json')
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        record = json.load(f)
+    if struct is None:
+        from hail.utils import Struct as struct
+    return tuple(_decode(record['coverage_model'])), _decode(record['plateau_models'], struct)
+
+
+def list_coverage_models(store_dir: str):
+    '''Parameters and source fingerprints of every stored model variant'''
+    records = []
+    for path in sorted(glob.glob(os.path.join(store_dir, '*.json'))):
+        with open(path) as f:
+            record = json.load(f)
+        records.append({'path': path, 'params': record['params'], 'fingerprint': record['fingerprint']})
+    return records
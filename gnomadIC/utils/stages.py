@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+
+class Stage:
+    '''
+    A pipeline stage whose completion is keyed by a hash of its inputs
+
+    :param name: Stage name (as used in --tasks)
+    :param func: Function running the stage, called without arguments
+    :param params: JSON-serialisable inputs that determine the stage output (intervals, dataset, model, ...)
+    :param upstream: Names of stages whose outputs this stage consumes
+    :param outputs: Paths that must exist for a completed stage to be reused
+    :param code: Source files whose contents version the stage
+    '''
+
+    def __init__(self, name: str, func: Callable[[], Any], params: Optional[Dict[str, Any]] = None,
+                 upstream: Sequence[str] = (), outputs: Sequence[str] = (), code: Sequence[str] = ()):
+        self.name = name
+        self.func = func
+        self.params = params or {}
+        self.upstream = list(upstream)
+        self.outputs = list(outputs)
+        self.code = list(code)
+
+    def __repr__(self):
+        return f'Stage(name={self.name}, upstream={self.upstream})'
+
+
+def code_version(files: Sequence[str]) -> str:
+    '''Hash of the contents of the given source files'''
+    digest = hashlib.sha256()
+    for path in sorted(files):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def stage_hash(stage: Stage, upstream_hashes: Dict[str, Optional[str]]) -> str:
+    '''Hash of everything that determines a stage's output: its params, code version and upstream hashes'''
+    key = {
+        'name': stage.name,
+        'params': stage.params,
+        'code': code_version(stage.code),
+        'upstream': {name: upstream_hashes.get(name) for name in stage.upstream}
+    }
+    return hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class StageManifest:
+    '''Record of completed stages and their hashes, stored as JSON next to the run outputs'''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.stages = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.stages = json.load(f)
+
+    def get_hash(self, name: str) -> Optional[str]:
+        return self.stages.get(name, {}).get('hash')
+
+    def is_complete(self, stage: Stage, hash: str) -> bool:
+        return self.get_hash(stage.name) == hash and all(os.path.exists(x) for x in stage.outputs)
+
+    def mark_complete(self, stage: Stage, hash: str, duration: float):
+        self.stages[stage.name] = {
+            'hash': hash,
+            'params': stage.params,
+            'upstream': stage.upstream,
+            'outputs': stage.outputs,
+            'completed': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'duration_s': round(duration, 1)
+        }
+        self.save()
+
+    def invalidate(self, name: str):
+        if self.stages.pop(name, None) is not None:
+            self.save()
+
+    def save(self):
+        # Write then rename so an interrupted run never leaves a truncated manifest
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.stages, f, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+
+def run_stages(stages: List[Stage], manifest_path: str, requested: Sequence[str], force: bool = False) -> Dict[str, str]:
+    '''
+    Run requested stages in order, skipping any completed earlier with the same hash
+
+    Stages that are not requested contribute the hash recorded when they last completed, since their outputs
+    on disk are what downstream stages read. A stage that reruns (because its hash changed or force is set)
+    invalidates every downstream stage: requested ones rerun even if their hash is unchanged, and the records
+    of the others are dropped so a later run reruns them. Returns the hash of every stage.
+    '''
+    manifest = StageManifest(manifest_path)
+    hashes = {}
+    # Stages rerun in this call, or left stale by an upstream stage that reran
+    rerun = set()
+    for stage in stages:
+        upstream_rerun = any(x in rerun for x in stage.upstream)
+        if stage.name not in requested:
+            if upstream_rerun:
+                print(f'Invalidating {stage.name}: an upstream stage reran')
+                manifest.invalidate(stage.name)
+                rerun.add(stage.name)
+            hashes[stage.name] = manifest.get_hash(stage.name)
+            continue
+        hashes[stage.name] = stage_hash(stage, hashes)
+        if not force and not upstream_rerun and manifest.is_complete(stage, hashes[stage.name]):
+            print(f'Skipping {stage.name}: up to date ({hashes[stage.name][:12]})')
+            continue
+        # Drop the record first so a crash mid-stage is never mistaken for a completed stage
+        manifest.invalidate(stage.name)
+        start = time.time()
+        stage.func()
+        manifest.mark_complete(stage, hashes[stage.name], time.time() - start)
+        rerun.add(stage.name)
+    return hashes
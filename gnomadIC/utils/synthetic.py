@@ -0,0 +1,247 @@
+import itertools
+import os
+import random
+from typing import Dict, List
+
+import hail as hl
+import pandas as pd
+
+from . import intervals
+from .utils import POPS
+
+# Synthetic gnomAD-like tables for offline runs and benchmarks
+# Genes are laid out round-robin over contigs 1-22, X and Y, GENE_SPACING apart from GENE_START, so the panel
+# covers autosomes, X/Y PAR (the first X and Y genes) and X/Y non-PAR regions
+
+GENE_START = 1_000_000
+GENE_SPACING = 50_000
+GENE_CONTIGS = intervals.CONTIGS_GRCH37[:24]
+# Keeps every gene within the shortest contig (21, ~48.1 Mb)
+MAX_GENES = len(GENE_CONTIGS) * ((48_000_000 - GENE_START) // GENE_SPACING)
+
+BASES = 'ACGT'
+TRANSCRIPTS_PER_GENE = 2
+# Consequence of each possible variant with its cumulative probability
+CONSEQUENCES = (
+    ('synonymous_variant', 0.28),
+    ('missense_variant', 0.90),
+    ('stop_gained', 0.95),
+    ('splice_donor_variant', 0.975),
+    ('splice_acceptor_variant', 1.0)
+)
+LOF_CONSEQUENCES = ('stop_gained', 'splice_donor_variant', 'splice_acceptor_variant')
+DOWNSAMPLINGS = (1000, 5000, 10000, 50000, 125748)
+SAMPLE_AN = 250_000
+COVERAGE_BINS = range(1, 101)
+
+
+def synthetic_gene_panel(n_genes: int, bases_per_gene: int = 300) -> pd.DataFrame:
+    '''Gene panel (symbol, contig, start, end) in the layout of run.get_gene_panel, sorted by position'''
+    assert 1 <= n_genes <= MAX_GENES, f'n_genes must be between 1 and {MAX_GENES}'
+    assert 1 <= bases_per_gene < GENE_SPACING, f'bases_per_gene must be below {GENE_SPACING}'
+    rows = []
+    for i in range(n_genes):
+        start = GENE_START + (i // len(GENE_CONTIGS)) * GENE_SPACING
+        rows.append({
+            'symbol': f'SYN{i:05d}',
+            'contig': GENE_CONTIGS[i % len(GENE_CONTIGS)],
+            'start': start,
+            'end': start + bases_per_gene - 1
+        })
+    panel = pd.DataFrame(rows)
+    panel['rank'] = panel['contig'].map(intervals.CONTIG_RANK)
+    return panel.sort_values(['rank', 'start']).drop(columns='rank').reset_index(drop=True)
+
+
+def _transcript_consequences(ht: hl.Table) -> hl.expr.ArrayExpression:
+    '''VEP transcript consequences (the fields read by data.process_table and vep.py) for each gene transcript'''
+    consequence = hl.case()
+    for name, cumulative_p in CONSEQUENCES:
+        consequence = consequence.when(ht._u_csq < cumulative_p, name)
+    consequence = consequence.default(CONSEQUENCES[-1][0])
+    is_lof = hl.literal(set(LOF_CONSEQUENCES)).contains(consequence)
+    is_missense = consequence == 'missense_variant'
+    protein_position = hl.int32(ht._offset // 3 + 1)
+    return hl.range(TRANSCRIPTS_PER_GENE).map(lambda t: hl.struct(
+        gene_symbol=ht._gene.symbol,
+        gene_id=hl.str('ENSG') + ht._gene.symbol,
+        transcript_id=hl.str('ENST') + ht._gene.symbol + '.' + hl.str(t),
+        canonical=hl.int32(t == 0),
+        biotype='protein_coding',
+        consequence_terms=[consequence],
+        amino_acids=(hl.case()
+            .when(consequence == 'synonymous_variant', 'A')
+            .when(is_missense, 'A/V')
+            .when(consequence == 'stop_gained', 'R/*')
+            .or_missing()),
+        protein_start=hl.or_missing(~is_lof | (consequence == 'stop_gained'), protein_position),
+        protein_end=hl.or_missing(~is_lof | (consequence == 'stop_gained'), protein_position),
+        hgvsp=hl.or_missing(consequence != 'splice_donor_variant',
+                            hl.str('ENSP') + ht._gene.symbol + '.' + hl.str(t) + ':p.' + hl.str(protein_position)),
+        lof=hl.or_missing(is_lof, hl.case()
+            .when(ht._u_mod < 0.85, 'HC')
+            .when(ht._u_mod < 0.95, 'LC')
+            .default('OS')),
+        lof_flags=hl.or_missing(is_lof, hl.if_else(ht._u_mod < 0.8, '', 'SINGLE_EXON')),
+        polyphen_prediction=hl.or_missing(is_missense, hl.case()
+            .when(ht._u_mod < 0.3, 'probably_damaging')
+            .when(ht._u_mod < 0.5, 'possibly_damaging')
+            .default('benign'))
+    ))
+
+
+def synthetic_context_table(panel: pd.DataFrame, n_partitions: int = None) -> hl.Table:
+    '''
+    Every possible SNV in the panel's genes, with the schema of the gnomAD GRCh37 VEP-annotated context table
+    (heptamer context, methylation, coverage and vep.transcript_consequences)
+    Random values follow Hail's global seed, so pass global_seed to hl.init for reproducible tables.
+    '''
+    bases_per_gene = int(panel['end'].iloc[0] - panel['start'].iloc[0] + 1)
+    genes = hl.literal([dict(symbol=row.symbol, contig=row.contig, start=int(row.start)) for row in panel.itertuples()],
+                       dtype=hl.tarray(hl.tstruct(symbol=hl.tstr, contig=hl.tstr, start=hl.tint32)))
+    n_sites = len(panel) * bases_per_gene
+    ht = hl.utils.range_table(n_sites, n_partitions or max(1, n_sites // 100_000))
+
+    # One heptamer per site, drawn as a single 14-bit integer and decoded base by base
+    ht = ht.annotate(_gene=genes[ht.idx // bases_per_gene], _offset=ht.idx % bases_per_gene,
+                     _context_code=hl.rand_int32(4 ** 7))
+    bases = hl.literal(list(BASES))
+    context = hl.delimit(hl.range(7).map(lambda i: bases[hl.bit_and(hl.bit_rshift(ht._context_code, 2 * (6 - i)), 3)]), '')
+    exome_median = hl.if_else(hl.rand_bool(0.02), 0, hl.min(100, hl.rand_pois(35)))
+    ht = ht.annotate(
+        locus=hl.locus(ht._gene.contig, ht._gene.start + hl.int32(ht._offset), 'GRCh37'),
+        context=context,
+        methylation=hl.struct(MEAN=hl.rand_unif(0, 1)),
+        coverage=hl.struct(
+            exomes=hl.struct(mean=hl.float64(exome_median), median=hl.int32(exome_median)),
+            genomes=hl.struct(mean=hl.float64(30), median=hl.int32(30))
+        ),
+        _ref_code=hl.bit_and(hl.bit_rshift(ht._context_code, 6), 3),
+        _alt_offset=hl.range(1, 4)
+    )
+
+    # Three possible alternate alleles per site, each with its own consequence
+    ht = ht.explode('_alt_offset')
+    ht = ht.annotate(
+        alleles=[bases[ht._ref_code], bases[(ht._ref_code + ht._alt_offset) % 4]],
+        _u_csq=hl.rand_unif(0, 1),
+        _u_mod=hl.rand_unif(0, 1)
+    )
+    ht = ht.annotate(vep=hl.struct(transcript_consequences=_transcript_consequences(ht)))
+    ht = ht.key_by('locus', 'alleles')
+    return ht.select('context', 'methylation', 'coverage', 'vep')
+
+
+def freq_meta() -> List[Dict[str, str]]:
+    '''Frequency metadata: adj and raw, adj by population, then adj downsamplings by population'''
+    meta = [{'group': 'adj'}, {'group': 'raw'}]
+    meta += [{'group': 'adj', 'pop': pop} for pop in POPS if pop != 'global']
+    meta += [{'group': 'adj', 'pop': pop, 'downsampling': str(n)} for pop in POPS for n in DOWNSAMPLINGS]
+    return meta
+
+
+def synthetic_exome_table(context_ht: hl.Table, p_observed: float = 0.15, p_common: float = 0.02) -> hl.Table:
+    '''
+    Observed variants sampled from a context table, with the exomes_processed.ht schema (context fields plus
+    freq, filters and the freq_meta/freq_index_dict globals)
+    Variants are observed with probability p_observed scaled down at low coverage; p_common of them are common.
+    '''
+    meta = freq_meta()
+    # Expected share of the full sample's allele count in each frequency entry
+    def fraction(m):
+        if 'downsampling' in m:
+            return int(m['downsampling']) / DOWNSAMPLINGS[-1]
+        return 1 / len(POPS) if 'pop' in m else 1.0
+    fractions = [fraction(m) for m in meta]
+    coverage = context_ht.coverage.exomes.median
+    ht = context_ht.filter(hl.rand_bool(p_observed * hl.min(1, coverage / 30)))
+    ht = ht.annotate(_ac=hl.if_else(hl.rand_bool(p_common), hl.rand_int32(300, 5000), 1 + hl.int32(hl.rand_pois(0.3))))
+    ht = ht.annotate(
+        freq=hl.literal(fractions).map(lambda f: hl.bind(
+            lambda ac: hl.struct(AC=ac, AF=ac / SAMPLE_AN, AN=SAMPLE_AN, homozygote_count=hl.int32(0)),
+            hl.if_else(f >= 1, ht._ac, hl.min(ht._ac, hl.int32(hl.rand_pois(ht._ac * f))))
+        )),
+        filters=hl.if_else(hl.rand_bool(0.05), hl.set(['RF']), hl.empty_set(hl.tstr))
+    ).drop('_ac')
+    freq_index = {'gnomad': 0, 'gnomad_raw': 1, 'non_neuro': 0, 'non_cancer': 0, 'controls': 0}
+    freq_index.update({f'gnomad_{m["pop"]}': i for i, m in enumerate(meta) if set(m) == {'group', 'pop'}})
+    return ht.annotate_globals(freq_meta=meta, freq_index_dict=freq_index)
+
+
+def mutation_rates(context_length: int = 3, seed: int = 0) -> List[Dict]:
+    '''Mutation rate rows for every strand-collapsed context (ref A or C), alt and methylation level'''
+    rng = random.Random(seed)
+    mid_index = context_length // 2
+    rows = []
+    for context in map(''.join, itertools.product(BASES, repeat=context_length)):
+        ref = context[mid_index]
+        if ref not in 'AC':
+            continue
+        for alt in BASES:
+            if alt == ref:
+                continue
+            transition = (ref, alt) in (('A', 'G'), ('C', 'T'))
+            cpg = ref == 'C' and alt == 'T' and context[mid_index + 1] == 'G'
+            jitter = rng.uniform(0.5, 1.5)
+            for methylation_level in range(3):
+                if cpg:
+                    mu = 2e-8 * (1 + 2 * methylation_level)
+                else:
+                    mu = 4e-9 if transition else 1.5e-9
+                rows.append(dict(context=context, ref=ref, alt=alt, methylation_level=methylation_level, mu_snp=mu * jitter))
+    return rows
+
+
+def synthetic_mutation_rate_table(context_length: int = 3, seed: int = 0) -> hl.Table:
+    '''Table with the schema of mutation_rate_methylation_bins.ht'''
+    schema = hl.tstruct(context=hl.tstr, ref=hl.tstr, alt=hl.tstr, methylation_level=hl.tint32, mu_snp=hl.tfloat64)
+    ht = hl.Table.parallelize(mutation_rates(context_length, seed), schema)
+    return ht.key_by('context', 'ref', 'alt', 'methylation_level')
+
+
+def synthetic_coverage_table(mutation_ht: hl.Table, mean_possible: int = 2000) -> hl.Table:
+    '''
+    Table with the schema of the proportion-observed-by-coverage table used by utils.build_models
+    Observed counts saturate with mutation rate and fall off below 40x coverage, so both models are identifiable.
+    '''
+    ht = mutation_ht.key_by().annotate(exome_coverage=hl.literal(list(COVERAGE_BINS)))
+    ht = ht.explode('exome_coverage')
+    coverage_factor = hl.min(1, hl.log10(ht.exome_coverage) / hl.log10(40))
+    ht = ht.annotate(possible_variants=hl.int64(1 + hl.rand_pois(mean_possible)))
+    ht = ht.annotate(variant_count=hl.int64(hl.rand_pois(
+        ht.possible_variants * hl.min(0.95, ht.mu_snp * 1.5e7) * coverage_factor)))
+    fractions = [n / DOWNSAMPLINGS[-1] for n in DOWNSAMPLINGS]
+    ht = ht.annotate(**{
+        f'downsampling_counts_{pop}': hl.literal(fractions).map(lambda f: hl.int64(hl.rand_pois(ht.variant_count * f)))
+        for pop in POPS
+    })
+    return ht.key_by('context', 'ref', 'alt', 'methylation_level', 'exome_coverage')
+
+
+def write_synthetic_dataset(root: str, n_genes: int, bases_per_gene: int = 300, overwrite: bool = False) -> Dict[str, str]:
+    '''
+    Write synthetic context, exome, mutation rate and coverage tables (plus the gene panel) under `root`
+    Returns paths under the keys used by run.setup_paths; existing tables are reused unless overwrite is set.
+    '''
+    paths = dict(
+        context_path=f'{root}/context.ht',
+        exomes_path=f'{root}/exomes.ht',
+        mutation_rate_path=f'{root}/mutation_rate.ht',
+        po_coverage_path=f'{root}/po_coverage.ht',
+        gene_panel_path=f'{root}/gene_panel.csv'
+    )
+    os.makedirs(root, exist_ok=True)
+    panel = synthetic_gene_panel(n_genes, bases_per_gene)
+    panel.to_csv(paths['gene_panel_path'], index=False)
+
+    def missing(path):
+        return overwrite or not os.path.isfile(f'{path}/_SUCCESS')
+    if missing(paths['context_path']):
+        synthetic_context_table(panel).write(paths['context_path'], overwrite=True)
+    if missing(paths['exomes_path']):
+        synthetic_exome_table(hl.read_table(paths['context_path'])).write(paths['exomes_path'], overwrite=True)
+    if missing(paths['mutation_rate_path']):
+        synthetic_mutation_rate_table().write(paths['mutation_rate_path'], overwrite=True)
+    if missing(paths['po_coverage_path']):
+        synthetic_coverage_table(hl.read_table(paths['mutation_rate_path'])).write(paths['po_coverage_path'], overwrite=True)
+    return paths
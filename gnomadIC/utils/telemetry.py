@@ -0,0 +1,305 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import urllib.request
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger("gnomadIC.telemetry")
+
+# Task metrics summed over a step's Spark stages (names as in the Spark monitoring REST API)
+SPARK_STAGE_METRICS = ('executorRunTime', 'executorCpuTime', 'inputBytes', 'outputBytes', 'shuffleReadBytes',
+                       'shuffleWriteBytes', 'memoryBytesSpilled', 'diskBytesSpilled')
+
+_active_report = None
+
+
+class RunReport:
+    '''
+    Structured record of a run: one entry per step with wall time, rows in and out, partitions, bytes written
+    per output path and the Spark jobs, stages, tasks and task metrics the step triggered
+
+    Steps nest (e.g. model/get_expected_variants); steps started from worker threads nest under the step that
+    was open on the thread that started the run. The report is rewritten after every step, so a failed run
+    still leaves a report of everything up to the failure.
+
+    :param path: JSON file the report is written to
+    :param params: Run parameters to record alongside the steps
+    :param spark_metrics: Whether to collect Spark job and task metrics (needs the Spark backend)
+    '''
+
+    def __init__(self, path: str, params: Optional[Dict[str, Any]] = None, spark_metrics: bool = True):
+        self.path = path
+        self.params = params or {}
+        self.spark_metrics = spark_metrics
+        self.started = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.finished = None
+        self.steps = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._root_thread = threading.get_ident()
+        self._root_stack = []
+        self._n_steps = 0
+
+    def __repr__(self):
+        return f'RunReport(path={self.path},n_steps={len(self.steps)})'
+
+    def _stack(self) -> List[Dict]:
+        if threading.get_ident() == self._root_thread:
+            return self._root_stack
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def current(self) -> Optional[Dict]:
+        stack = self._stack()
+        if stack:
+            return stack[-1]
+        return self._root_stack[-1] if self._root_stack else None
+
+    @contextlib.contextmanager
+    def step(self, name: str, **info):
+        parent = self.current()
+        with self._lock:
+            self._n_steps += 1
+            entry = {
+                'name': name,
+                'path': f'{parent["path"]}/{name}' if parent else name,
+                'thread': threading.current_thread().name,
+                'start': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'wall_s': None,
+                'status': 'running',
+                'inputs': {},
+                'outputs': {},
+                '_job_group': f'gnomadIC-{os.getpid()}-{self._n_steps}',
+                **info
+            }
+            self.steps.append(entry)
+        stack = self._stack()
+        stack.append(entry)
+        self._set_job_group(entry['_job_group'], entry['path'])
+        start = time.time()
+        try:
+            yield entry
+            entry['status'] = 'ok'
+        except BaseException as error:
+            entry['status'] = 'failed'
+            entry['error'] = f'{type(error).__name__}: {error}'
+            raise
+        finally:
+            entry['wall_s'] = round(time.time() - start, 3)
+            stack.pop()
+            if self.spark_metrics:
+                entry['spark'] = _spark_job_metrics(entry['_job_group'])
+            # Restore the enclosing step's job group for the jobs that follow
+            parent = self.current() if stack else None
+            self._set_job_group(parent['_job_group'] if parent else None, parent['path'] if parent else None)
+            self.save()
+
+    def _set_job_group(self, group: Optional[str], description: Optional[str]):
+        if not self.spark_metrics:
+            return
+        try:
+            import hail as hl
+            sc = hl.spark_context()
+            if group is None:
+                sc.setLocalProperty('spark.jobGroup.id', None)
+            else:
+                sc.setJobGroup(group, description)
+        except Exception:  # not the Spark backend, or Hail not initialised
+            pass
+
+    def record(self, **fields):
+        '''Add fields (e.g. rows_in, rows_out, partitions) to the innermost open step'''
+        step = self.current()
+        if step is not None:
+            step.update(fields)
+
+    def record_input(self, path: str, count_rows: bool = True):
+        '''Record bytes, rows and partitions of a table (or file) read by the innermost open step'''
+        step = self.current()
+        if step is not None:
+            step['inputs'][path] = describe_path(path, count_rows=count_rows)
+
+    def record_output(self, path: str, count_rows: bool = True):
+        '''Record bytes, rows and partitions of a table (or file) written by the innermost open step'''
+        step = self.current()
+        if step is not None:
+            step['outputs'][path] = describe_path(path, count_rows=count_rows)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'started': self.started,
+            'finished': self.finished,
+            'params': self.params,
+            'steps': [{k: v for k, v in step.items() if not k.startswith('_')} for step in self.steps]
+        }
+
+    def save(self):
+        with self._lock:
+            report = self.to_dict()
+            tmp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(report, f, indent=2, default=str)
+            os.replace(tmp_path, self.path)
+
+
+def describe_path(path: str, count_rows: bool = True) -> Dict[str, Any]:
+    '''Bytes on disk of a file or table directory, plus rows and partitions if it is a Hail table'''
+    from .mirror import _list_files, _is_local, _strip_scheme
+    if _is_local(path) and os.path.isfile(_strip_scheme(path)):
+        return {'bytes': os.path.getsize(_strip_scheme(path))}
+    description = {'bytes': sum(size for _, size in _list_files(path))}
+    if count_rows:
+        try:
+            import hail as hl
+            ht = hl.read_table(path)
+            # Row counts of a written table come from its stored partition counts
+            description.update(rows=ht.count(), partitions=ht.n_partitions())
+        except Exception:
+            pass
+    return description
+
+
+def _spark_job_metrics(job_group: str) -> Optional[Dict[str, Any]]:
+    '''Jobs, stages, tasks and summed task metrics of the Spark jobs run under `job_group`'''
+    try:
+        import hail as hl
+        sc = hl.spark_context()
+        tracker = sc.statusTracker()
+        job_ids = tracker.getJobIdsForGroup(job_group)
+    except Exception:
+        return None
+    stage_ids = []
+    for job_id in job_ids:
+        job = tracker.getJobInfo(job_id)
+        if job is not None:
+            stage_ids += list(job.stageIds)
+    metrics = {'jobs': len(job_ids), 'stages': len(stage_ids), 'tasks': 0, 'failed_tasks': 0}
+    for stage_id in stage_ids:
+        stage = tracker.getStageInfo(stage_id)
+        if stage is not None:
+            metrics['tasks'] += stage.numTasks
+            metrics['failed_tasks'] += stage.numFailedTasks
+    metrics.update(_spark_stage_task_metrics(sc, stage_ids))
+    return metrics
+
+
+def _spark_stage_task_metrics(sc, stage_ids: List[int]) -> Dict[str, int]:
+    '''Sum task metrics over stages from the Spark UI's REST API (empty if the UI is unavailable)'''
+    if not stage_ids or not sc.uiWebUrl:
+        return {}
+    totals = dict.fromkeys(SPARK_STAGE_METRICS, 0)
+    try:
+        for stage_id in stage_ids:
+            url = f'{sc.uiWebUrl}/api/v1/applications/{sc.applicationId}/stages/{stage_id}'
+            with urllib.request.urlopen(url, timeout=5) as response:
+                for attempt in json.load(response):
+                    for name in SPARK_STAGE_METRICS:
+                        totals[name] += attempt.get(name, 0)
+    except Exception as error:
+        logger.debug('Could not read Spark stage metrics: %s', error)
+        return {}
+    return totals
+
+
+def start_run(path: str, params: Optional[Dict[str, Any]] = None, spark_metrics: bool = True) -> RunReport:
+    '''Start the run report that step() and record() write to'''
+    global _active_report
+    _active_report = RunReport(path, params=params, spark_metrics=spark_metrics)
+    _active_report.save()
+    return _active_report
+
+
+def end_run():
+    global _active_report
+    if _active_report is not None:
+        _active_report.finished = time.strftime('%Y-%m-%d %H:%M:%S')
+        _active_report.save()
+    _active_report = None
+
+
+def active_report() -> Optional[RunReport]:
+    return _active_report
+
+
+@contextlib.contextmanager
+def step(name: str, **info):
+    '''Record a step in the active run report (does nothing if no run report has been started)'''
+    if _active_report is None:
+        yield None
+    else:
+        with _active_report.step(name, **info) as entry:
+            yield entry
+
+
+def traced(name: Optional[str] = None):
+    '''Decorator recording each call of a function as a step (named after the function by default)'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with step(name or func.__name__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record(**fields):
+    if _active_report is not None:
+        _active_report.record(**fields)
+
+
+def record_input(path: str, count_rows: bool = True):
+    if _active_report is not None:
+        _active_report.record_input(path, count_rows=count_rows)
+
+
+def record_output(path: str, count_rows: bool = True):
+    if _active_report is not None:
+        _active_report.record_output(path, count_rows=count_rows)
+
+
+def _rows(step: Dict[str, Any], direction: str) -> Optional[int]:
+    '''Rows in or out of a step: recorded explicitly, or summed over its recorded tables'''
+    if step.get(f'rows_{direction}') is not None:
+        return step[f'rows_{direction}']
+    tables = step.get('inputs' if direction == 'in' else 'outputs', {}).values()
+    counts = [x['rows'] for x in tables if 'rows' in x]
+    return sum(counts) if counts else None
+
+
+def compare_reports(path_a: str, path_b: str):
+    '''
+    Side-by-side comparison of two run reports, one row per step path, with the wall time ratio (b / a)
+    Returns a pandas DataFrame sorted by the largest slowdown.
+    '''
+    import pandas as pd
+    frames = []
+    for label, path in (('a', path_a), ('b', path_b)):
+        with open(path) as f:
+            steps = json.load(f)['steps']
+        frame = pd.DataFrame([{
+            'path': step['path'],
+            'wall_s': step['wall_s'],
+            'rows_in': _rows(step, 'in'),
+            'rows_out': _rows(step, 'out'),
+            'bytes_written': sum(x.get('bytes', 0) for x in step['outputs'].values()),
+            'tasks': (step.get('spark') or {}).get('tasks')
+        } for step in steps])
+        # Steps that run more than once (e.g. per region) are summed
+        frames.append(frame.groupby('path').sum(min_count=1).add_suffix(f'_{label}'))
+    comparison = frames[0].join(frames[1], how='outer')
+    comparison['wall_ratio'] = comparison['wall_s_b'] / comparison['wall_s_a']
+    return comparison.sort_values('wall_ratio', ascending=False)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare two run reports step by step')
+    parser.add_argument('report_a')
+    parser.add_argument('report_b')
+    args = parser.parse_args()
+    print(compare_reports(args.report_a, args.report_b).to_string())
@@ -1,48 +1,138 @@
 from .vep import *
+import functools
 import hail as hl
+import itertools
+import numpy as np
 import os
-import copy
+import pandas as pd
+from scipy import special
 from typing import Dict, List, Optional, Set, Tuple, Any
 
 HIGH_COVERAGE_CUTOFF = 40
 POPS = ('global', 'afr', 'amr', 'eas', 'nfe', 'sas')
+# Row number added to a table whose rows are collected, so driver-side results join back on it (see _collect_frame)
+ROW_INDEX = '_row_idx'
 
 
 
 # Model building
 
-def build_models(coverage_ht: hl.Table, trimers: bool = False, weighted: bool = False, half_cutoff = False
+def build_models(coverage_ht: hl.Table, trimers: bool = False, weighted: bool = False, half_cutoff = False, pops = False
                  ) -> Tuple[Tuple[float, float], Dict[str, Tuple[float, float]]]:
-    keys = ['context', 'ref', 'alt', 'methylation_level', 'mu_snp']
-
     cov_cutoff = (HIGH_COVERAGE_CUTOFF / half_cutoff) if half_cutoff else HIGH_COVERAGE_CUTOFF
-    all_high_coverage_ht = coverage_ht.filter(coverage_ht.exome_coverage >= cov_cutoff)
-    agg_expr = {
-        'observed_variants': hl.agg.sum(all_high_coverage_ht.variant_count),
-        'possible_variants': hl.agg.sum(all_high_coverage_ht.possible_variants)
-    }
-    for pop in POPS:
-        agg_expr[f'observed_{pop}'] = hl.agg.array_sum(all_high_coverage_ht[f'downsampling_counts_{pop}'])
-    high_coverage_ht = all_high_coverage_ht.group_by(*keys).aggregate(**agg_expr)
-
-    high_coverage_ht = annotate_variant_types(high_coverage_ht, not trimers)
-    #plateau_models = build_plateau_models(high_coverage_ht)
-    plateau_models = build_plateau_models_pop(high_coverage_ht, weighted=weighted) 
+    return build_models_sweep(coverage_ht, [cov_cutoff], trimers=trimers, weighted=weighted, pops=pops)[cov_cutoff]
 
-    high_coverage_scale_factor = all_high_coverage_ht.aggregate(
-        hl.agg.sum(all_high_coverage_ht.variant_count) /
-        hl.agg.sum(all_high_coverage_ht.possible_variants * all_high_coverage_ht.mu_snp))
 
-    all_low_coverage_ht = coverage_ht.filter((coverage_ht.exome_coverage < cov_cutoff) &
-                                              (coverage_ht.exome_coverage > 0))
-
-    low_coverage_ht = all_low_coverage_ht.group_by(log_coverage=hl.log10(all_low_coverage_ht.exome_coverage)).aggregate(
-         low_coverage_obs_exp=hl.agg.sum(all_low_coverage_ht.variant_count) /
-                              (high_coverage_scale_factor * hl.agg.sum(all_low_coverage_ht.possible_variants * all_low_coverage_ht.mu_snp)))
-    coverage_model = build_coverage_model(low_coverage_ht)
-    # # TODO: consider weighting here as well
-
-    return coverage_model, plateau_models
+def build_models_sweep(coverage_ht: hl.Table, cutoffs: List[float] = (HIGH_COVERAGE_CUTOFF,), trimers: bool = False,
+                       weighted: bool = False, pops = False) -> Dict[float, Tuple[Tuple[float, float], Any]]:
+    """
+    Coverage and plateau models for each of several high coverage cutoffs, from a single scan of the coverage table
+    Returns {cutoff: (coverage_model, plateau_models)}, each as build_models returns it.
+    The scan sums observed and possible variants by mutation and by band of coverage between consecutive cutoffs,
+    and by coverage below the highest cutoff. Sums over the bands above a cutoff give its plateau models and scale
+    factor, and the sums below it its coverage model, so every cutoff is fitted on the driver (fit_models_from_sums).
+    """
+    cutoffs = sorted(set(cutoffs))
+    keys = ['context', 'ref', 'alt', 'methylation_level', 'mu_snp']
+    ht = annotate_variant_types(coverage_ht, not trimers)
+    # Index of the highest cutoff the coverage reaches (-1 below all of them)
+    band = hl.len(hl.literal(cutoffs).filter(lambda cutoff: ht.exome_coverage >= cutoff)) - 1
+    high_expr = {
+        'observed_variants': hl.agg.sum(ht.variant_count),
+        'possible_variants': hl.agg.sum(ht.possible_variants)
+    }
+    if pops:
+        for pop in POPS:
+            high_expr[f'observed_{pop}'] = hl.agg.array_sum(ht[f'downsampling_counts_{pop}'])
+    sums = ht.aggregate(hl.struct(
+        high=hl.agg.filter(band >= 0, hl.agg.group_by(
+            hl.struct(**{k: ht[k] for k in keys}, cpg=ht.cpg, band=band), hl.struct(**high_expr))),
+        low=hl.agg.filter((ht.exome_coverage > 0) & (ht.exome_coverage < cutoffs[-1]), hl.agg.group_by(
+            ht.exome_coverage, hl.struct(
+                observed_variants=hl.agg.sum(ht.variant_count),
+                mu_possible=hl.agg.sum(ht.possible_variants * ht.mu_snp))))
+    ))
+    return fit_models_from_sums(sums.high, sums.low, cutoffs, weighted=weighted, pops=pops)
+
+
+def fit_models_from_sums(high: Dict, low: Dict, cutoffs: List[float], weighted: bool = False, pops = False
+                         ) -> Dict[float, Tuple[Tuple[float, float], Any]]:
+    """
+    Fit the models of each cutoff from the sums of build_models_sweep with NumPy
+    high maps (mutation fields, mu_snp, cpg, band) to observed and possible variant sums, low maps coverage to
+    observed variants and possible variants x mu_snp. Every regression (each cpg group of the plateau models, and
+    with pops each population x downsampling) is solved from its sufficient statistics (regression_by_group) rather
+    than one hl.agg.linreg per regression, and matches hl.agg.linreg as in build_coverage_model.
+    """
+    cutoffs = sorted(cutoffs)
+    pop_names = list(POPS) if pops else []
+    mutations = {}
+    for key in high:
+        mutations.setdefault((key.context, key.ref, key.alt, key.methylation_level, key.mu_snp, key.cpg), len(mutations))
+    n_mutations, n_bands = len(mutations), len(cutoffs)
+    present = np.zeros((n_mutations, n_bands), dtype=bool)
+    observed = np.zeros((n_mutations, n_bands))
+    possible = np.zeros((n_mutations, n_bands))
+    pop_observed = {}
+    for key, value in high.items():
+        i = mutations[(key.context, key.ref, key.alt, key.methylation_level, key.mu_snp, key.cpg)]
+        present[i, key.band] = True
+        observed[i, key.band] += value.observed_variants
+        possible[i, key.band] += value.possible_variants
+        for pop in pop_names:
+            counts = value[f'observed_{pop}']
+            if counts is None:
+                continue
+            if pop not in pop_observed:
+                pop_observed[pop] = np.zeros((n_mutations, n_bands, len(counts)))
+            pop_observed[pop][i, key.band] += counts
+    mu = np.array([x[4] for x in mutations], dtype=float)
+    cpgs = [x[5] for x in mutations]
+
+    # Sums over coverage at or above each cutoff
+    def above(x):
+        return np.flip(np.cumsum(np.flip(x, axis=1), axis=1), axis=1)
+    present, observed, possible = above(present) > 0, above(observed), above(possible)
+    pop_observed = {pop: above(x) for pop, x in pop_observed.items()}
+
+    coverages = sorted(low)
+    log_coverage = np.log10(np.array(coverages, dtype=float))
+    low_observed = np.array([low[x].observed_variants for x in coverages], dtype=float)
+    low_mu_possible = np.array([low[x].mu_possible for x in coverages], dtype=float)
+
+    models = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for k, cutoff in enumerate(cutoffs):
+            rows = present[:, k]
+            weight = possible[rows, k] if weighted else np.ones(rows.sum())
+            groups = [x for x, row in zip(cpgs, rows) if row]
+            responses = {'total': (observed[rows, k] / possible[rows, k])[:, None]}
+            for pop, counts in pop_observed.items():
+                responses[pop] = counts[rows, k] / possible[rows, k][:, None]
+            plateau_models = {}
+            for name, y in responses.items():
+                betas = {group: regression_by_group(y, mu[rows], weight, groups, group) for group in dict.fromkeys(groups)}
+                fits = [{group: beta[i].tolist() for group, beta in betas.items()} for i in range(y.shape[1])]
+                plateau_models[name] = fits[0] if name == 'total' else fits
+
+            scale_factor = observed[rows, k].sum() / (possible[rows, k] * mu[rows]).sum()
+            below = log_coverage < np.log10(cutoff)
+            low_obs_exp = low_observed[below] / (scale_factor * low_mu_possible[below])
+            coverage_model = regression_by_group(low_obs_exp[:, None], log_coverage[below], np.ones(below.sum()),
+                                                 [None] * below.sum(), None)[0]
+            models[cutoff] = (tuple(coverage_model.tolist()), hl.Struct(**plateau_models))
+    return models
+
+
+def regression_by_group(y: np.ndarray, x: np.ndarray, weight: np.ndarray, groups: List, group) -> np.ndarray:
+    """[intercept, slope] of the weighted regression of each column of y on x, over the rows in the given group"""
+    rows = np.array([g == group for g in groups], dtype=bool).reshape(len(groups))
+    w, x, y = weight[rows][:, None], x[rows][:, None], y[rows]
+    sums = np.stack([
+        np.broadcast_to(w, y.shape).sum(axis=0), np.broadcast_to(w * x, y.shape).sum(axis=0),
+        np.broadcast_to(w * x * x, y.shape).sum(axis=0), (w * y).sum(axis=0), (w * x * y).sum(axis=0)
+    ], axis=-1)
+    return solve_regressions(sums)
 
 def build_coverage_model(coverage_ht: hl.Table) -> Tuple[float, float]:
     """
@@ -64,36 +154,21 @@ def build_plateau_models(ht: hl.Table, weighted: bool = False) -> Dict[str, Tupl
     return ht
                                         
                                        
-def build_plateau_models_pop(ht: hl.Table, weighted: bool = False, pops=False) -> Dict[str, Tuple[float, float]]:
+def solve_regressions(sums: np.ndarray) -> np.ndarray:
     """
-    Calibrates high coverage model (returns intercept and slope)
+    Intercepts and slopes of weighted least squares regressions from their sufficient statistics
+    sums has (sum of w, wx, wx^2, wy, wxy) along its last axis; returns [intercept, slope] along the last axis,
+    NaN where x does not vary
     """
-    # For the moment, population-level plateau model calculations have been removed as they caused segmentation faults
-
-    agg_expr = {}
-    if pops:
-        pop_lengths = get_all_pop_lengths(ht)
-        for length, pop in pop_lengths:
-            agg_expr[pop] = [
-                hl.agg.group_by(
-                    ht.cpg,
-                    hl.agg.linreg(ht[f'observed_{pop}'][i] / ht.possible_variants, [1, ht.mu_snp],weight=ht.possible_variants if weighted else None)
-                ).map_values(lambda x: x.beta) \
-                for i in range(length)
-                ]
-            
-    agg_expr['total'] = (
-        hl.agg.group_by(
-            ht.cpg,
-            hl.agg.linreg(
-                ht.observed_variants / ht.possible_variants, 
-                [1, ht.mu_snp], 
-                weight=ht.possible_variants if weighted else None
-            )
-        ).map_values(lambda x: x.beta)
-    )
-        
-    return ht.aggregate(hl.struct(**agg_expr))
+    sw, sx, sxx, sy, sxy = np.moveaxis(sums, -1, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        det = sw * sxx - sx * sx
+        intercept = (sxx * sy - sx * sxy) / det
+        slope = (sw * sxy - sx * sy) / det
+    singular = det == 0
+    intercept[singular] = np.nan
+    slope[singular] = np.nan
+    return np.stack([intercept, slope], axis=-1)
 
 
 def get_all_pop_lengths(ht, prefix: str = 'observed_', pops: List[str] = POPS, skip_assertion: bool = False):
@@ -143,19 +218,70 @@ def collapse_strand(ht: Union[hl.Table, hl.MatrixTable]) -> Union[hl.Table, hl.M
     return ht.annotate(**collapse_expr) if isinstance(ht, hl.Table) else ht.annotate_rows(**collapse_expr)
 
 
-def prepare_ht(ht, trimer: bool = False, annotate_coverage: bool = True):
+# Strand collapsing by lookup
+# Every SNV in a 7-base (or, for trimers, 3-base) context, keyed by context + ref + alt, maps to its
+# strand-collapsed context, ref, alt and whether it was flipped: 49,152 heptamer or 192 trimer entries
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+STRAND_COLLAPSE_TYPE = hl.tdict(hl.tstr, hl.tstruct(context=hl.tstr, ref=hl.tstr, alt=hl.tstr, was_flipped=hl.tbool))
+
+
+@functools.lru_cache()
+def strand_collapse_table(trimer: bool = False) -> Dict[str, hl.Struct]:
+    '''
+    Collapsed form of every SNV by context + ref + alt (Python version of collapse_strand)
+    With trimer only trimers are keyed, so heptamers are trimmed first (see strand_collapse_key) and
+    only the trimer must be ACGT, as with trimer_from_heptamer
+    '''
+    table = {}
+    context_length = 3 if trimer else 7
+    mid_index = context_length // 2
+    for context in map(''.join, itertools.product('ACGT', repeat=context_length)):
+        ref = context[mid_index]
+        for alt in 'ACGT':
+            if alt == ref:
+                continue
+            was_flipped = ref in ('G', 'T')
+            table[context + ref + alt] = hl.Struct(
+                context=''.join(COMPLEMENT[x] for x in reversed(context)) if was_flipped else context,
+                ref=COMPLEMENT[ref] if was_flipped else ref,
+                alt=COMPLEMENT[alt] if was_flipped else alt,
+                was_flipped=was_flipped
+            )
+    return table
+
+
+def strand_collapse_key(context: hl.expr.StringExpression, ref: hl.expr.StringExpression,
+                        alt: hl.expr.StringExpression, trimer: bool = False) -> hl.expr.StringExpression:
+    '''Key of a variant in strand_collapse_table: its context (trimmed from a heptamer if trimer) + ref + alt'''
     if trimer:
-        ht = trimer_from_heptamer(ht)
-    str_len = 3 if trimer else 7
+        context = hl.cond(hl.len(context) == 7, context[2:5], context)
+    return context + ref + alt
 
+
+def prepare_ht(ht, trimer: bool = False, annotate_coverage: bool = True, packed: bool = False):
+    '''
+    Strand-collapses contexts (trimmed to trimers if trimer) with one lookup per row in strand_collapse_table;
+    rows that are not SNVs in an ACGT context have no entry and are dropped
+    packed replaces the context, ref and alt strings (and methylation_level) with a single integer
+    mutation_code (see mutation_code_expr), from which annotate_variant_types reads cpg and transition
+    '''
+    str_len = 3 if trimer else 7
+    lookup = hl.literal(strand_collapse_table(trimer), dtype=STRAND_COLLAPSE_TYPE)
+    collapsed = lookup.get(strand_collapse_key(ht.context, ht.alleles[0], ht.alleles[1], trimer))
     if isinstance(ht, hl.Table): 
-        ht = ht.annotate(ref=ht.alleles[0], alt=ht.alleles[1])
-        ht = ht.filter((hl.len(ht.ref) == 1) & (hl.len(ht.alt) == 1) & ht.context.matches(f'[ATCG]{{{str_len}}}'))
-        ht = annotate_variant_types(collapse_strand(ht), not trimer)
+        ht = ht.annotate(_collapsed=collapsed)
+        ht = ht.filter(hl.is_defined(ht._collapsed))
+        ht = ht.transmute(**ht._collapsed)
     else: # handle case where ht is a matrix table
-        ht = ht.annotate_rows(ref=ht.alleles[0], alt=ht.alleles[1])
-        ht = ht.filter_rows((hl.len(ht.ref) == 1) & (hl.len(ht.alt) == 1) & ht.context.matches(f'[ATCG]{{{str_len}}}'))
-        ht = annotate_variant_types(collapse_strand(ht), not trimer)
+        ht = ht.annotate_rows(_collapsed=collapsed)
+        ht = ht.filter_rows(hl.is_defined(ht._collapsed))
+        ht = ht.transmute_rows(**ht._collapsed)
+    if packed:
+        # Pack with methylation level 0 to find CpGs, then add the methylation level to the code
+        code = {'mutation_code': mutation_code_expr(ht.context, ht.alt, 0, str_len)}
+        ht = ht.annotate(**code) if isinstance(ht, hl.Table) else ht.annotate_rows(**code)
+    ht = annotate_variant_types(ht, not trimer, packed=packed)
     annotation = {
         'methylation_level': hl.case().when(
             ht.cpg & (ht.methylation.MEAN > 0.6), 2
@@ -163,24 +289,42 @@ def prepare_ht(ht, trimer: bool = False, annotate_coverage: bool = True):
             ht.cpg & (ht.methylation.MEAN > 0.2), 1
         ).default(0)
     }
+    if packed:
+        annotation = {'mutation_code': ht.mutation_code + annotation['methylation_level']}
     if annotate_coverage:
         annotation['exome_coverage'] = ht.coverage.exomes.median
-    return ht.annotate(**annotation) if isinstance(ht, hl.Table) else ht.annotate_rows(**annotation)
+    ht = ht.annotate(**annotation) if isinstance(ht, hl.Table) else ht.annotate_rows(**annotation)
+    if packed:
+        ht = ht.drop('context', 'ref', 'alt')
+    return ht
 
 def trimer_from_heptamer(t: Union[hl.MatrixTable, hl.Table]) -> Union[hl.MatrixTable, hl.Table]:
     trimer_expr = hl.cond(hl.len(t.context) == 7, t.context[2:5], t.context)
     return t.annotate_rows(context=trimer_expr) if isinstance(t, hl.MatrixTable) else t.annotate(context=trimer_expr)
 
 def annotate_variant_types(t: Union[hl.MatrixTable, hl.Table],
-                           heptamers: bool = False) -> Union[hl.MatrixTable, hl.Table]:
+                           heptamers: bool = False, packed: bool = False) -> Union[hl.MatrixTable, hl.Table]:
     """
     Adds cpg, transition, and variant_type, variant_type_model columns
+    With packed, these are read from the bits of t.mutation_code, and variant_type_model is the packed
+    context (mutation_code without alt and methylation level) for CpGs and -1 otherwise
     """
     mid_index = 3 if heptamers else 1
-    transition_expr = (((t.ref == "A") & (t.alt == "G")) | ((t.ref == "G") & (t.alt == "A")) |
-                       ((t.ref == "T") & (t.alt == "C")) | ((t.ref == "C") & (t.alt == "T")))
-    cpg_expr = (((t.ref == "G") & (t.alt == "A") & (t.context[mid_index - 1:mid_index] == 'C')) |
-                ((t.ref == "C") & (t.alt == "T") & (t.context[mid_index + 1:mid_index + 2] == 'G')))
+    if packed:
+        context_length = 7 if heptamers else 3
+        ref = packed_base_expr(t.mutation_code, mid_index, context_length)
+        alt = hl.bit_and(hl.bit_rshift(t.mutation_code, 2), 3)
+        # A/G and C/T differ only in their high bit
+        transition_expr = hl.bit_xor(ref, alt) == 2
+        cpg_expr = (((ref == BASE_CODES['G']) & (alt == BASE_CODES['A']) &
+                     (packed_base_expr(t.mutation_code, mid_index - 1, context_length) == BASE_CODES['C'])) |
+                    ((ref == BASE_CODES['C']) & (alt == BASE_CODES['T']) &
+                     (packed_base_expr(t.mutation_code, mid_index + 1, context_length) == BASE_CODES['G'])))
+    else:
+        transition_expr = (((t.ref == "A") & (t.alt == "G")) | ((t.ref == "G") & (t.alt == "A")) |
+                           ((t.ref == "T") & (t.alt == "C")) | ((t.ref == "C") & (t.alt == "T")))
+        cpg_expr = (((t.ref == "G") & (t.alt == "A") & (t.context[mid_index - 1:mid_index] == 'C')) |
+                    ((t.ref == "C") & (t.alt == "T") & (t.context[mid_index + 1:mid_index + 2] == 'G')))
     if isinstance(t, hl.MatrixTable):
         t = t.annotate_rows(transition=transition_expr, cpg=cpg_expr)
     else:
@@ -189,7 +333,10 @@ def annotate_variant_types(t: Union[hl.MatrixTable, hl.Table],
                          .when(t.cpg, 'CpG')
                          .when(t.transition, 'non-CpG transition')
                          .default('transversion'))
-    variant_type_model_expr = hl.cond(t.cpg, t.context, "non-CpG")
+    if packed:
+        variant_type_model_expr = hl.cond(t.cpg, hl.bit_rshift(t.mutation_code, 4), -1)
+    else:
+        variant_type_model_expr = hl.cond(t.cpg, t.context, "non-CpG")
     if isinstance(t, hl.MatrixTable):
         return t.annotate_rows(variant_type=variant_type_expr, variant_type_model=variant_type_model_expr)
     else:
@@ -233,10 +380,21 @@ def annotate_constraint_groupings(ht: Union[hl.Table, hl.MatrixTable],
 # Aggregation of variant counts
 
 
-def annotate_expected_mutations(ht, mutation_rate_ht, plateau_models, coverage_model, half_cutoff = False, pops = False):
-    ht = annotate_with_mu(ht, mutation_rate_ht)
+def annotate_expected_mutations(ht, mutation_rate_ht, plateau_models, coverage_model, half_cutoff = False, pops = False,
+                                mu_index: Optional[np.ndarray] = None):
+    packed = 'mutation_code' in ht.row
+    if mu_index is not None:
+        ht = annotate_with_mu_index(ht, mu_index)
+    elif packed:
+        raise ValueError('Packed mutation codes need a mutation rate index (mu_index)')
+    else:
+        ht = annotate_with_mu(ht, mutation_rate_ht)
     ht = ht.transmute(possible_variants=ht.variant_count)
-    ht = annotate_variant_types(ht.annotate(mu_agg=ht.mu_snp * ht.possible_variants))
+    if packed:
+        ht = annotate_variant_types(ht.annotate(mu_agg=ht.mu_snp * ht.possible_variants),
+                                    heptamers=len(mu_index) == 4 ** 9, packed=True)
+    else:
+        ht = annotate_variant_types(ht.annotate(mu_agg=ht.mu_snp * ht.possible_variants))
     model = hl.literal(plateau_models.total)[ht.cpg]
 
     cov_cutoff = (HIGH_COVERAGE_CUTOFF / half_cutoff) if half_cutoff else HIGH_COVERAGE_CUTOFF
@@ -273,6 +431,93 @@ def annotate_with_mu(ht: hl.Table, mutation_ht: hl.Table, output_loc: str = 'mu_
     return ht.annotate(**{output_loc: hl.case().when(hl.is_defined(mu), mu).or_error('Missing mu')})
 
 
+# Integer-indexed mutation rates
+# (context, ref, alt, methylation_level) packs into a dense integer using 2 bits per base: the context bases,
+# then alt, then methylation_level. ref is always the middle base of context so it needs no bits of its own.
+
+BASE_CODES = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
+
+
+def mutation_code(context: str, alt: str, methylation_level: int) -> int:
+    '''Dense integer code for a mutation context (Python version of mutation_code_expr)'''
+    code = 0
+    for base in context + alt:
+        code = code * 4 + BASE_CODES[base]
+    return code * 4 + methylation_level
+
+
+def base_code_expr(base: hl.expr.StringExpression) -> hl.expr.Int32Expression:
+    return (hl.switch(base)
+            .when('A', 0)
+            .when('C', 1)
+            .when('G', 2)
+            .when('T', 3)
+            .or_missing())
+
+
+def mutation_code_expr(context: hl.expr.StringExpression, alt: hl.expr.StringExpression,
+                       methylation_level: hl.expr.Int32Expression, context_length: int = 3) -> hl.expr.Int32Expression:
+    '''Dense integer code for a mutation context; context_length is fixed so the bases unroll into plain arithmetic'''
+    code = hl.int32(0)
+    for i in range(context_length):
+        code = code * 4 + base_code_expr(context[i])
+    return (code * 4 + base_code_expr(alt)) * 4 + methylation_level
+
+
+def packed_base_expr(code: hl.expr.Int32Expression, position: int, context_length: int = 3) -> hl.expr.Int32Expression:
+    '''Base code (see BASE_CODES) at `position` of the context packed in a mutation code'''
+    return hl.bit_and(hl.bit_rshift(code, 2 * (context_length - 1 - position) + 4), 3)
+
+
+def unpack_mutation_code(ht: hl.Table, context_length: int = 3, field: str = 'mutation_code') -> hl.Table:
+    '''Annotate context, ref, alt and methylation_level strings back from a packed mutation code'''
+    bases = hl.literal(sorted(BASE_CODES, key=BASE_CODES.get))
+    code = ht[field]
+    context = hl.delimit([bases[packed_base_expr(code, i, context_length)] for i in range(context_length)], '')
+    return ht.annotate(
+        context=context,
+        ref=context[context_length // 2],
+        alt=bases[hl.bit_and(hl.bit_rshift(code, 2), 3)],
+        methylation_level=hl.bit_and(code, 3)
+    )
+
+
+def build_mutation_rate_index(mutation_ht: hl.Table, context_length: int = 3) -> np.ndarray:
+    '''Collect mutation rates once into a flat float array indexed by mutation_code (NaN where no rate exists)'''
+    rows = mutation_ht.aggregate(hl.agg.collect(hl.struct(
+        context=mutation_ht.context, ref=mutation_ht.ref, alt=mutation_ht.alt,
+        methylation_level=mutation_ht.methylation_level, mu_snp=mutation_ht.mu_snp)))
+    mu_index = np.full(4 ** (context_length + 2), np.nan)
+    for row in rows:
+        assert len(row.context) == context_length, f'Expected {context_length}-mer contexts, found {row.context}'
+        assert row.ref == row.context[context_length // 2], f'ref {row.ref} is not the middle base of {row.context}'
+        mu_index[mutation_code(row.context, row.alt, row.methylation_level)] = row.mu_snp
+    return mu_index
+
+
+def load_mutation_rate_index(path: str, mutation_ht: hl.Table, trimer: bool = True) -> np.ndarray:
+    '''Load the mutation rate index cached at `path`, building and caching it from `mutation_ht` if absent'''
+    if os.path.isfile(path):
+        return np.load(path)
+    mu_index = build_mutation_rate_index(mutation_ht, 3 if trimer else 7)
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp.npy'
+    np.save(tmp_path, mu_index)
+    os.replace(tmp_path, path)
+    return mu_index
+
+
+def annotate_with_mu_index(ht: hl.Table, mu_index: np.ndarray, output_loc: str = 'mu_snp') -> hl.Table:
+    '''Same as annotate_with_mu, resolving mu by array indexing into a broadcast mutation rate index'''
+    context_length = int(round(np.log(len(mu_index)) / np.log(4))) - 2
+    mu_array = hl.literal(np.where(np.isnan(mu_index), None, mu_index).tolist(), dtype=hl.tarray(hl.tfloat64))
+    if 'mutation_code' in ht.row:
+        mu = mu_array[ht.mutation_code]
+    else:
+        mu = mu_array[mutation_code_expr(ht.context, ht.alt, ht.methylation_level, context_length)]
+    return ht.annotate(**{output_loc: hl.case().when(hl.is_defined(mu), mu).or_error('Missing mu')})
+
+
 def count_variants(ht: hl.Table,
                    count_singletons: bool = False, count_downsamplings: Optional[List[str]] = (),
                    additional_grouping: Optional[List[str]] = (), partition_hint: int = 100,
@@ -283,10 +528,16 @@ def count_variants(ht: hl.Table,
     Count variants by context, ref, alt, methylation_level and additional variables.
     Additional variables include gene and variant type
     All variables must be in the original schema
+    Tables prepared with packed=True are counted by mutation_code (see unpack_mutation_code)
     """
-    grouping = hl.struct(context=ht.context, ref=ht.ref, alt=ht.alt)
-    if not omit_methylation:
-        grouping = grouping.annotate(methylation_level=ht.methylation_level)
+    if 'mutation_code' in ht.row:
+        # With omit_methylation, clear the methylation level bits
+        grouping = hl.struct(mutation_code=ht.mutation_code - hl.bit_and(ht.mutation_code, 3)
+                             if omit_methylation else ht.mutation_code)
+    else:
+        grouping = hl.struct(context=ht.context, ref=ht.ref, alt=ht.alt)
+        if not omit_methylation:
+            grouping = grouping.annotate(methylation_level=ht.methylation_level)
     for group in additional_grouping:
         grouping = grouping.annotate(**{group: ht[group]})
 
@@ -350,27 +601,60 @@ def collapse_lof_ht(lof_ht: hl.Table, keys: Tuple[str], calculate_pop_pLI: bool
     lof_ht = lof_ht.group_by(*keys).aggregate(**agg_expr).persist()
     lof_ht = lof_ht.filter(lof_ht.exp_lof > 0)
     if calculate_pop_pLI:
-        pop_lengths = get_all_pop_lengths(lof_ht, 'obs_lof_')
-        print(pop_lengths)
-        for pop_length, pop in pop_lengths:
-            print(f'Calculating pLI for {pop}...')
-            plis = []
-            for i in range(8, pop_length):
-                print(i)
-                ht = lof_ht.filter(lof_ht[f'exp_lof_{pop}'][i] > 0)
-                pli_ht = pLI(ht, ht[f'obs_lof_{pop}'][i], ht[f'exp_lof_{pop}'][i])
-                plis.append(pli_ht[lof_ht.key])
-            lof_ht = lof_ht.annotate(**{
-                f'pLI_{pop}': [pli.pLI for pli in plis],
-                f'pRec_{pop}': [pli.pRec for pli in plis],
-                f'pNull_{pop}': [pli.pNull for pli in plis],
-            })
-    return lof_ht.annotate(
-        **pLI(lof_ht, lof_ht.obs_lof, lof_ht.exp_lof)[lof_ht.key],
-        oe_lof=lof_ht.obs_lof / lof_ht.exp_lof).key_by(*keys)
+        # Fit every population x downsampling (from index 8) in one batched EM
+        lof_ht, df = _collect_frame(lof_ht, **{f'{x}_lof_{pop}': lof_ht[f'{x}_lof_{pop}'] for pop in POPS for x in ('obs', 'exp')})
+        obs_columns, exp_columns, slices = [], [], {}
+        for pop in POPS:
+            obs_pop = np.array(df[f'obs_lof_{pop}'].tolist(), dtype=np.float64)
+            exp_pop = np.array(df[f'exp_lof_{pop}'].tolist(), dtype=np.float64)
+            assert obs_pop.ndim == 2, f'Downsampling arrays for {pop} differ in length'
+            print(f'Found: {obs_pop.shape[1]} downsamplings for {pop}')
+            slices[pop] = slice(len(obs_columns), len(obs_columns) + max(obs_pop.shape[1] - 8, 0))
+            obs_columns.extend(obs_pop[:, 8:].T)
+            exp_columns.extend(exp_pop[:, 8:].T)
+        print(f'Calculating pLI for {len(obs_columns)} population x downsampling fits...')
+        if obs_columns:
+            plis = pLI_np(np.stack(obs_columns, axis=1), np.stack(exp_columns, axis=1))
+        else:
+            # No population has more than 8 downsamplings: every population gets empty pLI arrays
+            plis = {k: np.zeros((len(df), 0)) for k in ('pLI', 'pRec', 'pNull')}
+        lof_ht = _annotate_from_arrays(lof_ht, df, {
+            f'{k}_{pop}': plis[k][:, slices[pop]] for pop in POPS for k in ('pLI', 'pRec', 'pNull')
+        })
+    lof_ht = pLI(lof_ht, lof_ht.obs_lof, lof_ht.exp_lof)
+    return lof_ht.annotate(oe_lof=lof_ht.obs_lof / lof_ht.exp_lof).key_by(*keys)
 
 # Calculation of summary stats
 
+def oe_confidence_interval_expr(
+        obs: hl.expr.Int32Expression,
+        exp: hl.expr.Float32Expression,
+        alpha: float = 0.05,
+        range: float = 3.0,
+        density: int = 1000
+        ) -> hl.expr.StructExpression:
+    '''
+    Grid search CI for an observed/expected ratio as a struct of lower, upper and log_P_H0
+    Being a row expression, CIs of several obs/exp pairs are computed in the same pass over a table
+    '''
+    # l (normalised rate of mutation) in a grid between 0 and range
+    grid = hl.range(0, int(range * density)).map(lambda x: hl.float64(x) / density)
+
+    def ci(obs, exp):
+        # Sum of Poisson probability mass Po(N_exp * l) of observing N_obs for rates up to l
+        cumulative_dpois = hl.cumulative_sum(grid.map(lambda x: hl.dpois(obs, exp * x)))
+        # Normalise to obtain probability that true constraint > l (assume less than limit)
+        norm_dpois = hl.bind(lambda total: cumulative_dpois.map(lambda x: x / total), cumulative_dpois[-1])
+        # Lower bound at max P(L < l) < alpha (or 0 if N_obs = 0), upper at min P(L < l) > 1 - alpha, log P(L > 1)
+        return hl.bind(lambda norm_dpois: hl.struct(
+            lower=hl.cond(obs > 0, grid[hl.argmax(norm_dpois.map(lambda x: hl.or_missing(x < alpha, x)))], 0),
+            upper=grid[hl.argmin(norm_dpois.map(lambda x: hl.or_missing(x > 1 - alpha, x)))],
+            log_P_H0=hl.log(hl.literal(1) - norm_dpois[density])
+        ), norm_dpois)
+
+    return hl.bind(ci, obs, exp)
+
+
 def oe_confidence_interval(
         ht: hl.Table, 
         obs: hl.expr.Int32Expression, 
@@ -381,72 +665,201 @@ def oe_confidence_interval(
         density: int = 1000,
         select_only_ci_metrics: bool = True
         ) -> hl.Table:
-    '''Calculate CI for observed/expected ratio'''
+    '''
+    Calculate CI for observed/expected ratio
+    Adds the same fields as annotate_oe_confidence_intervals: {prefix}_lower, {prefix}_upper and log_P_H0 carrying
+    the suffix of prefix
+    '''
     # This function is vectorised over the whole table
-    ht = ht.annotate(_obs=obs, _exp=exp)
-    
-    # create l (normalised rate of mutation) in grid array between 0 and 2
-    oe_ht = ht.annotate(_range=(
-        hl.range(0, int(range * density))
-          .map(lambda x: hl.float64(x) / density))
-    )
-    # Poisson probability mass Po(N_exp * l) of observing N_obs for a given rate
-    oe_ht = oe_ht.annotate(_range_dpois=(
-        oe_ht._range.map(lambda x: 
-            hl.dpois(oe_ht._obs, oe_ht._exp * x)
-    )))
-    # Sum of probility mass for rates up to l
-    oe_ht = oe_ht.transmute(
-        _cumulative_dpois=hl.cumulative_sum(oe_ht._range_dpois)
-    )
-    # Total sum of probability mass for range scanned
-    oe_ht = oe_ht.annotate(
-        _max_cumulative_dpois = oe_ht._cumulative_dpois[-1]
-    )
-    # Normalise to obtain probability that true constraint > l (assume less than limit)
-    oe_ht = oe_ht.transmute(
-        _norm_dpois=oe_ht._cumulative_dpois / oe_ht._max_cumulative_dpois
-    )
-    # Find idx for max P(L < l) < alpha
-    #  idx for min P(L < l) > 1 - alpha
-    # log P(L > 1)
-    oe_ht = oe_ht.transmute(
-        _lower_idx=hl.argmax(oe_ht._norm_dpois.map(lambda x: hl.or_missing(x < alpha, x))),
-        _upper_idx=hl.argmin(oe_ht._norm_dpois.map(lambda x: hl.or_missing(x > 1 - alpha, x))),
-        logP_H0= hl.log(hl.literal(1) - oe_ht._norm_dpois[density])
-    )
- 
-    oe_ht = oe_ht.transmute(**{
-        # Lower bound of confidence interval (or 0 if N_obs = 0)
-        f'{prefix}_lower': hl.cond(oe_ht._obs > 0, oe_ht._range[oe_ht._lower_idx], 0),
-        # Upper bound of confidence interval
-        f'{prefix}_upper': oe_ht._range[oe_ht._upper_idx]
-    })
+    fields = [f'{prefix}_lower', f'{prefix}_upper', f'log_P_H0{prefix[len("oe"):]}']
+    ht = ht.annotate(_ci=oe_confidence_interval_expr(obs, exp, alpha=alpha, range=range, density=density))
+    oe_ht = ht.transmute(**dict(zip(fields, (ht._ci.lower, ht._ci.upper, ht._ci.log_P_H0))))
     if select_only_ci_metrics:
-        return oe_ht.select(f'{prefix}_lower', f'{prefix}_upper',f'log_P_H0')
+        return oe_ht.select(*fields)
     else:
-        return oe_ht.drop('_exp')
+        return oe_ht
 
 
-def pLI(ht: hl.Table, obs: hl.expr.Int32Expression, exp: hl.expr.Float32Expression) -> hl.Table:
-    '''Calculate p(lof intolerant) - metric for constraint'''
-    last_pi = {'Null': 0, 'Rec': 0, 'LI': 0}
-    pi = {'Null': 1 / 3, 'Rec': 1 / 3, 'LI': 1 / 3}
+def oe_confidence_interval_np(
+        obs: np.ndarray,
+        exp: np.ndarray,
+        alpha: float = 0.05,
+        range: float = 3.0,
+        density: int = 1000
+        ) -> Dict[str, np.ndarray]:
+    '''
+    Calculate CI for observed/expected ratio on NumPy arrays of any length
+
+    The grid search in oe_confidence_interval sums Po(obs | exp * l) over l, which is proportional to a
+    Gamma(obs + 1, exp) density, so its cumulative sum is the regularised incomplete gamma function
+    evaluated at the upper edge of each grid cell. Bounds are found with the inverse of that function and
+    snapped onto the same grid, so oe_lower and oe_upper agree with the Hail path to within one grid step
+    (1 / density) and log_P_H0 agrees up to the O(1 / density) discretisation error of the grid (the grid
+    path saturates once 1 - P(L < 1) drops below float64 resolution, log_P_H0 < ~ -30, where this is exact).
+    Rows with exp <= 0 or missing values give NaN, as do rows with no usable probability mass in the scanned
+    range (e.g. obs / exp far above range), which the grid search leaves missing.
+    '''
+    obs = np.asarray(obs, dtype=np.float64)
+    exp = np.asarray(exp, dtype=np.float64)
+    step = 1 / density
+    n_grid = int(range * density)
+    end = (n_grid - 1) * step + step / 2
+    valid = np.isfinite(obs) & np.isfinite(exp) & (exp > 0)
+    shape = np.where(valid, obs + 1, 1.0)
+    rate = np.where(valid, exp, 1.0)
+
+    # Mass up to the end of the scanned range, used to normalise as in the grid search
+    total = special.gammainc(shape, rate * end)
+    valid &= total >= np.finfo(np.float64).tiny
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lower_q = special.gammaincinv(shape, alpha * total) / rate
+        upper_q = special.gammaincinv(shape, (1 - alpha) * total) / rate
+        # Largest grid index with P(L < l) < alpha; smallest grid index with P(L < l) > 1 - alpha
+        lower_idx = np.ceil(lower_q / step - 0.5) - 1
+        upper_idx = np.floor(upper_q / step - 0.5) + 1
+        # Mass between l = 1 and the end of the range, as a difference of whichever complement is not near 1
+        below_one = special.gammainc(shape, rate * (1 + step / 2))
+        tail = np.where(below_one < 0.5,
+                        special.gammainc(shape, rate * end) - below_one,
+                        special.gammaincc(shape, rate * (1 + step / 2)) - special.gammaincc(shape, rate * end))
+        log_p = np.log(tail / total)
+
+    lower = np.where(lower_idx >= 0, lower_idx * step, np.nan)
+    lower = np.where(obs > 0, lower, 0.0)
+    upper = np.where(upper_idx <= n_grid - 1, upper_idx * step, np.nan)
+    return {
+        'lower': np.where(valid, lower, np.nan),
+        'upper': np.where(valid, upper, np.nan),
+        'log_P_H0': np.where(valid, log_p, np.nan)
+    }
+
+
+def annotate_oe_confidence_intervals(
+        ht: hl.Table,
+        cis: Dict[str, Tuple[hl.expr.NumericExpression, hl.expr.NumericExpression]],
+        alpha: float = 0.05,
+        range: float = 3.0,
+        density: int = 1000
+        ) -> hl.Table:
+    '''
+    Calculate CIs for several observed/expected pairs in a single driver-side pass
+
+    `cis` maps an output prefix to an (obs, exp) pair. Each prefix gets {prefix}_lower and {prefix}_upper,
+    plus a log_P_H0 field carrying the same suffix (prefix 'oe' -> log_P_H0, 'oe_syn' -> log_P_H0_syn).
+    Only a row index and the obs/exp columns are collected; results are joined back to `ht` on that index.
+    '''
+    columns = {}
+    for i, (obs, exp) in enumerate(cis.values()):
+        columns[f'_obs_{i}'] = obs
+        columns[f'_exp_{i}'] = exp
+    ht, df = _collect_frame(ht, **columns)
+
+    results = {}
+    for i, prefix in enumerate(cis):
+        ci = oe_confidence_interval_np(df[f'_obs_{i}'].to_numpy(dtype=np.float64, na_value=np.nan),
+                                       df[f'_exp_{i}'].to_numpy(dtype=np.float64, na_value=np.nan),
+                                       alpha=alpha, range=range, density=density)
+        results[f'{prefix}_lower'] = ci['lower']
+        results[f'{prefix}_upper'] = ci['upper']
+        results[f'log_P_H0{prefix[len("oe"):]}'] = ci['log_P_H0']
+    return _annotate_from_arrays(ht, df, results)
+
+
+def _collect_frame(ht: hl.Table, **exprs) -> Tuple[hl.Table, pd.DataFrame]:
+    '''
+    Number the rows of `ht` (ROW_INDEX) and collect the numbers with the given row expressions of `ht` to a pandas
+    DataFrame. Returns the numbered table, which _annotate_from_arrays joins results back onto, and the frame
+    Key fields are not collected, so rows with missing key fields get results like any other row
+    '''
+    ht = ht.annotate(**{f'_collect_{k}': v for k, v in exprs.items()}).add_index(ROW_INDEX)
+    df = (ht.key_by()
+          .select(ROW_INDEX, **{k: ht[f'_collect_{k}'] for k in exprs})
+          .select_globals()
+          .to_pandas())
+    return ht.drop(*[f'_collect_{k}' for k in exprs]), df
+
+
+def _annotate_from_arrays(ht: hl.Table, df: pd.DataFrame, arrays: Dict[str, np.ndarray]) -> hl.Table:
+    '''Join float64 arrays aligned with the rows of `df` back onto `ht` as numbered by _collect_frame (NaN becomes missing)'''
+    results_ht = _table_from_arrays(df[ROW_INDEX].to_numpy(), arrays)
+    return ht.annotate(**results_ht[ht[ROW_INDEX]]).drop(ROW_INDEX)
+
+
+def _table_from_arrays(row_index: np.ndarray, arrays: Dict[str, np.ndarray]) -> hl.Table:
+    '''
+    Build a table keyed by ROW_INDEX from float64 arrays aligned with row_index (1-D -> float64 field, 2-D ->
+    array<float64> field, NaN becoming missing)
+    The arrays go to Spark as one Arrow batch per partition rather than as Python records, so this scales
+    with the table
+    '''
+    from hail.utils.java import Env
+    from pyspark.sql import types
+
+    spark = Env.spark_session()
+    spark.conf.set('spark.sql.execution.arrow.pyspark.enabled', 'true')
+    frame = pd.DataFrame({ROW_INDEX: np.asarray(row_index, dtype=np.int64),
+                          **{k: v if np.ndim(v) == 1 else list(v) for k, v in arrays.items()}})
+    schema = types.StructType([types.StructField(ROW_INDEX, types.LongType(), False)] + [
+        types.StructField(k, types.DoubleType() if np.ndim(v) == 1 else types.ArrayType(types.DoubleType()))
+        for k, v in arrays.items()])
+    ht = hl.Table.from_spark(spark.createDataFrame(frame, schema=schema), key=ROW_INDEX)
+    return ht.annotate(**{
+        k: hl.or_missing(~hl.is_nan(ht[k]), ht[k]) if np.ndim(v) == 1
+        else ht[k].map(lambda x: hl.or_missing(~hl.is_nan(x), x))
+        for k, v in arrays.items()})
+
+
+def pLI_np(obs: np.ndarray, exp: np.ndarray, tol: float = 0.001) -> Dict[str, np.ndarray]:
+    '''
+    Calculate p(lof intolerant) on NumPy arrays
+
+    obs and exp are either 1-D (one fit) or 2-D with one column per independent fit (e.g. every population x
+    downsampling), and all columns are fitted together. Each column runs the same three-component Poisson
+    mixture EM as the Hail implementation until its change in pi_LI is <= tol. Rows with missing values or
+    exp <= 0 are left out of the fit for that column and give NaN.
+    '''
     expected_values = {'Null': 1, 'Rec': 0.463, 'LI': 0.089}
-    ht = ht.annotate(_obs=obs, _exp=exp)
-
-    while abs(pi['LI'] - last_pi['LI']) > 0.001:
-        last_pi = copy.deepcopy(pi)
-        ht = ht.annotate(
-            **{k: v * hl.dpois(ht._obs, ht._exp * expected_values[k]) for k, v in pi.items()})
-        ht = ht.annotate(row_sum=hl.sum([ht[k] for k in pi]))
-        ht = ht.annotate(**{k: ht[k] / ht.row_sum for k, v in pi.items()})
-        pi = ht.aggregate({k: hl.agg.mean(ht[k]) for k in pi.keys()})
-
-    ht = ht.annotate(
-        **{k: v * hl.dpois(ht._obs, ht._exp * expected_values[k]) for k, v in pi.items()})
-    ht = ht.annotate(row_sum=hl.sum([ht[k] for k in pi]))
-    return ht.select(**{f'p{k}': ht[k] / ht.row_sum for k, v in pi.items()})
+    obs = np.asarray(obs, dtype=np.float64)
+    exp = np.asarray(exp, dtype=np.float64)
+    one_fit = obs.ndim == 1
+    if one_fit:
+        obs, exp = obs[:, None], exp[:, None]
+    valid = np.isfinite(obs) & np.isfinite(exp) & (exp > 0)
+    obs = np.where(valid, obs, 0)
+    exp = np.where(valid, exp, 1)
+
+    # Poisson log-likelihood of each row under each component: (component, row, fit)
+    rates = np.stack([exp * v for v in expected_values.values()])
+    log_lik = special.xlogy(obs, rates) - rates - special.gammaln(obs + 1)
+
+    def posterior(pi):
+        log_post = np.log(pi)[:, None, :] + log_lik
+        log_post -= log_post.max(axis=0)
+        post = np.exp(log_post)
+        return np.where(valid, post / post.sum(axis=0), np.nan)
+
+    n_fits = obs.shape[1]
+    pi = np.full((3, n_fits), 1 / 3)
+    active = np.ones(n_fits, dtype=bool)
+    while active.any():
+        last_li = pi[2].copy()
+        with np.errstate(invalid='ignore'):
+            pi[:, active] = np.nanmean(posterior(pi), axis=1)[:, active]
+        active &= np.abs(pi[2] - last_li) > tol
+
+    post = posterior(pi)
+    if one_fit:
+        post = post[:, :, 0]
+    return {f'p{k}': post[i] for i, k in enumerate(expected_values)}
+
+
+def pLI(ht: hl.Table, obs: hl.expr.Int32Expression, exp: hl.expr.Float32Expression) -> hl.Table:
+    '''Calculate p(lof intolerant) - metric for constraint
+    obs and exp are collected once and the EM runs on the driver (see pLI_np); returns ht annotated with pNull, pRec, pLI'''
+    ht, df = _collect_frame(ht, obs=obs, exp=exp)
+    pli = pLI_np(df['obs'].to_numpy(dtype=np.float64, na_value=np.nan),
+                 df['exp'].to_numpy(dtype=np.float64, na_value=np.nan))
+    return _annotate_from_arrays(ht, df, pli)
 
 
 def annotate_issues(ht: hl.Table) -> hl.Table:
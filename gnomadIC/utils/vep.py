@@ -71,6 +71,16 @@ CSQ_ORDER = (
     + CSQ_NON_CODING
 )
 
+CSQ_RANKS = {csq: rank for rank, csq in enumerate(CSQ_ORDER)}
+"""
+Constant mapping each consequence term to its rank in CSQ_ORDER (0 is the most severe).
+"""
+
+MAX_CSQ_MASK_TERMS = 63
+"""
+Constant containing the largest number of consequence terms an int64 consequence bitmask can hold.
+"""
+
 POSSIBLE_REFS = ("GRCh37", "GRCh38")
 """
 Constant containing supported references
@@ -228,6 +238,57 @@ def vep_or_lookup_vep(
     return vep_ht.union(revep_ht)
 
 
+def csq_mask_expr(
+    consequence_terms: hl.expr.ArrayExpression, csq_order: List[str] = CSQ_ORDER
+) -> hl.expr.Int64Expression:
+    """
+    Encode consequence terms as a bitmask, with the bit of each term's rank in `csq_order` set.
+
+    Terms not in `csq_order` set no bit. Masks of several consequences combine with `hl.bit_or`.
+
+    :param consequence_terms: Array of VEP consequence terms
+    :param csq_order: Order of VEP consequences, sorted from high to low impact. Default is CSQ_ORDER.
+    :return: Bitmask of the consequence terms
+    """
+    if len(csq_order) > MAX_CSQ_MASK_TERMS:
+        raise ValueError(
+            f"A consequence bitmask holds at most {MAX_CSQ_MASK_TERMS} terms, not {len(csq_order)}"
+        )
+    csq_bits = hl.literal(
+        {csq: 1 << rank for rank, csq in enumerate(csq_order)},
+        hl.tdict(hl.tstr, hl.tint64),
+    )
+    return consequence_terms.fold(
+        lambda mask, c: hl.bit_or(mask, csq_bits.get(c, hl.int64(0))), hl.int64(0)
+    )
+
+
+def most_severe_csq_rank_from_mask(
+    mask: hl.expr.Int64Expression,
+) -> hl.expr.Int32Expression:
+    """
+    Get the rank of the most severe consequence in a consequence bitmask, i.e. its lowest set bit.
+
+    :param mask: Bitmask from `csq_mask_expr`
+    :return: Rank of the most severe consequence, missing if no bit is set
+    """
+    # mask & -mask keeps only the lowest set bit, and the bits below it count its position
+    return hl.or_missing(mask != 0, hl.bit_count(hl.bit_and(mask, -mask) - 1))
+
+
+def most_severe_csq_from_mask(
+    mask: hl.expr.Int64Expression, csq_order: List[str] = CSQ_ORDER
+) -> hl.expr.StringExpression:
+    """
+    Get the most severe consequence term in a consequence bitmask.
+
+    :param mask: Bitmask from `csq_mask_expr`
+    :param csq_order: Order of VEP consequences the mask was built with. Default is CSQ_ORDER.
+    :return: Most severe consequence term, missing if no bit is set
+    """
+    return hl.literal(csq_order)[most_severe_csq_rank_from_mask(mask)]
+
+
 def add_most_severe_consequence_to_consequence(
     tc: hl.expr.StructExpression,
 ) -> hl.expr.StructExpression:
@@ -237,10 +298,10 @@ def add_most_severe_consequence_to_consequence(
     This is for a given transcript, as there are often multiple annotations for a single transcript:
     e.g. splice_region_variant&intron_variant -> splice_region_variant
     """
-    csqs = hl.literal(CSQ_ORDER)
-
     return tc.annotate(
-        most_severe_consequence=csqs.find(lambda c: tc.consequence_terms.contains(c))
+        most_severe_consequence=most_severe_csq_from_mask(
+            csq_mask_expr(tc.consequence_terms)
+        )
     )
 
 
@@ -259,8 +320,7 @@ def process_consequences(
     :param penalize_flags: Whether to penalize LOFTEE flagged variants, or treat them as equal to HC
     :return: MT with better formatted consequences
     """
-    csqs = hl.literal(CSQ_ORDER)
-    csq_dict = hl.literal(dict(zip(CSQ_ORDER, range(len(CSQ_ORDER)))))
+    csq_ranks = hl.literal(CSQ_RANKS)
 
     def find_worst_transcript_consequence(
         tcl: hl.expr.ArrayExpression,
@@ -269,29 +329,25 @@ def process_consequences(
         flag_score = 500
         no_flag_score = flag_score * (1 + penalize_flags)
 
-        def csq_score(tc):
-            return csq_dict[csqs.find(lambda x: x == tc.most_severe_consequence)]
+        def csq_score(tc, score):
+            return (
+                hl.case(missing_false=True)
+                .when((tc.lof == "HC") & (tc.lof_flags == ""), score - no_flag_score)
+                .when((tc.lof == "HC") & (tc.lof_flags != ""), score - flag_score)
+                .when(tc.lof == "OS", score - 20)
+                .when(tc.lof == "LC", score - 10)
+                .when(tc.polyphen_prediction == "probably_damaging", score - 0.5)
+                .when(tc.polyphen_prediction == "possibly_damaging", score - 0.25)
+                .when(tc.polyphen_prediction == "benign", score - 0.1)
+                .default(score)
+            )
 
         tcl = tcl.map(
             lambda tc: tc.annotate(
-                csq_score=hl.case(missing_false=True)
-                .when(
-                    (tc.lof == "HC") & (tc.lof_flags == ""),
-                    csq_score(tc) - no_flag_score,
-                )
-                .when(
-                    (tc.lof == "HC") & (tc.lof_flags != ""), csq_score(tc) - flag_score
-                )
-                .when(tc.lof == "OS", csq_score(tc) - 20)
-                .when(tc.lof == "LC", csq_score(tc) - 10)
-                .when(
-                    tc.polyphen_prediction == "probably_damaging", csq_score(tc) - 0.5
+                csq_score=hl.bind(
+                    lambda score: csq_score(tc, score),
+                    csq_ranks.get(tc.most_severe_consequence),
                 )
-                .when(
-                    tc.polyphen_prediction == "possibly_damaging", csq_score(tc) - 0.25
-                )
-                .when(tc.polyphen_prediction == "benign", csq_score(tc) - 0.1)
-                .default(csq_score(tc))
             )
         )
         return hl.or_missing(hl.len(tcl) > 0, hl.sorted(tcl, lambda x: x.csq_score)[0])
@@ -315,11 +371,13 @@ def process_consequences(
 
     vep_data = mt[vep_root].annotate(
         transcript_consequences=transcript_csqs,
-        worst_consequence_term=csqs.find(
-            lambda c: transcript_csqs.map(
-                lambda csq: csq.most_severe_consequence
-            ).contains(c)
-        ),
+        worst_consequence_term=hl.literal(CSQ_ORDER)[
+            hl.min(
+                transcript_csqs.map(
+                    lambda csq: csq_ranks.get(csq.most_severe_consequence)
+                )
+            )
+        ],
         worst_csq_by_gene=sorted_scores,
         worst_csq_for_variant=hl.or_missing(
             hl.len(sorted_scores) > 0, sorted_scores[0]
@@ -523,10 +581,13 @@ def get_most_severe_consequence_for_summary(
                 hl.is_defined(lof),
                 csq_list.any(lambda x: (x.lof == lof) & hl.is_missing(x.lof_flags)),
             )
-        all_csq_terms = csq_list.flatmap(lambda x: x.consequence_terms)
-        most_severe_csq = hl.literal(csq_order).find(
-            lambda x: all_csq_terms.contains(x)
+        csq_mask = csq_list.fold(
+            lambda mask, x: hl.bit_or(
+                mask, csq_mask_expr(x.consequence_terms, csq_order)
+            ),
+            hl.int64(0),
         )
+        most_severe_csq = most_severe_csq_from_mask(csq_mask, csq_order)
         return hl.struct(
             most_severe_csq=most_severe_csq,
             protein_coding=protein_coding,